@@ -4,7 +4,7 @@
 from builtins import str
 from builtins import range
 
-import os, datetime, sys
+import os, sys
 
 import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.fsl as fsl          # fsl
@@ -12,6 +12,7 @@ import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 
 import utils # code by AM specific to this project but multiple workflows
+import workdirs
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -43,6 +44,26 @@ wf.connect([
     ])
 
 if __name__ == '__main__':
+    utils.setup_logging()
+    # In-process (numpy) mode, no FSL or intermediate files:
+    #   python assign_mp.py --manifest splits.tsv [results.tsv]
+    #       (TSV with cope, roi, percentile and optionally roi_below_suffix, roi_above_suffix, out_dir columns)
+    #   python assign_mp.py --numpy cope roi pct_thresh roi_below roi_above out_dir
+    # both write the masks named as utils.roi_partition_filenames does
+    if sys.argv[1] == '--manifest':
+        manifest = os.path.abspath(sys.argv[2])
+        results_file = os.path.abspath(sys.argv[3]) if len(sys.argv) > 3 else f"{os.path.splitext(manifest)[0]}_results.tsv"
+        results = utils.assign_roi_percentiles(manifest)
+        results.to_csv(results_file, sep='\t', index=False)
+        print(results)
+        sys.exit(0)
+    elif sys.argv[1] == '--numpy':
+        cope_file, roi_mask, pct_thresh, roi_below_name, roi_above_name, out_dir = sys.argv[2:8]
+        print(utils.assign_roi_percentiles([dict(cope=os.path.abspath(cope_file), roi=os.path.abspath(roi_mask),
+            percentile=float(pct_thresh), roi_below_suffix=roi_below_name, roi_above_suffix=roi_above_name,
+            out_dir=os.path.abspath(out_dir))]))
+        sys.exit(0)
+
     # When this script is invoked from the command line, read in arguments and use them
     cope_file = os.path.abspath(sys.argv[1])
     roi_mask = os.path.abspath(sys.argv[2])
@@ -55,18 +76,19 @@ if __name__ == '__main__':
 
     out_dir = os.path.abspath(sys.argv[6])
 
-    # where intermediate outputs etc are stored
-    # by creating a unique one each time, we prevent re-use,
-    # which is desirable while testing different processing options and keeping them all
-    # but maybe should be changed to a flag or option later (TODO)
-    now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    working_dir = os.path.abspath(os.path.join(out_dir, f"assignmp_{now}"))
+    # where intermediate outputs etc are stored: named after a hash of the parameters and input files,
+    # so a rerun with the same ones reuses the cached results and different options each keep their own
+    params = dict(percentile_threshold=fslstats_op_string, roi_below_name=roi_below_name, roi_above_name=roi_above_name)
+    working_dir = workdirs.hashed_working_dir(out_dir, "assignmp", params, files=[cope_file, roi_mask])
     wf.base_dir = working_dir
-    wf.config = {"execution": {"crashdump_dir": os.path.join(working_dir, 'crashdumps')}}
+    wf.config = {"execution": {"crashdump_dir": os.path.join(working_dir, 'crashdumps'),
+                               "hash_method": "content"}}
 
     infosource.inputs.cope_file = cope_file
     infosource.inputs.roi_mask = roi_mask
     infosource.inputs.percentile_threshold = fslstats_op_string
 
     wf.write_graph()
-    outgraph = wf.run(plugin='MultiProc', plugin_args={'n_procs':3})
\ No newline at end of file
+    with workdirs.job(working_dir):
+        wf.run(plugin='MultiProc', plugin_args={'n_procs':3})
+    workdirs.gc_working_dirs(out_dir, keep=[working_dir])
\ No newline at end of file
@@ -0,0 +1,41 @@
+# Timings of the fixed effects GLM workflow with compressed vs uncompressed intermediates
+#
+# Runs the same GLM once with NIFTI_GZ and once with NIFTI scratch images (each in its own working directory,
+# suffixed bench-<type>), and reports the wall time, working directory size and the time spent in each node.
+# Remove those working directories between benchmarks, or nipype will just reuse the cached results.
+# Run from glm_code/:
+#   python benchmarks/bench_glm_intermediates.py sub ses task "[2, 3, 4]" "(4, 0)" raw_data_dir out_dir [n_procs]
+
+import os, sys, time, ast
+import os.path as op
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import pandas as pd
+
+import utils
+import profiling
+
+
+def dir_size(path):
+    return sum(op.getsize(op.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+if __name__ == '__main__':
+    sub, ses, task, runs, trim_idxs, raw_data_dir, out_dir = sys.argv[1:8]
+    n_procs = int(sys.argv[8]) if len(sys.argv) > 8 else 3
+    runs, trim_idxs = ast.literal_eval(runs), ast.literal_eval(trim_idxs)
+
+    timings = {}
+    nodes = {}
+    for intermediate_type in ('NIFTI_GZ', 'NIFTI'):
+        start = time.time()
+        working_dir = utils.run_fixedeffects_glm(sub, ses, task, runs, raw_data_dir, out_dir,
+                                                 working_dir_suffix=f"bench-{intermediate_type}", trim_idxs=trim_idxs,
+                                                 n_procs=n_procs, intermediate_type=intermediate_type)
+        timings[intermediate_type] = {'seconds': time.time() - start,
+                                      'working_dir_gb': dir_size(working_dir) / 1024**3}
+        nodes[intermediate_type] = {r['name']: r['wall_s'] for r in profiling.node_records(working_dir)}
+
+    print(pd.DataFrame(timings).T)
+    print(pd.DataFrame(nodes).fillna(0).round(1))
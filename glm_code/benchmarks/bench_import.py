@@ -0,0 +1,52 @@
+# Import times of the project's modules
+#
+# Each module is imported in a fresh interpreter (so nothing is already in sys.modules), and the median wall
+# time over the repeats is reported along with the heavy dependencies that the import pulled in.
+# `import utils` should stay in the milliseconds and load none of them. Run from glm_code/:
+#   python benchmarks/bench_import.py [--repeat 5] [modules ...]
+
+import sys, json
+import os.path as op
+import argparse
+import statistics
+import subprocess
+
+GLM_CODE_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+
+MODULES = ['utils', 'glm_inputs', 'bids_index', 'workdirs', 'image_utils', 'roi_utils', 'timeseries_utils',
+           'glm_fixedeffects_level12']
+HEAVY = ['numpy', 'pandas', 'nibabel', 'nilearn', 'nitime', 'matplotlib', 'bids', 'nipype']
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def import_time(module, repeat=5):
+    """Median seconds to import module in a new interpreter, and the heavy modules it loaded"""
+    runs = []
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY)], cwd=GLM_CODE_DIR,
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            return {'seconds': None, 'loaded': [], 'error': proc.stderr.strip().splitlines()[-1]}
+        runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return {'seconds': statistics.median(r['seconds'] for r in runs), 'loaded': runs[-1]['loaded']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the imports of the project's modules")
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        result = import_time(module, args.repeat)
+        if result['seconds'] is None:
+            print(f"{module:<28}{'failed':>10}  {result['error']}")
+        else:
+            print(f"{module:<28}{result['seconds'] * 1000:>8.1f} ms  {', '.join(result['loaded']) or '-'}")
@@ -0,0 +1,145 @@
+# Peak memory of the image-loading helpers in utils.py
+#
+# Each helper is run on synthetic data (int16 bolds, uint8 masks, like the scanner/FreeSurfer outputs)
+# in a fresh process, and the peak RSS of that process is reported next to that of the get_fdata-based
+# implementation it replaced. Run from glm_code/: python benchmarks/bench_memory.py [--shape 96 96 60 --vols 150]
+
+import sys
+import os.path as op
+import argparse
+import importlib
+import resource
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import numpy as np
+import nibabel as nib
+
+
+def make_data(tmp_dir, shape, n_vols, n_runs):
+    """Write synthetic bolds, a prf map pair, a ribbon file, an identity T1w -> func matrix and two rois to tmp_dir"""
+    rng = np.random.default_rng(0)
+    affine = np.diag([2., 2., 2., 1.])
+    files = {'bolds': []}
+    for r in range(n_runs):
+        fn = op.join(tmp_dir, f"bold_run-{r}.nii.gz")
+        nib.save(nib.Nifti1Image(rng.integers(0, 2000, (*shape, n_vols), dtype=np.int16), affine), fn)
+        files['bolds'].append(fn)
+    for desc in ('prfrsq', 'prftheta'):
+        fn = op.join(tmp_dir, f"sub-bench_desc-{desc}_space-func_map.nii.gz")
+        nib.save(nib.Nifti1Image(rng.random(shape, dtype=np.float32), affine), fn)
+        files[desc] = fn
+    fn = op.join(tmp_dir, "ribbon.nii.gz")
+    nib.save(nib.Nifti1Image(rng.choice(np.array([0, 2, 3, 41, 42], dtype=np.uint8), shape), affine), fn)
+    files['ribbon'] = fn
+    fn = op.join(tmp_dir, "T1w2func.mat")
+    np.savetxt(fn, np.eye(4))
+    files['xfm'] = fn
+    files['rois'] = {}
+    for i, hemi in enumerate('LR'):
+        roi = np.zeros(shape, dtype=np.uint8)
+        roi[i*shape[0]//2:(i+1)*shape[0]//2, :shape[1]//4, :shape[2]//4] = 1
+        fn = op.join(tmp_dir, f"{hemi}LGN.nii.gz")
+        nib.save(nib.Nifti1Image(roi, affine), fn)
+        files['rois'][f"{hemi}LGN"] = fn
+    files['out_dir'] = tmp_dir
+    return files
+
+
+## get_fdata-based versions of the helpers, as they were before load_mask/load_data
+def old_threshold(files):
+    w = nib.load(files['prftheta'])
+    b = nib.load(files['prfrsq'])
+    mask = b.get_fdata() < 0.1
+    out_data = w.get_fdata()
+    out_data[mask] = 0
+    return np.count_nonzero(out_data)
+
+def old_make_func_parc_mask(files):
+    # flirt then ran in a process of its own, so only the mask is measured
+    ribbon_data = nib.load(files['ribbon']).get_fdata()
+    mask = np.zeros_like(ribbon_data)
+    for code in (3, 42):
+        mask[ribbon_data == code] = 1
+    return np.count_nonzero(mask)
+
+def old_roi_stats(files):
+    n = 0
+    for roi in files['rois'].values():
+        coords = np.array(np.where(nib.load(roi).get_fdata())).T
+        n += coords.mean(axis=0).size
+    return n
+
+def old_make_timeseries_for_prf(files, n_vols=138):
+    bold_data = []
+    for bold in files['bolds']:
+        bold_data.append(nib.load(bold).get_fdata()[..., :n_vols])
+    return np.mean(np.stack(bold_data), axis=0).shape
+
+
+## the current helpers
+def new_threshold(files):
+    import utils
+    utils.threshold(files['prftheta'], files['prfrsq'], 0.1, files['out_dir'])
+
+def new_make_func_parc_mask(files):
+    # resampling to the functional grid included, as it now runs in-process; the prf maps stand in for the functional reference
+    import utils
+    out_fn = op.join(files['out_dir'], "sub-bench_space-func_desc-cortex_mask.nii.gz")
+    return utils.make_func_parc_mask(files['ribbon'], [3, 42], files['prfrsq'], out_fn, files['xfm'], engine='native')
+
+def new_roi_stats(files):
+    import utils
+    ref = nib.load(files['prfrsq'])
+    utils.roi_stats(files['rois'], ref)
+
+def new_make_timeseries_for_prf(files):
+    import utils
+    return utils.make_timeseries_for_prf(files['bolds']).shape
+
+
+CASES = {'threshold': (old_threshold, new_threshold),
+         'make_func_parc_mask': (old_make_func_parc_mask, new_make_func_parc_mask),
+         'roi_stats': (old_roi_stats, new_roi_stats),
+         'make_timeseries_for_prf': (old_make_timeseries_for_prf, new_make_timeseries_for_prf)}
+
+
+def _peak_rss(func, files):
+    """Run func in this (fresh) process, return the peak RSS in MB"""
+    func(files)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on linux
+
+def _baseline_rss(import_utils):
+    if import_utils:
+        importlib.import_module('utils')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(func, files):
+    """Peak RSS (MB) of func(files), run in a new process so earlier cases don't count"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+        return pool.submit(_peak_rss, func, files).result()
+
+def baseline(import_utils):
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+        return pool.submit(_baseline_rss, import_utils).result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak memory of the utils.py image-loading helpers")
+    parser.add_argument('--shape', type=int, nargs=3, default=[96, 96, 60])
+    parser.add_argument('--vols', type=int, default=150)
+    parser.add_argument('--runs', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = make_data(tmp_dir, tuple(args.shape), args.vols, args.runs)
+        base_old, base_new = baseline(False), baseline(True)
+        print(f"Baseline RSS: {base_old:.0f} MB (numpy/nibabel), {base_new:.0f} MB (with utils imported)")
+        print(f"{'helper':<26}{'get_fdata (MB)':>16}{'current (MB)':>14}{'ratio':>8}")
+        for name, (old, new) in CASES.items():
+            old_mb = measure(old, files) - base_old
+            new_mb = measure(new, files) - base_new
+            print(f"{name:<26}{old_mb:>16.0f}{new_mb:>14.0f}{old_mb / max(new_mb, 1):>8.1f}")
@@ -0,0 +1,170 @@
+# Benchmarks of the hot paths in utils.py on synthetic BIDS data
+#
+# Each benchmark runs in a fresh process (headless, Agg backend, with empty BIDS index and timeseries caches
+# unless noted), and its wall time and peak RSS are written to a JSON results file named after the commit,
+# so that results can be compared between commits. Run from glm_code/:
+#   python benchmarks/bench_utils.py [--shape 64 64 32 --vols 140 --runs 4 --sessions 01 02] [--data-dir DIR] [--repeat 3]
+#   python benchmarks/bench_utils.py --compare results/old.json results/new.json
+
+import os, sys, json, time
+import os.path as op
+import argparse
+import datetime
+import platform
+import resource
+import subprocess
+import tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+GLM_CODE_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+sys.path.insert(0, GLM_CODE_DIR)
+sys.path.insert(0, op.dirname(op.abspath(__file__)))
+
+RESULTS_DIR = op.join(op.dirname(op.abspath(__file__)), 'results')
+SCHEMA_VERSION = 1
+
+
+## the benchmarks: each takes the dataset's files dict and a scratch directory
+def bench_get_files(files, scratch_dir):
+    import utils
+    return utils.get_files(files['sub'], files['ses'], files['task'], files['raw_data_dir'], files['fmriprep_dir'])
+
+def bench_tsv2subjectinfo(files, scratch_dir):
+    import utils
+    return [utils.tsv2subjectinfo(events, confounds, trim_indices=(6, -1))
+            for events, confounds in zip(files['events'], files['confounds'])]
+
+def bench_seed_coherence_analysis(files, scratch_dir):
+    import utils
+    return utils.seed_coherence_analysis(files['bolds'][0], files['mask'], files['rois']['LLGN'], files['TR'],
+                                         f_ub=0.06, f_lb=0.02)
+
+def bench_assign_roi_percentile(files, scratch_dir):
+    import shutil
+    import utils
+    from nilearn.image import load_img
+    roi = op.join(scratch_dir, op.basename(files['rois']['LLGN'])) # the split rois are written next to it
+    shutil.copy(files['rois']['LLGN'], roi)
+    return utils.assign_roi_percentile(roi, files['cope'], 80, load_img(files['cope']))
+
+def bench_make_timeseries_for_prf(files, scratch_dir):
+    import utils
+    return utils.make_timeseries_for_prf(files['bolds'])
+
+def bench_threshold(files, scratch_dir):
+    import utils
+    return utils.threshold(files['prftheta'], files['prfrsq'], 0.1, scratch_dir)
+
+# name -> (function, whether a first untimed call is made to warm caches)
+BENCHMARKS = {'get_files': (bench_get_files, False),
+              'get_files_indexed': (bench_get_files, True),
+              'tsv2subjectinfo': (bench_tsv2subjectinfo, False),
+              'seed_coherence_analysis': (bench_seed_coherence_analysis, False),
+              'assign_roi_percentile': (bench_assign_roi_percentile, False),
+              'make_timeseries_for_prf': (bench_make_timeseries_for_prf, False),
+              'threshold': (bench_threshold, False)}
+
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024 # bytes on macOS, KB on linux
+
+def _run_benchmark(name, files):
+    """Run one benchmark in this (fresh) process, with its own caches, and return its measurements"""
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        os.environ['STREAMS_BIDS_INDEX_DIR'] = op.join(scratch_dir, 'bids_index')
+        os.environ['STREAMS_TS_CACHE_DIR'] = op.join(scratch_dir, 'timeseries')
+        os.environ['MPLBACKEND'] = 'Agg'
+        import matplotlib
+        matplotlib.use('Agg')
+        import utils # not part of the timings
+        func, warm_up = BENCHMARKS[name]
+        if warm_up:
+            func(files, scratch_dir)
+        rss_before = _max_rss_mb()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        func(files, scratch_dir)
+        wall, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+        peak_rss = _max_rss_mb()
+    return {'wall_s': wall, 'cpu_s': cpu, 'peak_rss_mb': peak_rss, 'rss_increase_mb': peak_rss - rss_before}
+
+def run_benchmark(name, files, repeat=1):
+    """Run a benchmark repeat times, each in a new process; report the fastest run and the highest peak RSS"""
+    runs = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+            runs.append(pool.submit(_run_benchmark, name, files).result())
+    return {'wall_s': min(r['wall_s'] for r in runs), 'wall_s_all': [r['wall_s'] for r in runs],
+            'cpu_s': min(r['cpu_s'] for r in runs), 'peak_rss_mb': max(r['peak_rss_mb'] for r in runs),
+            'rss_increase_mb': max(r['rss_increase_mb'] for r in runs)}
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=GLM_CODE_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=GLM_CODE_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip() != ''
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = 'unknown', False
+    return commit, dirty
+
+def compare(old_file, new_file):
+    """Print the ratio new/old of the wall times and peak RSS of the benchmarks in two results files"""
+    import pandas as pd
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    if old['config'] != new['config']:
+        print(f"Warning: the datasets differ:\n{old['config']}\n{new['config']}")
+    rows = {}
+    for name in new['results']:
+        if name in old['results']:
+            o, n = old['results'][name], new['results'][name]
+            rows[name] = {'wall_s_old': o['wall_s'], 'wall_s_new': n['wall_s'], 'wall_ratio': n['wall_s'] / o['wall_s'],
+                          'peak_rss_mb_old': o['peak_rss_mb'], 'peak_rss_mb_new': n['peak_rss_mb'],
+                          'rss_ratio': n['peak_rss_mb'] / o['peak_rss_mb']}
+    print(f"{old['commit']} -> {new['commit']}")
+    print(pd.DataFrame(rows).T.round(3))
+
+
+if __name__ == '__main__':
+    import synthetic_bids
+
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths of utils.py on synthetic BIDS data")
+    parser.add_argument('--shape', type=int, nargs=3)
+    parser.add_argument('--vols', type=int)
+    parser.add_argument('--runs', type=int)
+    parser.add_argument('--sessions', nargs='+')
+    parser.add_argument('--data-dir', help="where to keep the synthetic dataset (reused when its config matches)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs of each benchmark (the fastest is reported)")
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument('--out', help="results file, by default results/<date>_<commit>.json")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two results files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    config = synthetic_bids.default_config(shape=args.shape, n_vols=args.vols, n_runs=args.runs, sessions=args.sessions)
+    data_dir = args.data_dir or op.join(tempfile.gettempdir(), 'streams_synthetic_bids')
+    print(f"Synthetic dataset in {data_dir}: {config}")
+    files = synthetic_bids.make_dataset(data_dir, config)
+
+    commit, dirty = git_revision()
+    results = {}
+    for name in args.only or BENCHMARKS:
+        results[name] = run_benchmark(name, files, args.repeat)
+        print(f"{name:<28}{results[name]['wall_s']:>10.3f} s{results[name]['peak_rss_mb']:>10.0f} MB peak")
+
+    out_file = args.out or op.join(RESULTS_DIR, f"{datetime.date.today().isoformat()}_{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(op.dirname(op.abspath(out_file)), exist_ok=True)
+    with open(out_file, 'w') as f:
+        json.dump({'schema_version': SCHEMA_VERSION, 'commit': commit, 'dirty': dirty,
+                   'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(),
+                   'platform': platform.platform(), 'cpu_count': os.cpu_count(), 'repeat': args.repeat,
+                   'config': config, 'results': results}, f, indent=2)
+    print(f"Results written to {out_file}")
@@ -0,0 +1,159 @@
+# Synthetic BIDS datasets for the benchmarks
+#
+# A raw dataset (bolds with RepetitionTime sidecars, hemifield events) and an fmriprep-style derivatives
+# dataset (preprocessed bolds, brain masks, wide confounds files) of configurable size, plus LGN-sized ROIs,
+# a cope map and pRF maps, laid out so that utils.get_files and the other helpers find them as they would
+# find the real data. The bolds carry a hemifield block response in the LGN ROIs and in part of "cortex",
+# so the GLM, percentile split and coherence helpers have something to find.
+
+import os, json
+import os.path as op
+
+import numpy as np
+import nibabel as nib
+
+CONFIG_FILE = 'synthetic_config.json'
+
+
+def default_config(**kwargs):
+    config = dict(shape=[64, 64, 32], n_vols=140, n_runs=4, sessions=['01'], subject='SYN', task='hemi',
+                  TR=2.25, block_vols=6, lgn_size=[6, 5, 4], seed=0)
+    config.update({k: v for k, v in kwargs.items() if v is not None})
+    return config
+
+
+def _save(data, affine, fn):
+    os.makedirs(op.dirname(fn), exist_ok=True)
+    nib.save(nib.Nifti1Image(data, affine), fn)
+    return fn
+
+
+def _write_json(obj, fn):
+    os.makedirs(op.dirname(fn), exist_ok=True)
+    with open(fn, 'w') as f:
+        json.dump(obj, f, indent=2)
+
+
+def hemifield_blocks(n_vols, block_vols):
+    """+1 for L blocks and -1 for R blocks, alternating every block_vols volumes, starting with L"""
+    return np.where((np.arange(n_vols) // block_vols) % 2 == 0, 1., -1.)
+
+
+def write_events(fn, n_vols, TR, block_vols):
+    lines = ["onset\tduration\ttrial_type"]
+    for b, start in enumerate(range(0, n_vols, block_vols)):
+        lines.append(f"{start * TR}\t{block_vols * TR}\t{'LR'[b % 2]}")
+    with open(fn, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_confounds(fn, n_vols, rng):
+    """fmriprep-like confounds file, as wide as the real ones (most columns are never used)"""
+    columns = {}
+    for name in ('trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z'):
+        columns[name] = np.cumsum(rng.normal(0, 0.01, n_vols))
+    for name in ('global_signal', 'white_matter', 'csf'):
+        columns[name] = 1000 + rng.normal(0, 5, n_vols)
+    fd = np.abs(rng.normal(0, 0.1, n_vols))
+    for i in range(50):
+        columns[f"a_comp_cor_{i:02d}"] = rng.normal(0, 0.1, n_vols)
+        columns[f"t_comp_cor_{i:02d}"] = rng.normal(0, 0.1, n_vols)
+    header = ['framewise_displacement', *columns]
+    rows = ['\t'.join(header)]
+    for t in range(n_vols):
+        fd_t = 'n/a' if t == 0 else f"{fd[t]:.6f}"
+        rows.append('\t'.join([fd_t, *[f"{columns[c][t]:.6f}" for c in columns]]))
+    with open(fn, 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+
+
+def make_dataset(root, config):
+    """
+    Write the synthetic datasets under root (skipped if root already has one with the same config).
+
+    Returns a dict of paths: raw_data_dir, fmriprep_dir, and for the first session the bolds, brain mask,
+    LGN rois (dict of label -> file), cope map and pRF rsq/theta maps, plus sub, ses, task and TR.
+    """
+    rng = np.random.default_rng(config['seed'])
+    shape = tuple(config['shape'])
+    sub, task, TR = config['subject'], config['task'], config['TR']
+    raw_data_dir = op.join(root, 'raw')
+    fmriprep_dir = op.join(root, 'derivatives', 'fmriprep')
+    ses0 = config['sessions'][0]
+    roi_dir = op.join(root, 'derivatives', 'rois')
+    map_dir = op.join(root, 'derivatives', 'maps')
+    files = dict(raw_data_dir=raw_data_dir, fmriprep_dir=fmriprep_dir, sub=sub, ses=ses0, task=task, TR=TR,
+                 roi_dir=roi_dir, map_dir=map_dir)
+
+    # LGN-sized ROIs on either side of the midline, a brain mask, and a "cortex" region responding to L
+    affine = np.diag([2.5, 2.5, 2.5, 1.])
+    affine[:3, 3] = -np.array(shape) * 2.5 / 2
+    brain = np.zeros(shape, dtype=np.uint8)
+    margin = [s // 8 for s in shape]
+    brain[margin[0]:-margin[0], margin[1]:-margin[1], margin[2]:-margin[2]] = 1
+    lgn_size = config['lgn_size']
+    center = [s // 2 for s in shape]
+    rois = {}
+    for hemi, x in (('L', center[0] - shape[0] // 6), ('R', center[0] + shape[0] // 6)):
+        roi = np.zeros(shape, dtype=np.uint8)
+        roi[x:x+lgn_size[0], center[1]:center[1]+lgn_size[1], center[2]:center[2]+lgn_size[2]] = 1
+        rois[f"{hemi}LGN"] = roi
+    cortex = np.zeros(shape, dtype=bool)
+    cortex[margin[0]:center[0], -2*margin[1]:-margin[1], margin[2]:-margin[2]] = True
+
+    files['rois'] = {label: op.join(roi_dir, f"sub-{sub}_desc-{label}_space-func_roi.nii.gz") for label in rois}
+    files['cope'] = op.join(map_dir, f"sub-{sub}_desc-MminusP_space-func_cope.nii.gz")
+    prefix = f"sub-{sub}_ses-{ses0}_task-prf"
+    files['prfrsq'] = op.join(map_dir, f"{prefix}_desc-prfrsq_space-func_map.nii.gz")
+    files['prftheta'] = op.join(map_dir, f"{prefix}_desc-prftheta_space-func_map.nii.gz")
+    files.update(_run_files(raw_data_dir, fmriprep_dir, sub, ses0, task, config['n_runs']))
+
+    config_file = op.join(root, CONFIG_FILE)
+    if op.exists(config_file):
+        with open(config_file) as f:
+            if json.load(f) == config:
+                return files
+
+    for label, roi in rois.items():
+        _save(roi, affine, files['rois'][label])
+    _save(rng.normal(0, 1, shape).astype(np.float32), affine, files['cope'])
+    _save(rng.random(shape, dtype=np.float32), affine, files['prfrsq'])
+    _save(rng.uniform(-np.pi, np.pi, shape).astype(np.float32), affine, files['prftheta'])
+
+    _write_json({'Name': 'synthetic', 'BIDSVersion': '1.4.0'}, op.join(raw_data_dir, 'dataset_description.json'))
+    _write_json({'Name': 'fMRIPrep', 'BIDSVersion': '1.4.0', 'DatasetType': 'derivative',
+                 'GeneratedBy': [{'Name': 'fMRIPrep'}], 'PipelineDescription': {'Name': 'fMRIPrep'}},
+                op.join(fmriprep_dir, 'dataset_description.json'))
+
+    n_vols = config['n_vols']
+    blocks = hemifield_blocks(n_vols, config['block_vols'])
+    lgn = (rois['LLGN'] + rois['RLGN']) > 0
+    for ses in config['sessions']:
+        raw_func = op.join(raw_data_dir, f"sub-{sub}", f"ses-{ses}", 'func')
+        prep_func = op.join(fmriprep_dir, f"sub-{sub}", f"ses-{ses}", 'func')
+        for run in range(1, config['n_runs'] + 1):
+            stem = f"sub-{sub}_ses-{ses}_task-{task}_run-{run:02d}"
+            data = 1000 + 20 * rng.standard_normal((*shape, n_vols), dtype=np.float32)
+            data[lgn] += 15 * blocks
+            data[cortex] += 10 * blocks
+            data *= brain[..., None]
+            bold = data.astype(np.int16)
+            _save(bold, affine, op.join(raw_func, f"{stem}_bold.nii.gz"))
+            _write_json({'RepetitionTime': TR, 'TaskName': task}, op.join(raw_func, f"{stem}_bold.json"))
+            write_events(op.join(raw_func, f"{stem}_events.tsv"), n_vols, TR, config['block_vols'])
+            _save(bold, affine, op.join(prep_func, f"{stem}_space-T1w_desc-preproc_bold.nii.gz"))
+            _save(brain, affine, op.join(prep_func, f"{stem}_space-T1w_desc-brain_mask.nii.gz"))
+            write_confounds(op.join(prep_func, f"{stem}_desc-confounds_regressors.tsv"), n_vols, rng)
+
+    _write_json(config, config_file)
+    return files
+
+
+def _run_files(raw_data_dir, fmriprep_dir, sub, ses, task, n_runs):
+    raw_func = op.join(raw_data_dir, f"sub-{sub}", f"ses-{ses}", 'func')
+    prep_func = op.join(fmriprep_dir, f"sub-{sub}", f"ses-{ses}", 'func')
+    stems = [f"sub-{sub}_ses-{ses}_task-{task}_run-{run:02d}" for run in range(1, n_runs + 1)]
+    return dict(bolds=[op.join(prep_func, f"{stem}_space-T1w_desc-preproc_bold.nii.gz") for stem in stems],
+                mask=op.join(prep_func, f"{stems[0]}_space-T1w_desc-brain_mask.nii.gz"),
+                events=[op.join(raw_func, f"{stem}_events.tsv") for stem in stems],
+                confounds=[op.join(prep_func, f"{stem}_desc-confounds_regressors.tsv") for stem in stems])
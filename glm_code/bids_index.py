@@ -0,0 +1,147 @@
+# Persistent, shared BIDSLayout indexes for utils.get_files and friends
+#
+# Building a BIDSLayout walks and parses every file (and json sidecar) in the dataset,
+# which takes minutes on the combined datasets. Here a dataset is indexed into pybids
+# SQLite databases on disk, one per scope: the sub-{subject} directory a query is about
+# (or ses-{session} in a single subject's dataset, such as the project's out_dir), along
+# with the files of the dataset outside its subject/session directories. Each database is
+# keyed by a signature of its scope: the modification times of its directories (which change
+# whenever files are added, removed or renamed) and of its .json/.tsv files (sidecars and
+# events edited in place change only their own). Later calls, from this or any other
+# process, load the database instead of re-indexing, and a change re-indexes only the
+# scopes it is in, e.g. the one session the pipeline just wrote to. The signature only
+# walks the scope, so it is checked on every call. Pipeline steps that write files get_files
+# looks up (utils.preprocess_runs) also call invalidate, so the next lookup never misses them.
+
+import os
+import os.path as op
+import re
+import hashlib
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+import profiling
+
+DEFAULT_INDEX_DIR = os.environ.get('STREAMS_BIDS_INDEX_DIR',
+                                   op.join(op.expanduser('~'), '.cache', 'streams', 'bids_index'))
+
+# files whose contents the index holds (metadata, events), so their own mtimes are part of the signature
+METADATA_EXTENSIONS = ('.json', '.tsv')
+# directories pybids does not index by default (besides dot directories)
+IGNORED_DIRS = ('code', 'stimuli', 'sourcedata', 'models')
+# top-level directories that are scopes of their own
+SCOPE_PREFIXES = ('sub-', 'ses-')
+
+# layouts loaded in this process: (root, derivatives, scope) -> (signature, database path, BIDSLayout)
+_layouts = {}
+
+
+def tree_signature(root, skip=()):
+    """Hash of the path and mtime of every directory under root, and of every .json and .tsv file,
+    leaving out the top-level directories of root named in skip"""
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == root:
+            dirnames[:] = [d for d in dirnames if d not in skip]
+        dirnames.sort()
+        h.update(f"{dirpath}:{os.stat(dirpath).st_mtime_ns}\n".encode())
+        for filename in sorted(filenames):
+            if filename.endswith(METADATA_EXTENSIONS):
+                h.update(f"{filename}:{os.stat(op.join(dirpath, filename)).st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def find_scope(root, subject=None, session=None):
+    """The top-level directory of root that a query for subject/session is about: sub-{subject},
+    or ses-{session} in a single subject's dataset, or None (the whole dataset) if there is neither"""
+    for name in (subject and f"sub-{subject}", session and f"ses-{session}"):
+        if name and op.isdir(op.join(root, name)):
+            return name
+    return None
+
+
+def excluded_dirs(root, derivatives=False, scope=None):
+    """Top-level directories of root outside a scope's index: the other subject/session directories,
+    those pybids ignores, and derivatives/ unless derivatives"""
+    excluded = [d for d in os.listdir(root) if op.isdir(op.join(root, d))
+                and (d.startswith('.') or d in IGNORED_DIRS or (d == 'derivatives' and not derivatives)
+                     or (scope is not None and d != scope and d.startswith(SCOPE_PREFIXES)))]
+    return sorted(excluded)
+
+
+@contextmanager
+def _locked(path):
+    """Hold an exclusive lock on path + '.lock' so only one process (re)builds an index at a time"""
+    import fcntl
+    with open(f"{path}.lock", 'w') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+@profiling.traced
+def get_layout(root, derivatives=False, index_dir=None, subject=None, session=None):
+    """
+    Return a BIDSLayout for root, loading it from the on-disk index when it is up to date
+    and (re)building the index otherwise.
+
+    root: BIDS dataset directory (raw data, or a derivatives dataset like fmriprep/)
+    derivatives: passed through to BIDSLayout
+    index_dir: where the databases are kept, one per (root, derivatives, scope)
+    subject, session: what the layout will be queried for. The layout then only holds that subject's
+                      (or, in a single subject's dataset, that session's) files, see find_scope.
+                      Without either, the whole dataset is indexed (and re-indexed on any change).
+    """
+    from bids import BIDSLayout
+
+    root = op.abspath(root)
+    scope = find_scope(root, subject, session)
+    key = (root, derivatives, scope)
+    excluded = excluded_dirs(root, derivatives, scope)
+    signature = tree_signature(root, skip=excluded)
+    if key in _layouts and _layouts[key][0] == signature:
+        return _layouts[key][2]
+
+    if index_dir is None:
+        index_dir = DEFAULT_INDEX_DIR
+    os.makedirs(index_dir, exist_ok=True)
+    database_path = op.join(index_dir, hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+    signature_file = f"{database_path}.signature"
+
+    with _locked(database_path):
+        stale = True
+        if op.exists(database_path) and op.exists(signature_file):
+            with open(signature_file) as f:
+                stale = f.read().strip() != signature
+        if stale:
+            logger.debug(f"Indexing {op.join(root, scope or '')} into {database_path}")
+        layout = BIDSLayout(root, validate=False, derivatives=derivatives, ignore=[*excluded, re.compile(r'^\.')],
+                            database_path=database_path, reset_database=stale)
+        if stale:
+            with open(signature_file, 'w') as f:
+                f.write(signature)
+
+    _layouts[key] = (signature, database_path, layout)
+    return layout
+
+
+def invalidate(path):
+    """Have the next get_layout re-index the scopes loaded in this process that path (a file or directory
+    just written) is in, even if the write left their signature unchanged (e.g. within the same mtime tick)"""
+    path = op.abspath(path)
+    for key in list(_layouts):
+        root, _, scope = key
+        if not (path == root or path.startswith(root + os.sep) or root.startswith(path + os.sep)):
+            continue
+        top = op.relpath(path, root).split(os.sep)[0] if path.startswith(root + os.sep) else None
+        if scope is not None and top is not None and top != scope and top.startswith(SCOPE_PREFIXES):
+            continue # in another subject/session
+        _, database_path, _ = _layouts.pop(key)
+        try:
+            os.remove(f"{database_path}.signature")
+        except FileNotFoundError:
+            pass
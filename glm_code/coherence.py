@@ -0,0 +1,121 @@
+# Batched seed coherence for the LGN-cortical coupling (aka streams) project
+#
+# nitime's SeedCoherenceAnalyzer computes the full cross-spectrum of the seed with every
+# target voxel at every frequency, although we only ever look at a narrow band.
+# Here the spectra of all target voxels are computed together, as one matrix product
+# against the Fourier basis restricted to the band of interest, in chunks of voxels
+# small enough to keep memory bounded. Conventions (Welch defaults, frequencies in Hz,
+# phase of the seed->target cross-spectrum) follow nitime so results are comparable.
+
+from collections import namedtuple
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+import profiling
+
+BandCoherence = namedtuple('BandCoherence', ['frequencies', 'coherence', 'relative_phases'])
+
+
+def band_frequencies(n_times, Fs, f_lb, f_ub, method=None):
+    """Frequencies (Hz) and Fourier bin indices strictly between f_lb and f_ub for the given method.
+
+    method: nitime-style dict, this_method is 'welch' (default, uses NFFT) or 'multi_taper_csd'."""
+    if method is None:
+        method = {}
+    if method.get('this_method', 'welch') == 'welch':
+        n_fft = method.get('NFFT', 64)
+    else:
+        n_fft = n_times
+    freqs = np.arange(n_fft // 2 + 1) * Fs / n_fft
+    bins = np.where((freqs > f_lb) * (freqs < f_ub))[0]
+    return freqs[bins], bins, n_fft
+
+
+def _tapered_segments(n_times, method):
+    """(segment start indices, segment length, window(s)) for the spectral method.
+    For multitaper the 'segments' are the whole run under each of the dpss tapers."""
+    if method.get('this_method', 'welch') == 'welch':
+        n_fft = method.get('NFFT', 64)
+        n_overlap = method.get('n_overlap', int(np.ceil(n_fft / 2)))
+        seg_len = min(n_fft, n_times)
+        starts = np.arange(0, n_times - seg_len + 1, n_fft - n_overlap)
+        window = np.hanning(seg_len)[None, :]
+    else:
+        from scipy.signal.windows import dpss
+        NW = method.get('NW', 4)
+        seg_len = n_times
+        starts = np.array([0])
+        # as nitime's multi_taper_csd: 2NW tapers, without those with eigenvalues below 0.9 (low_bias),
+        # each taper's cross-spectrum weighted by its eigenvalue (so each taper is scaled by its square root)
+        tapers, eigvals = dpss(n_times, NW, Kmax=int(2 * NW), return_ratios=True)
+        keep = eigvals > 0.9 if np.any(eigvals > 0.9) else np.ones(len(eigvals), dtype=bool)
+        window = tapers[keep] * np.sqrt(eigvals[keep])[:, None]
+    return starts, seg_len, window
+
+
+def band_spectra(data, basis, starts, seg_len, window, demean=False):
+    """Fourier coefficients in the band for each row of data (n x time), after removing its mean if demean.
+
+    Returns (n, segments x tapers, band frequencies), complex."""
+    if demean:
+        data = data - np.mean(data, axis=1, keepdims=True)
+    segs = data[:, starts[:, None] + np.arange(seg_len)[None, :]] # n x segments x seg_len
+    tapered = segs[:, :, None, :] * window[None, None, :, :] # n x segments x tapers x seg_len
+    tapered = tapered.reshape(data.shape[0], -1, seg_len)
+    return tapered @ basis
+
+
+@profiling.traced
+def band_coherence(seed, target, Fs, f_lb, f_ub, method=None, max_bytes=256 * 1024**2):
+    """
+    Coherence and relative phase between seed and target timeseries, only within f_lb < f < f_ub.
+
+    seed: (time,) or (seeds x time) array. target: (voxels x time) array.
+    Fs: sampling rate in Hz (1/TR).
+    max_bytes: approximate memory budget for the intermediate arrays of one chunk of voxels.
+
+    Returns a BandCoherence with frequencies and coherence/relative_phases shaped
+    (voxels x frequencies), or (seeds x voxels x frequencies) for a 2d seed, as nitime does.
+    """
+    if method is None:
+        method = {}
+    seed = np.asarray(seed, dtype=float)
+    target = np.asarray(target, dtype=float)
+    one_seed = seed.ndim == 1
+    seed = np.atleast_2d(seed)
+    n_times = seed.shape[-1]
+    assert target.shape[-1] == n_times, f"Seed has {n_times} timepoints but target has {target.shape[-1]}!"
+
+    freqs, bins, n_fft = band_frequencies(n_times, Fs, f_lb, f_ub, method)
+    starts, seg_len, window = _tapered_segments(n_times, method)
+    # Fourier basis for the band bins only (zero-padding segments shorter than n_fft)
+    basis = np.exp(-2j * np.pi * np.outer(np.arange(seg_len), bins) / n_fft)
+
+    demean = method.get('this_method', 'welch') != 'welch' # nitime's multi_taper_csd de-means, its welch does not
+    seed_spec = band_spectra(seed, basis, starts, seg_len, window, demean)
+    seed_power = np.mean(np.abs(seed_spec)**2, axis=1) # seeds x freqs
+    n_segs = seed_spec.shape[1]
+
+    # per voxel: tapered segments (float) + their spectra and cross-spectra (complex)
+    bytes_per_voxel = 8 * n_segs * seg_len + 16 * n_segs * len(bins) + 3 * 16 * seed.shape[0] * len(bins)
+    chunk_size = max(1, int(max_bytes // bytes_per_voxel))
+    logger.debug(f"Band coherence: {seed.shape[0]} seeds x {target.shape[0]} voxels, {len(bins)} freq bins "
+                 f"{freqs}, {n_segs} segments, chunks of {chunk_size} voxels")
+
+    coherence = np.empty((seed.shape[0], target.shape[0], len(bins)))
+    phases = np.empty_like(coherence)
+    for c in range(0, target.shape[0], chunk_size):
+        target_spec = band_spectra(target[c:c+chunk_size], basis, starts, seg_len, window, demean)
+        target_power = np.mean(np.abs(target_spec)**2, axis=1) # voxels x freqs
+        cross = np.einsum('msf,vsf->mvf', seed_spec, np.conj(target_spec)) / n_segs # as nitime's csd
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coh = np.abs(cross)**2 / (seed_power[:, None, :] * target_power[None, :, :])
+        coherence[:, c:c+chunk_size] = np.nan_to_num(coh)
+        phases[:, c:c+chunk_size] = np.angle(cross)
+
+    if one_seed:
+        coherence, phases = coherence[0], phases[0]
+    return BandCoherence(freqs, coherence, phases)
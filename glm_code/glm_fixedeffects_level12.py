@@ -12,95 +12,172 @@ import nipype.interfaces.utility as util     # utility
 import nipype.pipeline.engine as pe          # pypeline engine
 import nipype.algorithms.modelgen as model   # model generation
 
-from nipype.interfaces.nipy.preprocess import Trim # Trim leading and trailing volumes
-
 import utils # code by AM specific to this project but multiple workflows
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
-#Set up model fitting workflow (we assume data has been preprocessed with fmriprep)
-modelfit = pe.Workflow(name='modelfit')
-
-#Custom interface wrapping function Tsv2subjectinfo
-tsv2subjinfo = pe.MapNode(util.Function(function=utils.tsv2subjectinfo, input_names=['events_file', 'exclude', 'confounds_file', 'trim_indices'],
-                         output_names=['subject_info']), name="tsv2subjinfo", iterfield=['events_file', 'confounds_file'])
-modelspec = pe.MapNode(interface=model.SpecifyModel(), name="modelspec", iterfield=['subject_info'])
-level1design = pe.MapNode(interface=fsl.Level1Design(), name="level1design", iterfield=['session_info'])
-modelgen = pe.MapNode(interface=fsl.FEATModel(), name='modelgen', iterfield=["fsf_file", "ev_files"])
-
-trim = pe.MapNode(interface=Trim(), name="trim", iterfield=['in_file'])
-applymask = pe.MapNode(interface=fsl.ApplyMask(), name="applymask", iterfield=["in_file", "mask_file"])
-
-modelestimate = pe.MapNode(interface=fsl.FILMGLS(), name='modelestimate',
-                        iterfield=['design_file', 'in_file', 'tcon_file'])
-
-# combine copes, varcopes, and masks across multiple sessions
-copemerge = pe.MapNode(interface=fsl.Merge(dimension='t'), iterfield=['in_files'], name="copemerge")
-varcopemerge = pe.MapNode(interface=fsl.Merge(dimension='t'), iterfield=['in_files'], name="varcopemerge")
-maskemerge = pe.MapNode(interface=fsl.Merge(dimension='t'), iterfield=['in_files'], name="maskemerge")
-
-# set up and estimate fixed-effects cross-session analysis
-level2model = pe.Node(interface=fsl.L2Model(), name='l2model')
-flameo = pe.MapNode(interface=fsl.FLAMEO(run_mode='fe'), name="flameo", iterfield=['cope_file', 'var_cope_file'])
-
-modelfit.connect([
-    (tsv2subjinfo, modelspec, [('subject_info', 'subject_info')]),
-    (trim, modelspec, [('out_file', 'functional_runs')]),
-    (modelspec, level1design, [('session_info', 'session_info')]),
-    (level1design, modelgen, [('fsf_files', 'fsf_file'),
-                              ('ev_files', 'ev_files')]),
-    (modelgen, modelestimate, [('design_file', 'design_file'),
-                              ('con_file','tcon_file')]),
-    (trim, applymask, [('out_file', 'in_file')]),
-    (applymask, modelestimate, [('out_file', 'in_file')]),
-    (modelestimate, copemerge, [(('copes', utils.sort_copes), 'in_files')]),
-    (modelestimate, varcopemerge, [(('varcopes', utils.sort_copes), 'in_files')]),
-    (modelestimate, level2model, [(('copes', utils.num_copes), 'num_copes')]),
-    (copemerge, flameo, [('merged_file', 'cope_file')]),
-    (varcopemerge, flameo, [('merged_file', 'var_cope_file')]),
-    (level2model, flameo, [('design_mat', 'design_file'),
-                           ('design_con', 't_con_file'),
-                           ('design_grp', 'cov_split_file')]),
-    (maskemerge, flameo, [(('merged_file', utils.pickfirst),'mask_file')])
-])
-
-# Data input and configuration!
-BIDSDataGrabber = pe.Node(util.Function(function=utils.get_files, 
-      input_names=["subject_id", "session", "task", "raw_data_dir", "preprocessed_data_dir", "space", "run"],
-      output_names=["bolds", "masks", "events", "TR", "confounds"]), 
-      name="BIDSDataGrabber")
-
-# What event/trial types, if any, to exclude
-modelfit.inputs.tsv2subjinfo.exclude = None
-
-modelfit.inputs.modelspec.input_units = 'secs'
-modelfit.inputs.modelspec.high_pass_filter_cutoff = 128.
-
-modelfit.inputs.level1design.bases = {'dgamma': {'derivs': False}}
-modelfit.inputs.level1design.model_serial_correlations = True
-
-modelfit.inputs.modelestimate.smooth_autocorr = True
-modelfit.inputs.modelestimate.mask_size = 5
-modelfit.inputs.modelestimate.threshold = 0 # 0 is nipype default, setting until intensity normalization is decided
-
-hemi_wf = pe.Workflow(name="fixedeffects")
-
-# output
-datasink = pe.Node(nio.DataSink(), name='datasink')
-
-modelfit.connect([
-  (modelgen, datasink, [('design_image', 'design_image'), ('design_file', 'design_file')]),
-  (modelestimate, datasink, [('results_dir', 'results_dir')]),
-  (applymask, datasink, [('out_file', 'epi_masked_trimmed')]),
-  (flameo, datasink, [('stats_dir', 'stats_dir')])
-])
-
-hemi_wf.connect([
-                    (BIDSDataGrabber, modelfit, [('events', 'tsv2subjinfo.events_file'),
-                                              ('confounds', 'tsv2subjinfo.confounds_file'),
-                                              ('bolds', 'trim.in_file'),
-                                              ('masks', 'applymask.mask_file'),
-                                              ('masks', 'maskemerge.in_files'),
-                                              ('TR', 'modelspec.time_repetition'),
-                                              ('TR', 'level1design.interscan_interval')])
-                    ])
\ No newline at end of file
+# Format of the scratch images passed between nodes in the working directory (trimmed and masked bolds,
+# FILMGLS results, merged copes). 'NIFTI' saves compressing 4D files only for the next node to decompress them;
+# 'NIFTI_GZ' was the behavior before this was configurable. DataSink outputs are written as OUTPUT_TYPE.
+INTERMEDIATE_TYPE = os.environ.get('STREAMS_GLM_INTERMEDIATE_TYPE', 'NIFTI')
+OUTPUT_TYPE = 'NIFTI_GZ'
+
+# Model settings, also part of the hash that names each GLM's datasink directory (see utils.run_fixedeffects_glm)
+MODEL_SETTINGS = {'high_pass_filter_cutoff': 128.,
+                  'bases': {'dgamma': {'derivs': False}},
+                  'model_serial_correlations': True,
+                  'smooth_autocorr': True,
+                  'mask_size': 5,
+                  'threshold': 0, # 0 is nipype default, setting until intensity normalization is decided
+                  'confound_set': 'motion'} # see utils.tsv2subjectinfo
+
+def create_fixedeffects_workflow(name="fixedeffects", intermediate_type=None, output_type=None):
+    """Build a new, independent instance of the fixed effects workflow.
+
+    Each call returns a fresh workflow, so several subject/session/task combinations
+    can be configured and run side by side (see utils.make_fixedeffects_workflow).
+    The BIDSDataGrabber node, modelfit subworkflow and its nodes are retrieved with get_node().
+
+    intermediate_type, output_type: 'NIFTI' or 'NIFTI_GZ' for the working directory and DataSink
+    images, by default INTERMEDIATE_TYPE and OUTPUT_TYPE. When they differ, the images going
+    into the DataSink are converted on the way, keeping the same DataSink layout."""
+    if intermediate_type is None:
+        intermediate_type = INTERMEDIATE_TYPE
+    if output_type is None:
+        output_type = OUTPUT_TYPE
+    #Set up model fitting workflow (we assume data has been preprocessed with fmriprep)
+    modelfit = pe.Workflow(name='modelfit')
+
+    #Custom interface wrapping function Tsv2subjectinfo
+    tsv2subjinfo = pe.MapNode(util.Function(function=utils.tsv2subjectinfo, input_names=['events_file', 'exclude', 'confounds_file', 'trim_indices',
+                             'confound_set', 'trim_events', 'TR'],
+                             output_names=['subject_info']), name="tsv2subjinfo", iterfield=['events_file', 'confounds_file'])
+    modelspec = pe.MapNode(interface=model.SpecifyModel(), name="modelspec", iterfield=['subject_info'])
+    level1design = pe.MapNode(interface=fsl.Level1Design(), name="level1design", iterfield=['session_info'])
+    modelgen = pe.MapNode(interface=fsl.FEATModel(), name='modelgen', iterfield=["fsf_file", "ev_files"])
+
+    trim = pe.MapNode(util.Function(function=utils.trim_volumes, input_names=['in_file', 'begin_index', 'end_index', 'output_type'],
+                             output_names=['out_file']), name="trim", iterfield=['in_file'])
+    applymask = pe.MapNode(interface=fsl.ApplyMask(), name="applymask", iterfield=["in_file", "mask_file"])
+
+    modelestimate = pe.MapNode(interface=fsl.FILMGLS(), name='modelestimate',
+                            iterfield=['design_file', 'in_file', 'tcon_file'])
+
+    # combine copes, varcopes, and masks across multiple sessions
+    copemerge = pe.MapNode(interface=fsl.Merge(dimension='t'), iterfield=['in_files'], name="copemerge")
+    varcopemerge = pe.MapNode(interface=fsl.Merge(dimension='t'), iterfield=['in_files'], name="varcopemerge")
+    maskemerge = pe.MapNode(interface=fsl.Merge(dimension='t'), iterfield=['in_files'], name="maskemerge")
+
+    # set up and estimate fixed-effects cross-session analysis
+    level2model = pe.Node(interface=fsl.L2Model(), name='l2model')
+    flameo = pe.MapNode(interface=fsl.FLAMEO(run_mode='fe'), name="flameo", iterfield=['cope_file', 'var_cope_file'])
+
+    modelfit.connect([
+        (tsv2subjinfo, modelspec, [('subject_info', 'subject_info')]),
+        (trim, modelspec, [('out_file', 'functional_runs')]),
+        (modelspec, level1design, [('session_info', 'session_info')]),
+        (level1design, modelgen, [('fsf_files', 'fsf_file'),
+                                  ('ev_files', 'ev_files')]),
+        (modelgen, modelestimate, [('design_file', 'design_file'),
+                                  ('con_file','tcon_file')]),
+        (trim, applymask, [('out_file', 'in_file')]),
+        (applymask, modelestimate, [('out_file', 'in_file')]),
+        (modelestimate, copemerge, [(('copes', utils.sort_copes), 'in_files')]),
+        (modelestimate, varcopemerge, [(('varcopes', utils.sort_copes), 'in_files')]),
+        (modelestimate, level2model, [(('copes', utils.num_copes), 'num_copes')]),
+        (copemerge, flameo, [('merged_file', 'cope_file')]),
+        (varcopemerge, flameo, [('merged_file', 'var_cope_file')]),
+        (level2model, flameo, [('design_mat', 'design_file'),
+                               ('design_con', 't_con_file'),
+                               ('design_grp', 'cov_split_file')]),
+        (maskemerge, flameo, [(('merged_file', utils.pickfirst),'mask_file')])
+    ])
+
+    # Data input and configuration!
+    BIDSDataGrabber = pe.Node(util.Function(function=utils.get_files, 
+          input_names=["subject_id", "session", "task", "raw_data_dir", "preprocessed_data_dir", "space", "run"],
+          output_names=["bolds", "masks", "events", "TR", "confounds"]), 
+          name="BIDSDataGrabber")
+
+    # What event/trial types, if any, to exclude
+    modelfit.inputs.tsv2subjinfo.exclude = None
+    modelfit.inputs.tsv2subjinfo.confound_set = MODEL_SETTINGS['confound_set']
+    modelfit.inputs.tsv2subjinfo.trim_events = False # the event files are made for the trimmed runs
+
+    modelfit.inputs.modelspec.input_units = 'secs'
+    modelfit.inputs.modelspec.high_pass_filter_cutoff = MODEL_SETTINGS['high_pass_filter_cutoff']
+
+    modelfit.inputs.level1design.bases = MODEL_SETTINGS['bases']
+    modelfit.inputs.level1design.model_serial_correlations = MODEL_SETTINGS['model_serial_correlations']
+
+    modelfit.inputs.modelestimate.smooth_autocorr = MODEL_SETTINGS['smooth_autocorr']
+    modelfit.inputs.modelestimate.mask_size = MODEL_SETTINGS['mask_size']
+    modelfit.inputs.modelestimate.threshold = MODEL_SETTINGS['threshold']
+
+    modelfit.inputs.trim.output_type = intermediate_type
+    modelfit.inputs.applymask.output_type = intermediate_type
+    modelfit.inputs.modelestimate.output_type = intermediate_type
+    modelfit.inputs.copemerge.output_type = intermediate_type
+    modelfit.inputs.varcopemerge.output_type = intermediate_type
+    modelfit.inputs.maskemerge.output_type = intermediate_type
+    modelfit.inputs.flameo.output_type = output_type # only goes to the DataSink
+
+    hemi_wf = pe.Workflow(name=name)
+
+    # output
+    datasink = pe.Node(nio.DataSink(), name='datasink')
+
+    modelfit.connect([
+      (modelgen, datasink, [('design_image', 'design_image'), ('design_file', 'design_file')]),
+      (flameo, datasink, [('stats_dir', 'stats_dir')])
+    ])
+    if intermediate_type == output_type:
+        modelfit.connect([
+          (modelestimate, datasink, [('results_dir', 'results_dir')]),
+          (applymask, datasink, [('out_file', 'epi_masked_trimmed')])
+        ])
+    else:
+        convert_results = pe.MapNode(util.Function(function=utils.convert_nifti_outputs, input_names=['in_path', 'output_type'],
+                                     output_names=['out_path']), name="convert_results", iterfield=['in_path'])
+        convert_results.inputs.output_type = output_type
+        convert_masked = convert_results.clone("convert_masked")
+        modelfit.connect([
+          (modelestimate, convert_results, [('results_dir', 'in_path')]),
+          (applymask, convert_masked, [('out_file', 'in_path')]),
+          (convert_results, datasink, [('out_path', 'results_dir')]),
+          (convert_masked, datasink, [('out_path', 'epi_masked_trimmed')])
+        ])
+        # keep the layout get_model_outputs expects, e.g. results_dir/_modelestimate0/results
+        datasink.inputs.regexp_substitutions = [(r'_convert_results(\d+)', r'_modelestimate\1'),
+                                                (r'_convert_masked(\d+)', r'_applymask\1')]
+
+    hemi_wf.connect([
+                        (BIDSDataGrabber, modelfit, [('events', 'tsv2subjinfo.events_file'),
+                                                  ('confounds', 'tsv2subjinfo.confounds_file'),
+                                                  ('bolds', 'trim.in_file'),
+                                                  ('masks', 'applymask.mask_file'),
+                                                  ('masks', 'maskemerge.in_files'),
+                                                  ('TR', 'modelspec.time_repetition'),
+                                                  ('TR', 'tsv2subjinfo.TR'),
+                                                  ('TR', 'level1design.interscan_interval')])
+                        ])
+
+    return hemi_wf
+
+# module-level instance, kept for code that configures the workflow through these globals
+hemi_wf = create_fixedeffects_workflow()
+modelfit = hemi_wf.get_node('modelfit')
+BIDSDataGrabber = hemi_wf.get_node('BIDSDataGrabber')
+
+if __name__ == '__main__':
+    utils.setup_logging()
+    # When this script is invoked from the command line, fit every row of a manifest
+    # (TSV with sub, ses, task, runs, trim_idxs, raw_data_dir, out_dir columns)
+    manifest = os.path.abspath(sys.argv[1])
+    if len(sys.argv) > 2:
+      summary_file = os.path.abspath(sys.argv[2])
+    else:
+      summary_file = f"{os.path.splitext(manifest)[0]}_summary.tsv"
+
+    summary = utils.run_fixedeffects_batch(manifest, summary_file=summary_file)
+    print(summary)
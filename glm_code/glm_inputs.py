@@ -0,0 +1,102 @@
+# Event and confound files for the GLMs of the LGN-cortical coupling (aka streams) project
+#
+# utils.tsv2subjectinfo runs once per run (in a nipype MapNode, or per run in native_glm), and the
+# same events/confounds files are read again for every GLM that uses them. Here each file is parsed
+# once per process (keyed by path and mtime), confounds only for the columns asked for, and the
+# events are grouped by trial type in one pass. Named sets of fmriprep confounds can be combined
+# instead of editing a hardcoded list of regressors.
+
+import os
+import os.path as op
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+MOTION = ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+
+# fmriprep confounds columns for each named set; confound_set may combine these with column names
+CONFOUND_SETS = {'motion': MOTION,
+                 'fd': ['framewise_displacement'],
+                 'acompcor': [f"a_comp_cor_{i:02d}" for i in range(6)],
+                 'global_signal': ['global_signal'],
+                 'white_matter': ['white_matter'],
+                 'csf': ['csf']}
+
+
+def regressor_names(confound_set='motion'):
+    """Confound column names for a set name, a column name, or a list of them, e.g. ['motion', 'fd', 'acompcor']"""
+    if confound_set is None:
+        return []
+    if isinstance(confound_set, str):
+        confound_set = [confound_set]
+    names = []
+    for s in confound_set:
+        for name in CONFOUND_SETS.get(s, [s]):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def trim_slice(trim_indices):
+    """slice() for (begin, end) trim indices in volumes, where end 0 means nothing is trimmed from the end"""
+    if trim_indices is None:
+        return slice(None)
+    assert(len(trim_indices)==2)
+    return slice(trim_indices[0], None if trim_indices[-1] == 0 else trim_indices[-1])
+
+
+@lru_cache(maxsize=256)
+def _read_events(events_file, mtime_ns):
+    events = pd.read_csv(events_file, sep="\t")
+    if 'weight' not in events.columns:
+        events['weight'] = 1.
+    return events
+
+
+@lru_cache(maxsize=256)
+def _read_confounds(confounds_file, mtime_ns, columns):
+    confounds = pd.read_csv(confounds_file, sep="\t", na_values="n/a", usecols=list(columns)) # fmriprep confounds file
+    values = confounds[list(columns)].fillna(0).to_numpy()
+    values.flags.writeable = False # shared between calls
+    return values
+
+
+def read_events(events_file, exclude=None, trim_indices=None, TR=None):
+    """
+    Conditions and their onsets, durations and amplitudes (weight column, or 1) from a BIDS events file.
+
+    exclude: trial_types to leave out
+    trim_indices, TR: if both are given, onsets are shifted to the start of the trimmed run,
+        and events that end before it are dropped (or cut short if they straddle it)
+    Returns (conditions, onsets, durations, amplitudes), the last three lists of lists, one per condition.
+    """
+    events = _read_events(op.abspath(events_file), os.stat(events_file).st_mtime_ns)
+    if exclude is not None:
+        events = events[~events['trial_type'].isin(np.atleast_1d(exclude))]
+    if trim_indices is not None and TR is not None:
+        shift = trim_indices[0] * TR
+        events = events.assign(onset=events['onset'] - shift)
+        events = events[events['onset'] + events['duration'] > 0]
+        events = events.assign(duration=events['duration'] + np.minimum(events['onset'], 0),
+                               onset=np.maximum(events['onset'], 0))
+    conditions, onsets, durations, amplitudes = [], [], [], []
+    for trial_type, group in events.groupby('trial_type', sort=True):
+        conditions.append(trial_type)
+        onsets.append(group['onset'].tolist())
+        durations.append(group['duration'].tolist())
+        amplitudes.append(group['weight'].tolist())
+    return conditions, onsets, durations, amplitudes
+
+
+def read_confounds(confounds_file, confound_set='motion', trim_indices=None):
+    """
+    (regressor names, regressors) from an fmriprep confounds file, n/a as 0, trimmed like the bold.
+
+    Only the columns in confound_set (see regressor_names) are read. regressors is a list of lists, one per column.
+    """
+    names = regressor_names(confound_set)
+    if confounds_file is None or confounds_file == '' or len(names) == 0:
+        return [], []
+    values = _read_confounds(op.abspath(confounds_file), os.stat(confounds_file).st_mtime_ns, tuple(names))
+    return names, values[trim_slice(trim_indices)].T.tolist()
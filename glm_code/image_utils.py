@@ -0,0 +1,89 @@
+# Image loading, cropping and thresholding for the LGN-cortical coupling (aka streams) project
+#
+# Split out of utils.py, which imports them lazily: these need numpy and nibabel, and the GLM and
+# BIDS helpers there do not.
+
+import os
+
+import numpy as np
+import nibabel as nib
+
+import profiling
+
+## Functions for loading images without get_fdata's float64 copies
+def load_mask(img, slicer=None):
+    """Boolean array of the nonzero voxels of a mask (filename or image).
+
+    Unlike get_fdata, the mask's own (usually uint8) data are read and nothing is cached
+    on the image. slicer: tuple of slices to read only that sub-volume through the array proxy"""
+    img = nib.load(img) if isinstance(img, str) else img
+    mask = np.asanyarray(img.dataobj if slicer is None else img.dataobj[slicer]) != 0
+    img.uncache()
+    return mask
+
+def load_data(img, dtype=np.float32, slicer=None):
+    """Image data (filename or image) as dtype, float32 by default.
+
+    get_fdata would make (and cache on the image) a float64 copy, 4x the size of int16 bold data.
+    slicer: tuple of slices to read only that sub-volume through the array proxy"""
+    img = nib.load(img) if isinstance(img, str) else img
+    data = np.asarray(img.dataobj if slicer is None else img.dataobj[slicer], dtype=dtype)
+    img.uncache()
+    return data
+
+## Functions for processing only the bounding box of a (small, e.g. LGN) ROI
+def bounding_box(mask, margin=2):
+    """Tuple of slices around the nonzero voxels of a 3d array, with margin voxels on each side
+    (clipped to the volume). Usable as the slicer of load_mask, load_data and crop_img"""
+    slicer = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other_axes))
+        assert len(nonzero) > 0, "Mask is empty!"
+        slicer.append(slice(max(nonzero[0] - margin, 0), min(nonzero[-1] + margin + 1, mask.shape[axis])))
+    return tuple(slicer)
+
+def roi_bbox(roi, margin=2):
+    """Bounding box (tuple of slices) of an roi mask (filename or image), see bounding_box"""
+    return bounding_box(load_mask(roi), margin)
+
+def crop_img(img, slicer):
+    """The sub-block slicer (3 slices, 4d images keep all volumes) of an image (filename or image),
+    read through the array proxy, with the affine shifted so voxels keep their RAS coordinates"""
+    img = nib.load(img) if isinstance(img, str) else img
+    return img.slicer[slicer]
+
+def uncrop(data, slicer, shape):
+    """Paste data cropped with slicer back into a zero array the size of the full volume (shape[:3])"""
+    full = np.zeros((*shape[:3], *data.shape[3:]), dtype=data.dtype)
+    full[slicer] = data
+    return full
+
+## Functions manipulating NIFTI images
+@profiling.traced
+def threshold(what, by, at, out_dir, how='more', roi=None, margin=2):
+    """Threshold a given prf output (what) by another (by, usually rsq) at a specific value
+
+    roi: if given (e.g. an LGN mask), only the roi's bounding box (plus margin voxels) of both maps
+    is read and thresholded, and everything outside it is 0 in the (full-size) output"""
+    w = nib.load(what)
+    b = nib.load(by)
+    assert(w.shape == b.shape)
+    bbox = None if roi is None else roi_bbox(roi, margin)
+    if how=='more':
+        mask = load_data(b, slicer=bbox) < at
+    elif how=='less':
+        mask = load_data(b, slicer=bbox) > at
+    out_data = np.where(mask, 0, load_data(w, slicer=bbox))
+    if bbox is not None:
+        out_data = uncrop(out_data, bbox, w.shape)
+    print(f"Thresholding {what} by {by} at thresh {at:.2f}...\n", 
+        mask.shape, out_data.shape, np.count_nonzero(mask), np.count_nonzero(out_data))
+    out_img = nib.Nifti1Image(out_data, w.affine)
+    parts_by = os.path.basename(by).split('_')
+    desc_by = [p for p in parts_by if 'desc' in p][0].split('-')[1] # gets whatever is after desc-
+    parts = os.path.basename(what).split('_')
+    parts.insert(-1, f"thresh-{desc_by}-{at:.2f}")
+    out_file = '_'.join(parts)
+    print(desc_by, parts, out_file, sep='\n')
+    nib.save(out_img, f"{out_dir}/{out_file}")
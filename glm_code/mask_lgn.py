@@ -4,7 +4,7 @@
 from builtins import str
 from builtins import range
 
-import os, datetime, sys
+import os, sys
 
 import nipype.interfaces.io as nio           # Data i/o
 import nipype.interfaces.fsl as fsl          # fsl
@@ -15,6 +15,7 @@ import nipype.algorithms.modelgen as model   # model generation
 from nipype.interfaces.nipy.preprocess import Trim # Trim leading and trailing volumes
 
 import utils # code by AM specific to this project but multiple workflows
+import workdirs
 
 fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
 
@@ -45,6 +46,7 @@ hemi_wf.connect([
                     ])
 
 if __name__ == '__main__':
+    utils.setup_logging()
     # When this script is invoked from the command line, read in arguments and use them
     # raw data, with event files, appropriate metadata in header, etc
     raw_data_dir = os.path.abspath(sys.argv[1])
@@ -62,14 +64,17 @@ if __name__ == '__main__':
     else:
       run = []
 
-    # where intermediate outputs etc are stored
-    # by creating a unique one each time, we prevent re-use,
-    # which is desirable while testing different processing options and keeping them all
-    # but maybe should be changed to a flag or option later (TODO)
-    now = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    working_dir = os.path.abspath(os.path.join(out_dir, f"nipype_{sub}_{ses}_{task}"))
+    # manually drawn LGN ROI mask
+    mask_file = "/Users/smerdis/data/LGN/BIDS/NB_combined/derivatives/sub-NB_R-LGN_mask_manual.nii.gz"
+
+    # where intermediate outputs etc are stored: named after a hash of the parameters and input files,
+    # so a rerun with the same ones reuses the cached results and different options each keep their own
+    bolds = utils.get_files(sub, ses, task, raw_data_dir, fmriprep_dir, space=space, run=run)[0]
+    params = dict(sub=sub, ses=ses, task=task, space=space, run=run)
+    working_dir = workdirs.hashed_working_dir(out_dir, f"nipype_{sub}_{ses}_{task}", params, files=[bolds, mask_file])
     hemi_wf.base_dir = working_dir
-    hemi_wf.config = {"execution": {"crashdump_dir": os.path.join(working_dir, 'crashdumps')}}
+    hemi_wf.config = {"execution": {"crashdump_dir": os.path.join(working_dir, 'crashdumps'),
+                                    "hash_method": "content"}}
 
     BIDSDataGrabber.inputs.raw_data_dir = raw_data_dir
     BIDSDataGrabber.inputs.preprocessed_data_dir = fmriprep_dir
@@ -79,9 +84,10 @@ if __name__ == '__main__':
     BIDSDataGrabber.inputs.session = ses
     BIDSDataGrabber.inputs.task = task
 
-    # manually drawn LGN ROI mask
-    applymask.inputs.mask_file = "/Users/smerdis/data/LGN/BIDS/NB_combined/derivatives/sub-NB_R-LGN_mask_manual.nii.gz"
+    applymask.inputs.mask_file = mask_file
 
     hemi_wf.write_graph()
-    outgraph = hemi_wf.run(plugin='MultiProc', plugin_args={'n_procs':3})
+    with workdirs.job(working_dir):
+        hemi_wf.run(plugin='MultiProc', plugin_args={'n_procs':3})
+    workdirs.gc_working_dirs(out_dir, keep=[working_dir])
     #outgraph = hemi_wf.run(plugin='Linear') # Easier to debug for the moment
\ No newline at end of file
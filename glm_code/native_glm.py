@@ -0,0 +1,235 @@
+# In-process (numpy) implementation of the fixed-effects GLM in glm_fixedeffects_level12.py
+#
+# The nipype workflow shells out to FEATModel, FILMGLS, fslmerge and FLAMEO once per run
+# and per contrast, writing gzipped volumes between every step. Here the same model
+# (events + confounds from tsv2subjectinfo, dgamma HRF, high-pass filter, AR(1) prewhitening,
+# inverse-variance fixed effects across runs) is fit for all masked voxels at once,
+# and the results are written where get_model_outputs() expects to find them.
+
+import os
+import os.path as op
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+import profiling
+
+
+def subjectinfo_to_events(subject_info):
+    """Turn the Bunch returned by utils.tsv2subjectinfo into a nilearn-style events DataFrame"""
+    rows = []
+    for cond, onsets, durations, amplitudes in zip(subject_info.conditions, subject_info.onsets,
+                                                    subject_info.durations, subject_info.amplitudes):
+        for onset, duration, amplitude in zip(onsets, durations, amplitudes):
+            rows.append((onset, duration, cond, amplitude))
+    return pd.DataFrame(rows, columns=['onset', 'duration', 'trial_type', 'modulation'])
+
+
+def make_design_matrix(subject_info, n_vols, TR, high_pass_filter_cutoff=128., bases=None):
+    """
+    Build the (n_vols x regressors) design matrix for one run from a tsv2subjectinfo Bunch.
+
+    bases: same dict as level1design.bases in glm_fixedeffects_level12, only dgamma is supported.
+    high_pass_filter_cutoff: in seconds, implemented as a discrete cosine drift basis.
+    """
+    from nilearn.glm.first_level import make_first_level_design_matrix
+
+    if bases is None:
+        bases = {'dgamma': {'derivs': False}}
+    if 'dgamma' not in bases:
+        raise ValueError(f"Only dgamma bases are supported by the native GLM, got {bases}")
+    hrf_model = 'spm + derivative' if bases['dgamma'].get('derivs', False) else 'spm'
+
+    frame_times = np.arange(n_vols) * TR
+    events = subjectinfo_to_events(subject_info)
+    if subject_info.regressor_names:
+        add_regs = np.array(subject_info.regressors, dtype=float).T
+        assert add_regs.shape[0] == n_vols, f"Confounds have {add_regs.shape[0]} rows but run has {n_vols} volumes!"
+        add_reg_names = list(subject_info.regressor_names)
+    else:
+        add_regs = None
+        add_reg_names = None
+
+    return make_first_level_design_matrix(frame_times, events, hrf_model=hrf_model,
+        drift_model='cosine', high_pass=1./high_pass_filter_cutoff,
+        add_regs=add_regs, add_reg_names=add_reg_names)
+
+
+def contrast_vectors(contrasts, design_columns):
+    """Convert contrasts in the get_contrasts() format ([name, 'T', [conds], [weights]])
+    into an (n_contrasts x n_columns) array of weights on the design matrix columns"""
+    C = np.zeros((len(contrasts), len(design_columns)))
+    for i, (name, stat, conds, weights) in enumerate(contrasts):
+        if stat != 'T':
+            raise ValueError(f"Only T contrasts are supported by the native GLM, {name} is {stat}")
+        for cond, weight in zip(conds, weights):
+            C[i, design_columns.index(cond)] = weight
+    return C
+
+
+def _ar1_whiten(A, rho):
+    """Apply the AR(1) whitening transform with coefficient rho along the first (time) axis"""
+    W = np.empty_like(A)
+    W[0] = np.sqrt(1 - rho**2) * A[0]
+    W[1:] = A[1:] - rho * A[:-1]
+    return W
+
+
+def _solve(X, Y, C):
+    """OLS for all columns of Y at once. Returns betas, residuals, copes and varcope scale factors."""
+    pinv_X = np.linalg.pinv(X)
+    B = pinv_X @ Y
+    resid = Y - X @ B
+    copes = C @ B
+    # c (X'X)^-1 c' for each contrast
+    var_scale = np.einsum('ij,jk,ik->i', C, pinv_X @ pinv_X.T, C)
+    return B, resid, copes, var_scale
+
+
+@profiling.traced
+def fit_glm(Y, X, C, autocorr=True, rho_step=0.01):
+    """
+    Fit the GLM Y = XB + e for all voxels (columns of Y, time x voxels) in one batched solve.
+
+    If autocorr is True, residuals from the OLS fit are used to estimate an AR(1) coefficient
+    per voxel. Coefficients are rounded to rho_step so that voxels sharing a value
+    can be prewhitened and refit together in one solve per bin.
+
+    Returns copes, varcopes, tstats (each n_contrasts x voxels) and the residual degrees of freedom.
+    """
+    n_vols = X.shape[0]
+    dof = n_vols - np.linalg.matrix_rank(X)
+    _, resid, copes, var_scale = _solve(X, Y, C)
+
+    if autocorr:
+        ss = np.sum(resid**2, axis=0)
+        ss[ss == 0] = 1
+        rho = np.sum(resid[1:] * resid[:-1], axis=0) / ss
+        rho = np.round(np.clip(rho, -0.95, 0.95) / rho_step) * rho_step
+        rho_bins, bin_idx = np.unique(rho, return_inverse=True)
+        logger.debug(f"Prewhitening {Y.shape[1]} voxels in {len(rho_bins)} AR(1) bins")
+        varcopes = np.empty_like(copes)
+        for b, r in enumerate(rho_bins):
+            voxels = bin_idx == b
+            _, resid_w, copes_w, var_scale_w = _solve(_ar1_whiten(X, r), _ar1_whiten(Y[:, voxels], r), C)
+            copes[:, voxels] = copes_w
+            sigma2 = np.sum(resid_w**2, axis=0) / dof
+            varcopes[:, voxels] = var_scale_w[:, None] * sigma2[None, :]
+    else:
+        sigma2 = np.sum(resid**2, axis=0) / dof
+        varcopes = var_scale[:, None] * sigma2[None, :]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstats = np.where(varcopes > 0, copes / np.sqrt(varcopes), 0)
+    return copes, varcopes, tstats, dof
+
+
+@profiling.traced
+def fixed_effects(copes, varcopes, dofs):
+    """
+    Inverse-variance weighted combination across runs, as FLAMEO does with run_mode='fe'
+    and a single group-mean L2 model.
+
+    copes, varcopes: (runs x voxels) for one contrast. dofs: residual dof of each run.
+    Returns cope, varcope, tstat, zstat (each of length voxels).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(varcopes > 0, 1. / varcopes, 0)
+        sum_weights = np.sum(weights, axis=0)
+        cope = np.where(sum_weights > 0, np.sum(weights * copes, axis=0) / sum_weights, 0)
+        varcope = np.where(sum_weights > 0, 1. / sum_weights, 0)
+        tstat = np.where(varcope > 0, cope / np.sqrt(varcope), 0)
+    dof = np.sum(dofs)
+    return cope, varcope, tstat, t_to_z(tstat, dof)
+
+
+def t_to_z(tstat, dof):
+    """z with the same tail probability as t, computed on |t| so that strong negative effects
+    keep their magnitude; where the p-value underflows, z comes from log(p) (asymptotic expansion)"""
+    from scipy import stats
+
+    abs_t = np.abs(tstat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = stats.norm.isf(stats.t.sf(abs_t, dof))
+        tiny = ~np.isfinite(z)
+        if np.any(tiny):
+            x = -2 * stats.t.logsf(abs_t[tiny], dof)
+            z[tiny] = np.sqrt(x - np.log(x) - np.log(2 * np.pi))
+    return np.sign(tstat) * z
+
+
+def _save_masked(values, mask, affine, out_file):
+    """Write a vector of per-voxel values back into a volume shaped like mask"""
+    vol = np.zeros(mask.shape, dtype=np.float32)
+    vol[mask] = values
+    nib.save(nib.Nifti1Image(vol, affine), out_file)
+
+
+def _remask(values, from_mask, to_mask):
+    """Move per-voxel values (... x voxels) defined in from_mask to to_mask, with 0 where undefined"""
+    vol = np.zeros((*values.shape[:-1], *from_mask.shape), dtype=values.dtype)
+    vol[..., from_mask] = values
+    return vol[..., to_mask]
+
+
+@profiling.traced
+def run_native_fixedeffects(bolds, masks, events, TR, confounds, contrasts, datasink_dir, trim_indices=None,
+                            exclude=None, high_pass_filter_cutoff=128., bases=None, autocorr=True, confound_set='motion'):
+    """
+    Fit the level 1 (per-run) and level 2 (fixed effects) models for a set of runs, writing
+    results_dir/_modelestimate{i}/results/{cope,varcope,tstat}{n}.nii.gz and
+    stats_dir/_flameo{n-1}/stats/{cope,varcope,tstat,zstat}1.nii.gz under datasink_dir,
+    i.e. the same layout the nipype DataSink produces and get_model_outputs() reads.
+
+    Arguments other than datasink_dir are as returned by utils.get_files / passed to run_fixedeffects_glm.
+    """
+    import utils
+
+    if trim_indices is None:
+        trim_slice = slice(None)
+    else:
+        trim_slice = slice(trim_indices[0], None if trim_indices[1] == 0 else trim_indices[1])
+
+    assert len(bolds) == len(masks) == len(events) == len(confounds), \
+        f"{len(bolds)} bolds, {len(masks)} masks, {len(events)} events and {len(confounds)} confounds files"
+    l1_copes, l1_varcopes, dofs, run_masks = [], [], [], []
+    for i, (bold, mask_file, events_file, confounds_file) in enumerate(zip(bolds, masks, events, confounds)):
+        mask_img = nib.load(mask_file)
+        mask = np.asanyarray(mask_img.dataobj) > 0
+        bold_img = nib.load(bold)
+        Y = np.asanyarray(bold_img.dataobj)[mask][:, trim_slice].T.astype(np.float64)
+        logger.debug(f"Run {i}: {bold}\n{Y.shape[0]} volumes x {Y.shape[1]} voxels")
+
+        subject_info = utils.tsv2subjectinfo(events_file, confounds_file=confounds_file,
+                                             exclude=exclude, trim_indices=trim_indices, confound_set=confound_set)
+        design = make_design_matrix(subject_info, Y.shape[0], TR, high_pass_filter_cutoff, bases)
+        C = contrast_vectors(contrasts, list(design.columns))
+        copes, varcopes, tstats, dof = fit_glm(Y, design.values, C, autocorr=autocorr)
+
+        results_dir = op.join(datasink_dir, 'results_dir', f"_modelestimate{i}", 'results')
+        os.makedirs(results_dir, exist_ok=True)
+        design.to_csv(op.join(results_dir, 'design.tsv'), sep='\t', index=False)
+        for c in range(len(contrasts)):
+            for name, values in (('cope', copes[c]), ('varcope', varcopes[c]), ('tstat', tstats[c])):
+                _save_masked(values, mask, bold_img.affine, op.join(results_dir, f"{name}{c+1}.nii.gz"))
+
+        l1_copes.append(copes)
+        l1_varcopes.append(varcopes)
+        dofs.append(dof)
+        run_masks.append(mask)
+
+    # level 2 is estimated within the first run's mask, like flameo's mask_file (pickfirst)
+    l2_mask = run_masks[0]
+    l2_copes = np.stack([_remask(c, m, l2_mask) for c, m in zip(l1_copes, run_masks)])
+    l2_varcopes = np.stack([_remask(v, m, l2_mask) for v, m in zip(l1_varcopes, run_masks)])
+    for c in range(len(contrasts)):
+        stats_dir = op.join(datasink_dir, 'stats_dir', f"_flameo{c}", 'stats')
+        os.makedirs(stats_dir, exist_ok=True)
+        cope, varcope, tstat, zstat = fixed_effects(l2_copes[:, c], l2_varcopes[:, c], dofs)
+        for name, values in (('cope1', cope), ('varcope1', varcope), ('tstat1', tstat), ('zstat1', zstat)):
+            _save_masked(values, l2_mask, bold_img.affine, op.join(stats_dir, f"{name}.nii.gz"))
+    return datasink_dir
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# pRF fitting for the LGN-cortical coupling (aka streams) project
+#
+# The voxels of a (cortex/LGN) mask are split into chunks that are fit in parallel
+# across a process pool. Results go into a structured array on disk as each chunk
+# finishes, so an interrupted fit picks up where it left off, and the parameter maps
+# are written as the BIDS-named NIfTIs that utils.threshold and utils.prf_to_anat use:
+# {out_prefix}_desc-prf{rsq,sig,rho,theta,xx,yy,mask}_space-func_map.nii.gz
+
+import os, sys
+import os.path as op
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import nibabel as nib
+
+import profiling
+
+DEFAULT_BANK_DIR = os.environ.get('STREAMS_PRF_BANK_DIR',
+                                  op.join(op.expanduser('~'), '.cache', 'streams', 'prf_banks'))
+
+# one record per voxel in the results array
+PRF_DTYPE = np.dtype([('x', 'f4'), ('y', 'f4'), ('sigma', 'f4'), ('beta', 'f4'), ('baseline', 'f4'),
+                      ('rsquared', 'f4'), ('done', '?')])
+
+# state of each pool worker, set up once by the fitter's initializer
+_worker = {}
+
+
+def _init_popeye_worker(stim, grids=((-10, 10), (-10, 10), (0.25, 5.25)),
+                        bounds=((-12, 12), (-12, 12), (0.001, 12), (1e-8, None), (-5, 5)), Ns=5):
+    """Build the popeye Gaussian model for this worker process"""
+    from popeye.visual_stimulus import VisualStimulus
+    import popeye.og as og
+    import popeye.utilities as putils
+
+    stimulus = VisualStimulus(stim['bigstack'], stim['viewing_distance'], stim['screen_width'],
+                              stim.get('scale_factor', 1.0), stim['TR'], np.short)
+    model = og.GaussianModel(stimulus, putils.double_gamma_hrf)
+    model.hrf_delay = 0
+    _worker.update(model=model, grids=grids, bounds=bounds, Ns=Ns)
+
+
+def _fit_chunk_popeye(data, voxel_index):
+    """Fit each voxel's timeseries (rows of data) with popeye's GaussianFit"""
+    import popeye.og as og
+
+    results = np.zeros(len(data), dtype=PRF_DTYPE)
+    for i, (timeseries, idx) in enumerate(zip(data, voxel_index)):
+        fit = og.GaussianFit(_worker['model'], timeseries, _worker['grids'], _worker['bounds'],
+                             Ns=_worker['Ns'], voxel_index=tuple(idx), auto_fit=True, verbose=0)
+        results[i] = (fit.x, fit.y, fit.sigma, fit.beta, fit.baseline, fit.rsquared, True)
+    return results
+
+
+def stimulus_coordinates(stim):
+    """Downsampled stimulus aperture as a (time x pixels) array, and the x/y position
+    in degrees of visual angle of each pixel (y increases upwards)"""
+    bigstack = stim['bigstack']
+    stride = max(1, int(round(1. / stim.get('scale_factor', 1.0))))
+    aperture = bigstack[::stride, ::stride, :]
+    rows, cols = aperture.shape[:2]
+    screen_deg = 2 * np.degrees(np.arctan(stim['screen_width'] / 2. / stim['viewing_distance']))
+    deg_per_px = screen_deg / bigstack.shape[1] * stride
+    deg_x = (np.arange(cols) - (cols - 1) / 2.) * deg_per_px
+    deg_y = ((rows - 1) / 2. - np.arange(rows)) * deg_per_px
+    X, Y = np.meshgrid(deg_x, deg_y)
+    return aperture.reshape(rows * cols, -1).T.astype(np.float32), X.ravel(), Y.ravel()
+
+
+def double_gamma_hrf(TR, length=32.):
+    """SPM-style canonical (double gamma) HRF sampled every TR, normalized to unit sum"""
+    from scipy.stats import gamma
+    t = np.arange(0, length, TR)
+    hrf = gamma.pdf(t, 6) - gamma.pdf(t, 16) / 6.
+    return hrf / np.sum(hrf)
+
+
+def default_grid(stim, n_xy=21, n_sigma=12):
+    """(x, y, sigma) candidates spanning the stimulated part of the visual field"""
+    screen_deg = 2 * np.degrees(np.arctan(stim['screen_width'] / 2. / stim['viewing_distance']))
+    xy = np.linspace(-screen_deg / 2., screen_deg / 2., n_xy)
+    return xy, xy, np.geomspace(0.25, screen_deg / 4., n_sigma)
+
+
+def predict_timeseries(aperture, X, Y, hrf, params):
+    """HRF-convolved Gaussian pRF responses to the aperture, one column per row of params (x, y, sigma)"""
+    from scipy.signal import fftconvolve
+    x, y, sigma = (params[:, i, None] for i in range(3))
+    gaussians = np.exp(-((X[None, :] - x)**2 + (Y[None, :] - y)**2) / (2 * sigma**2)).astype(np.float32)
+    responses = aperture @ gaussians.T # time x candidates
+    return fftconvolve(responses, hrf[:, None], axes=0)[:aperture.shape[0]]
+
+
+@profiling.traced
+def prediction_bank(stim, grid=None, cache_dir=None, chunk_size=1000):
+    """
+    Predicted timeseries of every (x, y, sigma) candidate in grid, for the stimulus in stim.
+
+    The bank depends only on the stimulus, TR and grid, so it is computed once and kept
+    in cache_dir (by default DEFAULT_BANK_DIR, set by STREAMS_PRF_BANK_DIR; keyed by a hash of all three)
+    for every later fit with the same stimulus.
+    Returns the (time x candidates) predictions and the (candidates x 3) parameters.
+    """
+    import hashlib
+
+    if grid is None:
+        grid = default_grid(stim)
+    params = np.array(np.meshgrid(*grid, indexing='ij')).reshape(3, -1).T
+    if cache_dir is None:
+        cache_dir = DEFAULT_BANK_DIR
+    h = hashlib.sha1(np.ascontiguousarray(stim['bigstack']).tobytes())
+    h.update(repr((stim['TR'], stim['viewing_distance'], stim['screen_width'], stim.get('scale_factor', 1.0))).encode())
+    h.update(params.tobytes())
+    bank_file = op.join(cache_dir, f"prfbank_{h.hexdigest()}.npy")
+    if op.exists(bank_file):
+        return np.load(bank_file, mmap_mode='r'), params
+
+    aperture, X, Y = stimulus_coordinates(stim)
+    hrf = double_gamma_hrf(stim['TR'])
+    bank = np.empty((aperture.shape[0], len(params)), dtype=np.float32)
+    for start in range(0, len(params), chunk_size):
+        bank[:, start:start+chunk_size] = predict_timeseries(aperture, X, Y, hrf, params[start:start+chunk_size])
+    logger.debug(f"Built pRF prediction bank {bank.shape} -> {bank_file}")
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{bank_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, bank)
+    os.replace(tmp_file, bank_file)
+    return bank, params
+
+
+def _zscore_columns(A):
+    """z-score each column, leaving constant columns at 0"""
+    A = A - np.mean(A, axis=0)
+    std = np.std(A, axis=0)
+    std[std == 0] = np.inf
+    return A / std
+
+
+def _init_grid_worker(stim, grid=None, fine_threshold=0.1, cache_dir=None):
+    """Load the prediction bank (built once and cached, see prediction_bank) for this worker process"""
+    bank, params = prediction_bank(stim, grid, cache_dir)
+    aperture, X, Y = stimulus_coordinates(stim)
+    _worker.update(bank_z=_zscore_columns(np.asarray(bank, dtype=np.float32)), params=params,
+                   aperture=aperture, X=X, Y=Y, hrf=double_gamma_hrf(stim['TR']),
+                   bounds=[(p.min(), p.max()) for p in (params[:, 0], params[:, 1], params[:, 2])],
+                   fine_threshold=fine_threshold)
+
+
+def _linear_fit(prediction, timeseries):
+    """beta, baseline and residual sum of squares of timeseries ~ beta * prediction + baseline"""
+    A = np.column_stack([prediction, np.ones_like(prediction)])
+    coefs, rss, _, _ = np.linalg.lstsq(A, timeseries, rcond=None)
+    rss = rss[0] if len(rss) else np.sum((timeseries - A @ coefs)**2)
+    return coefs[0], coefs[1], rss
+
+
+def _fit_chunk_grid(data, voxel_index):
+    """Coarse fit all voxels at once as the best-correlated prediction in the bank
+    (one matrix product), then refine (x, y, sigma) only where the coarse fit is good enough"""
+    from scipy.optimize import minimize
+
+    w = _worker
+    n_vols = w['bank_z'].shape[0]
+    data = np.asarray(data, dtype=np.float32)[:, :n_vols]
+    corr = _zscore_columns(data.T).T @ w['bank_z'] / n_vols # voxels x candidates
+    best = np.argmax(corr, axis=1)
+    best_r = corr[np.arange(len(data)), best]
+
+    results = np.zeros(len(data), dtype=PRF_DTYPE)
+    for i, timeseries in enumerate(data):
+        x, y, sigma = w['params'][best[i]]
+        rsquared = max(best_r[i], 0)**2
+        if rsquared >= w['fine_threshold']:
+            def rss(p):
+                prediction = predict_timeseries(w['aperture'], w['X'], w['Y'], w['hrf'], p[None, :])[:, 0]
+                return _linear_fit(prediction, timeseries)[2]
+            fit = minimize(rss, (x, y, sigma), method='L-BFGS-B', bounds=w['bounds'])
+            x, y, sigma = fit.x
+        prediction = predict_timeseries(w['aperture'], w['X'], w['Y'], w['hrf'], np.array([[x, y, sigma]]))[:, 0]
+        beta, baseline, residual = _linear_fit(prediction, timeseries)
+        total = np.sum((timeseries - np.mean(timeseries))**2)
+        rsquared = 1 - residual / total if total > 0 else 0
+        results[i] = (x, y, sigma, beta, baseline, rsquared, True)
+    return results
+
+
+def _prepare_grid(stim, grid=None, fine_threshold=0.1, cache_dir=None):
+    """Build the prediction bank on disk (see prediction_bank), so the workers only load it"""
+    prediction_bank(stim, grid, cache_dir)
+
+
+# method name -> (worker initializer, chunk fitting function,
+#                 setup run once in the parent before the workers start, e.g. to build an on-disk cache, or None)
+FITTERS = {'popeye': (_init_popeye_worker, _fit_chunk_popeye, None),
+           'grid': (_init_grid_worker, _fit_chunk_grid, _prepare_grid)}
+
+
+def fit_signature(bold, stim, method, fit_kwargs):
+    """Hash of what a results file depends on besides the voxels: the bold (path, mtime and size),
+    the stimulus, the method and its fit_kwargs"""
+    import hashlib
+
+    st = os.stat(bold)
+    h = hashlib.sha1(repr((op.abspath(bold), st.st_mtime_ns, st.st_size)).encode())
+    h.update(np.ascontiguousarray(stim['bigstack']).tobytes())
+    h.update(repr(sorted((k, v) for k, v in stim.items() if k != 'bigstack')).encode())
+    h.update(repr((method, sorted(fit_kwargs.items()))).encode())
+    return h.hexdigest()
+
+
+def open_results(results_file, voxel_index, signature=None):
+    """Open (or create) the on-disk results array for these voxels.
+
+    The voxel coordinates and the fit's signature (see fit_signature) are stored alongside, and
+    an existing results file is only reused if it was made for the same voxels and signature."""
+    voxel_file = results_file.replace('.npy', '_voxels.npy')
+    signature_file = results_file.replace('.npy', '_signature.txt')
+    if op.exists(results_file) and op.exists(voxel_file):
+        if not np.array_equal(np.load(voxel_file), voxel_index):
+            raise ValueError(f"{results_file} was created for a different mask, remove it or use another out_prefix")
+        stored = open(signature_file).read().strip() if op.exists(signature_file) else None
+        if stored != signature:
+            raise ValueError(f"{results_file} was created for a different bold, stimulus, method or fit options, "
+                             f"remove it or use another out_prefix")
+        results = np.lib.format.open_memmap(results_file, mode='r+')
+        logger.debug(f"Resuming {results_file}: {np.count_nonzero(results['done'])}/{len(results)} voxels done")
+    else:
+        np.save(voxel_file, voxel_index)
+        if signature is not None:
+            with open(signature_file, 'w') as f:
+                f.write(signature)
+        results = np.lib.format.open_memmap(results_file, mode='w+', dtype=PRF_DTYPE, shape=(len(voxel_index),))
+    return results
+
+
+@profiling.traced
+def write_prf_maps(results, voxel_index, ref_img, out_dir, out_prefix, space='func'):
+    """Scatter the fit parameters back into volumes and save them, returning the filenames"""
+    x = results['x']
+    y = results['y']
+    params = {'rsq': results['rsquared'],
+              'sig': results['sigma'],
+              'rho': np.sqrt(x**2 + y**2),
+              'theta': np.mod(np.arctan2(y, x), 2 * np.pi),
+              'xx': x,
+              'yy': y,
+              'mask': np.ones(len(results))}
+    done = results['done']
+    out_files = []
+    for name, values in params.items():
+        vol = np.zeros(ref_img.shape[:3], dtype=np.float32)
+        vol[tuple(voxel_index[done].T)] = values[done]
+        out_file = op.join(out_dir, f"{out_prefix}_desc-prf{name}_space-{space}_map.nii.gz")
+        out_img = nib.Nifti1Image(vol, ref_img.affine, header=ref_img.header)
+        out_img.set_data_dtype(np.float32) # the bold's header may have an integer type
+        nib.save(out_img, out_file)
+        out_files.append(out_file)
+    return out_files
+
+
+@profiling.traced
+def fit_prf_volume(bold, mask, stim, out_dir, out_prefix, method='popeye', n_procs=None, chunk_size=500,
+                   mask_threshold=0.5, **fit_kwargs):
+    """
+    Fit pRFs to every voxel of bold (e.g. the output of utils.make_timeseries_for_prf) within mask.
+
+    stim: dict with the stimulus aperture 'bigstack' (pixels x pixels x time),
+          'TR', 'viewing_distance', 'screen_width' and optionally 'scale_factor'
+    out_prefix: e.g. sub-NB_ses-20201215, used for the results array and the map filenames
+    method: key into FITTERS, fit_kwargs are passed to its worker initializer.
+            'popeye' runs popeye's GaussianFit for each voxel, 'grid' does the coarse search for
+            a whole chunk as one product with a cached prediction bank and refines only the
+            voxels whose coarse r^2 is above fine_threshold
+    mask_threshold: voxels with mask values above this are fit
+
+    Results are kept in {out_dir}/{out_prefix}_prffits.npy; calling again with the same
+    arguments after an interruption only fits the chunks that were not finished. Calling
+    with another bold, stimulus, method or fit_kwargs raises ValueError rather than mixing fits.
+    Returns the list of parameter map files.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from functools import partial
+
+    init_worker, fit_chunk, prepare = FITTERS[method]
+    os.makedirs(out_dir, exist_ok=True)
+    mask_img = nib.load(mask)
+    voxel_index = np.argwhere(np.asanyarray(mask_img.dataobj) > mask_threshold)
+    results = open_results(op.join(out_dir, f"{out_prefix}_prffits.npy"), voxel_index,
+                           fit_signature(bold, stim, method, fit_kwargs))
+
+    chunks = [(start, min(start + chunk_size, len(voxel_index))) for start in range(0, len(voxel_index), chunk_size)]
+    chunks = [(start, stop) for start, stop in chunks if not np.all(results['done'][start:stop])]
+    logger.debug(f"Fitting {len(voxel_index)} voxels: {len(chunks)} chunks of {chunk_size} left to do")
+
+    bold_img = nib.load(bold)
+    if chunks:
+        if prepare is not None:
+            # build what the fitter caches on disk (the grid method's prediction bank) once, not in every worker
+            prepare(stim, **fit_kwargs)
+        data = np.asarray(bold_img.dataobj, dtype=np.float32)[tuple(voxel_index.T)]
+        bold_img.uncache()
+        with ProcessPoolExecutor(max_workers=n_procs, initializer=partial(init_worker, stim, **fit_kwargs)) as executor:
+            futures = {executor.submit(fit_chunk, data[start:stop], voxel_index[start:stop]): (start, stop)
+                       for start, stop in chunks}
+            for i, future in enumerate(as_completed(futures)):
+                start, stop = futures[future]
+                results[start:stop] = future.result()
+                results.flush()
+                logger.debug(f"Chunk {i+1}/{len(chunks)} (voxels {start}-{stop}) done")
+
+    return write_prf_maps(results, voxel_index, bold_img, out_dir, out_prefix)
+
+
+if __name__ == '__main__':
+    # When this script is invoked from the command line, read in arguments and use them
+    import pickle
+    bold = os.path.abspath(sys.argv[1])
+    mask = os.path.abspath(sys.argv[2])
+    with open(sys.argv[3], 'rb') as f: # pickled bigstack, as made in the pRF notebooks
+        bigstack = pickle.load(f)
+    stim = dict(bigstack=bigstack, TR=float(sys.argv[4]), viewing_distance=float(sys.argv[5]),
+                screen_width=float(sys.argv[6]))
+    out_dir = os.path.abspath(sys.argv[7])
+    out_prefix = sys.argv[8]
+
+    print('\n'.join(fit_prf_volume(bold, mask, stim, out_dir, out_prefix)))
@@ -0,0 +1,286 @@
+# Timing instrumentation for the LGN-cortical coupling (aka streams) project
+#
+# traced (decorator) and trace (context manager) record the wall time, CPU time (own and of child
+# processes such as FSL commands), peak RSS and bytes read of a function call or block. Commands run with
+# run_process are measured on their own (wait4 and /proc/{pid}/io), not through this process's totals,
+# so that those run concurrently by run_commands' threads each get their own share. Nothing is recorded
+# until start_trace() is called (or STREAMS_TRACE_DIR is set): each process then appends its records to
+# {trace_dir}/spans-{pid}.jsonl, so the workers of run_fixedeffects_batch and run_commands end up in the
+# same trace. nipype nodes are not traced here but read back from their result files, with the memory
+# and CPU use measured by nipype's resource monitor (enabled by start_trace), see node_records.
+# write_report gathers everything into trace.json, trace.csv and a per-step summary.tsv.
+#
+# Functions that run as nipype Function nodes (tsv2subjectinfo, get_files, trim_volumes, ...) must not be
+# decorated: nipype runs their source, decorator included, in the node. They are timed as nodes.
+#
+#   import profiling
+#   trace_dir = profiling.start_trace()
+#   ... GLM, ROI split, coherence, pRF ...
+#   profiling.write_report(trace_dir)
+
+import os, sys, json, glob, time
+import os.path as op
+import datetime
+import functools
+import resource
+import threading
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+TRACE_DIR_ENV = 'STREAMS_TRACE_DIR'
+# cpu_s, children_cpu_s, read_mb: this process's (and its waited-for children's) totals over the span, so
+#     only for spans of the main thread, which include whatever its worker threads do meanwhile. In other
+#     threads they can't be told apart from the other threads' and are None, unless the block measures
+#     them itself (see run_process).
+# peak_rss_mb: this process's high-water mark (ru_maxrss) at the end of the span, which may have been
+#     reached before it; rss_increase_mb is how much the span raised it. For commands, the command's own
+#     peak, for nodes, the one nipype measured.
+FIELDS = ['name', 'kind', 'parent', 'start', 'wall_s', 'cpu_s', 'children_cpu_s', 'peak_rss_mb',
+          'rss_increase_mb', 'read_mb', 'pid', 'tags']
+
+_local = threading.local() # stack of open span names, per thread
+
+
+def trace_dir():
+    """The directory records are written to, or None when tracing is off"""
+    return os.environ.get(TRACE_DIR_ENV) or None
+
+
+def start_trace(out_dir=None, run_name=None):
+    """Turn tracing on for this process and the processes it starts (through STREAMS_TRACE_DIR).
+
+    The trace goes to out_dir, by default traces/{run_name or the date and time}. Also enables nipype's
+    resource monitor, so that the nodes' peak memory and CPU use are recorded. Returns the trace directory."""
+    if out_dir is None:
+        out_dir = op.join('traces', run_name or datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    out_dir = op.abspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    os.environ[TRACE_DIR_ENV] = out_dir
+    enable_resource_monitor()
+    logger.debug(f"Tracing to {out_dir}")
+    return out_dir
+
+
+def enable_resource_monitor():
+    """Have nipype record each node's peak memory and CPU use (in its result file), if nipype is installed"""
+    try:
+        from nipype import config
+    except ImportError:
+        return
+    config.enable_resource_monitor()
+
+
+def stop_trace():
+    os.environ.pop(TRACE_DIR_ENV, None)
+
+
+def max_rss_mb(who=resource.RUSAGE_SELF):
+    return _ru_maxrss_mb(resource.getrusage(who).ru_maxrss)
+
+
+def _ru_maxrss_mb(ru_maxrss):
+    return ru_maxrss / 1024**2 if sys.platform == 'darwin' else ru_maxrss / 1024 # bytes on macOS, KB on linux
+
+
+def read_bytes(pid='self'):
+    """Bytes read by a process so far (including from the page cache, and by the children it waited for),
+    None where /proc is unavailable"""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _write_records(records):
+    out_dir = trace_dir()
+    if out_dir is None:
+        return
+    with open(op.join(out_dir, f"spans-{os.getpid()}.jsonl"), 'a') as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + '\n')
+
+
+@contextmanager
+def trace(name, kind='span', **tags):
+    """Record the wall/CPU time, peak RSS and bytes read of the with block as a span called name.
+
+    Yields a dict in which the block can set measures of its own (e.g. those of run_process), which replace
+    the process-wide ones, see FIELDS. tags (e.g. sub, ses, task) are saved with the record.
+    Does nothing when tracing is off."""
+    if trace_dir() is None:
+        yield {}
+        return
+    stack = _local.__dict__.setdefault('stack', [])
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    main_thread = threading.current_thread() is threading.main_thread()
+    start, wall, cpu = time.time(), time.perf_counter(), time.process_time()
+    children_cpu = resource.getrusage(resource.RUSAGE_CHILDREN)
+    rss, read = max_rss_mb(), read_bytes()
+    measured = {}
+    try:
+        yield measured
+    finally:
+        stack.pop()
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_end = read_bytes()
+        peak_rss = max_rss_mb()
+        record = {'name': name, 'kind': kind, 'parent': parent, 'start': start,
+                  'wall_s': time.perf_counter() - wall, 'cpu_s': None, 'children_cpu_s': None,
+                  'peak_rss_mb': None, 'rss_increase_mb': None, 'read_mb': None, 'pid': os.getpid(), 'tags': tags}
+        if main_thread:
+            record.update({'cpu_s': time.process_time() - cpu,
+                           'children_cpu_s': (children_end.ru_utime + children_end.ru_stime
+                                              - children_cpu.ru_utime - children_cpu.ru_stime),
+                           'peak_rss_mb': peak_rss, 'rss_increase_mb': peak_rss - rss,
+                           'read_mb': None if read is None else (read_end - read) / 1024**2})
+        record.update(measured)
+        _write_records([record])
+
+
+def run_process(cmd, env=None):
+    """Run a shell command, like subprocess.run(cmd, shell=True, capture_output=True, text=True, env=env),
+    and measure its own resource use, apart from this process's other threads and children.
+
+    Returns the exit code, stdout, stderr and a dict of the command's measures (see trace): the CPU time
+    (children_cpu_s, from wait4), peak RSS and bytes read (from /proc/{pid}/io, None where unavailable)
+    of the command and the processes it waited for, and the (negligible) CPU time of the waiting thread."""
+    import subprocess, tempfile
+
+    cpu = time.thread_time()
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(cmd, shell=True, stdout=out, stderr=err, env=env)
+        try:
+            # wait for it to exit without reaping it, so that its /proc/{pid}/io can still be read
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+            read = read_bytes(proc.pid)
+            _, status, usage = os.wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        out.seek(0)
+        err.seek(0)
+        stdout, stderr = out.read().decode(errors='replace'), err.read().decode(errors='replace')
+    measured = {'cpu_s': time.thread_time() - cpu, 'children_cpu_s': usage.ru_utime + usage.ru_stime,
+                'peak_rss_mb': _ru_maxrss_mb(usage.ru_maxrss),
+                'read_mb': None if read is None else read / 1024**2}
+    return proc.returncode, stdout, stderr, measured
+
+
+def traced(func=None, *, name=None):
+    """Decorator recording each call of func as a span (see trace), named after the function"""
+    if func is None:
+        return functools.partial(traced, name=name)
+    span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if trace_dir() is None:
+            return func(*args, **kwargs)
+        with trace(span_name, kind='function'):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _utc_timestamp(iso_time):
+    # nipype's runtime.startTime is an isoformat UTC time without a timezone
+    return datetime.datetime.fromisoformat(iso_time).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def node_records(working_dir, since=None, **tags):
+    """Records for the nipype nodes run in working_dir, from their result files.
+
+    since: only nodes that finished after this time (seconds since the epoch), so that nodes
+    reused from nipype's cache are left out. MapNode iterations are summed into their node.
+    peak_rss_mb and cpu_s come from nipype's resource monitor, and are None if it was off."""
+    from nipype.utils.filemanip import loadpkl
+
+    records = []
+    for result_file in glob.glob(op.join(working_dir, '**', 'result_*.pklz'), recursive=True):
+        node = op.basename(result_file)[len('result_'):-len('.pklz')]
+        if node.startswith('_'):
+            continue # MapNode iterations are counted by their parent
+        if since is not None and op.getmtime(result_file) < since:
+            continue
+        runtime = loadpkl(result_file).runtime
+        runtimes = [r for r in (runtime if isinstance(runtime, list) else [runtime]) if r is not None]
+        if len(runtimes) == 0:
+            continue
+        durations = [getattr(r, 'duration', 0) or 0 for r in runtimes]
+        mem_peaks = [r.mem_peak_gb for r in runtimes if getattr(r, 'mem_peak_gb', None) is not None]
+        cpu_percents = [getattr(r, 'cpu_percent', None) for r in runtimes]
+        cpu = (None if any(c is None for c in cpu_percents)
+               else sum(d * c / 100 for d, c in zip(durations, cpu_percents)))
+        starts = [r.startTime for r in runtimes if getattr(r, 'startTime', None)]
+        records.append({'name': node, 'kind': 'node', 'parent': op.relpath(op.dirname(op.dirname(result_file)), working_dir), # the workflow
+                        'start': (_utc_timestamp(min(starts)) if starts else op.getmtime(result_file)),
+                        'wall_s': sum(durations), 'cpu_s': cpu, 'children_cpu_s': None,
+                        'peak_rss_mb': max(mem_peaks) * 1024 if mem_peaks else None, 'rss_increase_mb': None,
+                        'read_mb': None, 'pid': None, 'tags': {**tags, 'iterations': len(runtimes)}})
+    return records
+
+
+def add_node_records(working_dir, since=None, **tags):
+    """Add the records of the nipype nodes run in working_dir (see node_records) to the trace, if tracing"""
+    if trace_dir() is None:
+        return []
+    records = node_records(working_dir, since, **tags)
+    _write_records(records)
+    return records
+
+
+def load_trace(out_dir):
+    """All the records written to a trace directory, in start order"""
+    records = []
+    for spans_file in glob.glob(op.join(out_dir, 'spans-*.jsonl')):
+        with open(spans_file) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda r: r['start'])
+
+
+def summarize(records):
+    """DataFrame with one row per span/function/node name: calls, total and max wall time, CPU time
+    (own + child processes), highest peak RSS and total MB read, sorted by total wall time"""
+    import pandas as pd
+
+    df = pd.DataFrame(records, columns=FIELDS)
+    if len(df) == 0:
+        return df
+    df['total_cpu_s'] = df['cpu_s'].fillna(0) + df['children_cpu_s'].fillna(0)
+    summary = df.groupby(['kind', 'name']).agg(calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'),
+                                               max_wall_s=('wall_s', 'max'), cpu_s=('total_cpu_s', 'sum'),
+                                               peak_rss_mb=('peak_rss_mb', 'max'), read_mb=('read_mb', 'sum'))
+    return summary.sort_values('wall_s', ascending=False)
+
+
+def write_report(out_dir=None):
+    """Write trace.json, trace.csv (one row per record) and summary.tsv (see summarize) to the trace
+    directory (by default the current one), print the summary and return it"""
+    import pandas as pd
+
+    out_dir = out_dir or trace_dir()
+    records = load_trace(out_dir)
+    with open(op.join(out_dir, 'trace.json'), 'w') as f:
+        json.dump(records, f, indent=2, default=str)
+    trace_df = pd.DataFrame(records, columns=FIELDS)
+    trace_df['tags'] = trace_df['tags'].map(lambda t: json.dumps(t, default=str))
+    trace_df.to_csv(op.join(out_dir, 'trace.csv'), index=False)
+    summary = summarize(records)
+    summary.to_csv(op.join(out_dir, 'summary.tsv'), sep='\t')
+    print(f"{len(records)} records in {out_dir}")
+    print(summary.round(2).to_string())
+    return summary
+
+
+if __name__ == '__main__':
+    # Write the report of a trace directory (e.g. after a run with STREAMS_TRACE_DIR set):
+    #   python profiling.py trace_dir
+    write_report(op.abspath(sys.argv[1]))
@@ -0,0 +1,146 @@
+# In-process affine resampling with FSL matrices for the LGN-cortical coupling (aka streams) project
+#
+# prf_to_anat and make_func_parc_mask used to run `flirt -applyxfm` once per map, each flirt process
+# recomputing the same sampling grid for the same func2brain/brain2func matrix. Here an FSL .mat is
+# turned into a reference voxel -> source voxel mapping once, the sample positions (nearest: source
+# voxel indices, trilinear: base voxel and fractional offsets) are computed once per (source grid,
+# reference grid, matrix) and kept in memory, and a whole batch of maps is then resampled with a few
+# gathers. Like flirt, reference voxels that map outside the source volume are 0, and the outputs have
+# the reference's geometry.
+
+import os
+import os.path as op
+from collections import namedtuple
+from functools import lru_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import nibabel as nib
+
+import profiling
+
+# target: flat indices of the reference voxels that fall inside the source volume
+# source: (nearest) flat index of the source voxel sampled for each of them,
+#         (trilinear) flat index of the lower corner of the source voxel cube around them
+# fractions: (trilinear) their offsets (target voxels x 3) from that corner, in voxels
+Sampler = namedtuple('Sampler', ['interp', 'src_shape', 'ref_shape', 'target', 'source', 'fractions'])
+
+
+def read_fsl_mat(mat_file):
+    """4x4 FSL (flirt) transformation matrix from a .mat text file"""
+    return np.loadtxt(mat_file, ndmin=2)
+
+
+def fsl_scaled_voxel_matrix(shape, zooms, affine):
+    """4x4 matrix from voxel indices to FSL's scaled voxel coordinates (mm from the first voxel),
+    with x flipped when the image is stored in neurological order (positive affine determinant), as FSL does"""
+    scale = np.diag([*zooms[:3], 1.])
+    if np.linalg.det(affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        scale = scale @ flip
+    return scale
+
+
+def grid(img):
+    """Hashable description of an image's voxel grid (shape, zooms, affine), the cache key of sampler"""
+    return (tuple(img.shape[:3]), tuple(float(z) for z in img.header.get_zooms()[:3]),
+            tuple(np.asarray(img.affine, dtype=float).ravel()))
+
+
+def voxel_mapping(src_grid, ref_grid, xfm):
+    """4x4 matrix from reference voxel indices to source voxel indices for the FSL matrix xfm (source -> reference)"""
+    src_shape, src_zooms, src_affine = src_grid
+    ref_shape, ref_zooms, ref_affine = ref_grid
+    src_scaled = fsl_scaled_voxel_matrix(src_shape, src_zooms, np.reshape(src_affine, (4, 4)))
+    ref_scaled = fsl_scaled_voxel_matrix(ref_shape, ref_zooms, np.reshape(ref_affine, (4, 4)))
+    return np.linalg.inv(src_scaled) @ np.linalg.inv(np.asarray(xfm)) @ ref_scaled
+
+
+@lru_cache(maxsize=4) # a trilinear sampler for a 1mm anatomical grid is a few hundred MB
+def _sampler(src_grid, ref_grid, xfm, interp):
+    src_shape, ref_shape = src_grid[0], ref_grid[0]
+    ref2src = voxel_mapping(src_grid, ref_grid, np.reshape(xfm, (4, 4)))
+    src_strides = np.array([src_shape[1] * src_shape[2], src_shape[2], 1])
+    upper = np.array(src_shape) - 1
+    jk = np.indices(ref_shape[1:]).reshape(2, -1)
+    targets, sources, fractions = [], [], []
+    for i in range(ref_shape[0]): # one plane at a time, to keep the float64 coordinates small
+        ijk = np.vstack([np.full(jk.shape[1], i), jk])
+        coords = (ref2src[:3, :3] @ ijk + ref2src[:3, 3:]).T
+        if interp == 'nearest':
+            inside = np.all((coords >= -0.5) & (coords < upper + 0.5), axis=1)
+            base = np.clip(np.rint(coords[inside]), 0, upper).astype(np.int64)
+        else:
+            inside = np.all((coords >= 0) & (coords <= upper), axis=1)
+            base = np.minimum(np.floor(coords[inside]), np.maximum(upper - 1, 0)).astype(np.int64)
+            fractions.append((coords[inside] - base).astype(np.float32))
+        targets.append(i * len(jk[0]) + np.flatnonzero(inside))
+        sources.append(base @ src_strides)
+    sampler = Sampler(interp, src_shape, ref_shape, np.concatenate(targets), np.concatenate(sources),
+                      np.concatenate(fractions) if interp == 'trilinear' else None)
+    logger.debug(f"{interp} sampler from {src_shape} to {ref_shape}: {len(sampler.target)} voxels inside the source")
+    return sampler
+
+
+def sampler(src_img, ref_img, xfm, interp='trilinear'):
+    """Sampler for resampling images on src_img's grid to ref_img's grid with an FSL matrix
+    (array or .mat file), as flirt -applyxfm -init xfm does. Cached for the last few grids/matrices.
+
+    interp: 'nearest' (flirt's nearestneighbour) or 'trilinear'"""
+    if interp not in ('nearest', 'trilinear'):
+        raise ValueError(f"Unknown interpolation {interp}, must be 'nearest' or 'trilinear'")
+    src_img = nib.load(src_img) if isinstance(src_img, str) else src_img
+    ref_img = nib.load(ref_img) if isinstance(ref_img, str) else ref_img
+    xfm = read_fsl_mat(xfm) if isinstance(xfm, str) else np.asarray(xfm, dtype=float)
+    return _sampler(grid(src_img), grid(ref_img), tuple(xfm.ravel()), interp)
+
+
+def apply_sampler(s, data, dtype=np.float32):
+    """Resample a batch of maps (maps x source volume, or a single source volume) with a Sampler.
+    Returns an array of dtype, maps x reference volume (or a single reference volume)"""
+    single = data.ndim == 3
+    flat = np.reshape(data, (1 if single else len(data), -1))
+    out = np.zeros((len(flat), int(np.prod(s.ref_shape))), dtype=dtype)
+    if s.interp == 'nearest':
+        out[:, s.target] = flat[:, s.source]
+    else:
+        strides = (s.src_shape[1] * s.src_shape[2], s.src_shape[2], 1)
+        fx, fy, fz = s.fractions.T
+        values = np.zeros((len(flat), len(s.target)), dtype=np.float32)
+        for dx, wx in ((0, 1 - fx), (strides[0], fx)):
+            for dy, wy in ((0, 1 - fy), (strides[1], fy)):
+                for dz, wz in ((0, 1 - fz), (strides[2], fz)):
+                    values += flat[:, s.source + (dx + dy + dz)] * (wx * wy * wz)
+        out[:, s.target] = values
+    out = out.reshape(len(flat), *s.ref_shape)
+    return out[0] if single else out
+
+
+@profiling.traced
+def apply_xfm(in_files, ref_file, xfm, out_files, interp='trilinear', dtype=np.float32):
+    """Resample 3d images (in_files) to ref_file's grid with an FSL matrix (array or .mat file)
+    and save them as out_files, like one flirt -applyxfm per file.
+
+    The sample positions are computed once for all the files on the same grid (see sampler),
+    and each such group is resampled in one pass. Returns out_files."""
+    if isinstance(in_files, str):
+        in_files, out_files = [in_files], [out_files]
+    assert len(in_files) == len(out_files)
+    ref_img = nib.load(ref_file)
+    groups = {}
+    for in_file, out_file in zip(in_files, out_files):
+        img = nib.load(in_file)
+        groups.setdefault(grid(img), []).append((img, out_file))
+    for group in groups.values():
+        s = sampler(group[0][0], ref_img, xfm, interp)
+        data = np.stack([np.asarray(img.dataobj, dtype=np.float32) for img, _ in group])
+        for out_data, (_, out_file) in zip(apply_sampler(s, data, dtype), group):
+            out_img = nib.Nifti1Image(out_data, ref_img.affine, ref_img.header)
+            out_img.set_data_dtype(dtype)
+            os.makedirs(op.dirname(op.abspath(out_file)), exist_ok=True)
+            nib.save(out_img, out_file)
+    return out_files
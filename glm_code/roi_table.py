@@ -0,0 +1,104 @@
+# ROI tables for the LGN-cortical coupling (aka streams) project
+#
+# A set of ROI masks is loaded once into one array of flat (C-order) voxel indices,
+# with offsets marking where each ROI's voxels start, like a sparse label volume.
+# Voxel counts, centroids, bounds and their RAS equivalents are then computed for every
+# ROI in one vectorized pass, and the values of any map (3d or 4d) can be pulled out
+# for each ROI by indexing, without building a NiftiMasker per ROI.
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+RoiTable = namedtuple('RoiTable', ['labels', 'indices', 'offsets', 'shape', 'affine'])
+
+
+def load_roi_table(rois, affine=None):
+    """
+    Load ROI masks into a RoiTable.
+
+    rois: dict of label -> mask (filename or image), or a list of filenames (used as labels)
+    affine: voxel -> RAS transform to report coordinates in, by default the first mask's
+    """
+    if not isinstance(rois, dict):
+        rois = {roi: roi for roi in rois}
+    indices = []
+    shape = None
+    for label, roi in rois.items():
+        img = nib.load(roi) if isinstance(roi, str) else roi
+        mask = np.asanyarray(img.dataobj) != 0
+        if shape is None:
+            shape = mask.shape
+            if affine is None:
+                affine = img.affine
+        assert mask.shape == shape, f"{label} has shape {mask.shape}, expected {shape}!"
+        indices.append(np.flatnonzero(mask).astype(np.int32))
+        assert len(indices[-1]) > 0, f"{label} is empty!"
+    offsets = np.concatenate([[0], np.cumsum([len(i) for i in indices])])
+    return RoiTable(list(rois.keys()), np.concatenate(indices), offsets, shape, affine)
+
+
+def roi_voxel_coords(table):
+    """(voxels x 3) voxel coordinates of every voxel of every ROI, in table order"""
+    return np.array(np.unravel_index(table.indices, table.shape)).T
+
+
+def to_ras(coords, affine):
+    """Apply the affine to (n x 3) voxel coordinates"""
+    return coords @ affine[:3, :3].T + affine[:3, 3]
+
+
+def roi_geometry(table):
+    """
+    Voxel count, centroid, bounds and extent of every ROI, in voxel and RAS coordinates.
+
+    Returns a DataFrame indexed by label, with 3-element array columns
+    center, min, max, extent (voxels) and center_ras, min_ras, max_ras, extent_ras.
+    """
+    coords = roi_voxel_coords(table)
+    starts = table.offsets[:-1]
+    n_voxels = np.diff(table.offsets)
+    centers = np.add.reduceat(coords, starts, axis=0) / n_voxels[:, None]
+    mins = np.minimum.reduceat(coords, starts, axis=0)
+    maxs = np.maximum.reduceat(coords, starts, axis=0)
+    geometry = pd.DataFrame({'n_voxels': n_voxels,
+                             'center': list(centers),
+                             'min': list(mins),
+                             'max': list(maxs),
+                             'extent': list(maxs - mins + 1),
+                             'center_ras': list(to_ras(centers, table.affine)),
+                             'min_ras': list(to_ras(mins, table.affine)),
+                             'max_ras': list(to_ras(maxs, table.affine))},
+                            index=table.labels)
+    geometry['extent_ras'] = geometry['max_ras'] - geometry['min_ras']
+    return geometry
+
+
+def roi_coords(table, label, ras=False):
+    """(voxels x 3) coordinates of one ROI's voxels, in voxel space or RAS"""
+    i = table.labels.index(label)
+    coords = np.array(np.unravel_index(table.indices[table.offsets[i]:table.offsets[i+1]], table.shape)).T
+    return to_ras(coords, table.affine) if ras else coords
+
+
+def roi_values(table, img):
+    """
+    Values of a map at each ROI's voxels, as a dict of label -> array.
+
+    img: filename or image on the same grid as the ROIs; 3d maps give (voxels,) arrays
+    and 4d images (voxels x time) arrays, in the same voxel order as roi_coords.
+    Only the bounding box of the ROIs is read from img, through its array proxy.
+    """
+    img = nib.load(img) if isinstance(img, str) else img
+    assert img.shape[:3] == table.shape, f"Image has shape {img.shape}, ROIs have {table.shape}!"
+    coords = roi_voxel_coords(table)
+    corner = coords.min(axis=0)
+    bbox = tuple(slice(lo, hi + 1) for lo, hi in zip(corner, coords.max(axis=0)))
+    data = np.asanyarray(img.dataobj[bbox])
+    crop_indices = np.ravel_multi_index(tuple((coords - corner).T), data.shape[:3])
+    values = data.reshape(np.prod(data.shape[:3]), -1)[crop_indices]
+    if data.ndim == 3:
+        values = values[:, 0]
+    return {label: values[table.offsets[i]:table.offsets[i+1]] for i, label in enumerate(table.labels)}
@@ -0,0 +1,271 @@
+# ROI helpers (scatter plots, percentile partitions) for the LGN-cortical coupling (aka streams) project
+#
+# Split out of utils.py, which imports them lazily. matplotlib is only imported by the plotting functions,
+# so the percentile partitions (e.g. assign_mp.py --numpy) run without it.
+
+import os.path as op
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import pandas as pd
+
+from nilearn.image import load_img, new_img_like
+
+from roi_table import load_roi_table, roi_geometry, roi_coords, roi_values
+from image_utils import load_mask, load_data, bounding_box
+import profiling
+
+## Functions for dealing with rois
+
+@profiling.traced
+def roi_map_scatter(roi, beta_map, ref_vol_img):
+    import matplotlib.pyplot as plt
+
+    # get coordinates of roi, calculate bounds
+    table = load_roi_table({roi: roi}, affine=ref_vol_img.affine)
+    geometry = roi_geometry(table).loc[roi]
+    print(f"****\n{roi} extends from {geometry['max']} to {geometry['min']} and is centered at:\n{geometry['center']} (native) = {geometry['center_ras']} (RAS)", sep='\n')
+
+    # values of the beta map within the roi mask
+    roi_betas = roi_values(table, beta_map)[roi]
+    coords_ras = roi_coords(table, roi, ras=True).T
+    print(coords_ras.shape, roi_betas.shape)
+
+    plt.scatter(coords_ras[0, :], roi_betas)
+    plt.xlabel("Left - Right")
+    plt.ylabel(f"{op.basename(beta_map)}")
+    plt.show()
+    plt.close()
+    plt.scatter(coords_ras[1, :], roi_betas)
+    plt.xlabel("Posterior - Anterior")
+    plt.ylabel(f"{op.basename(beta_map)}")
+    plt.show()
+    plt.close()
+    # plot histogram of beta values within roi mask
+    plt.scatter(coords_ras[2, :], roi_betas)
+    plt.xlabel("Inferior - Superior")
+    plt.ylabel(f"{op.basename(beta_map)}")
+    plt.show()
+    plt.close()
+
+@profiling.traced
+def roi_centers(big_roi_fn, subdivision_rois_fns, ref_vol_img):
+    import matplotlib.pyplot as plt
+
+    geometry = roi_geometry(load_roi_table([big_roi_fn, *subdivision_rois_fns], affine=ref_vol_img.affine))
+    big_roi = geometry.loc[big_roi_fn]
+    big_roi_max_bounds = big_roi['max_ras']
+    big_roi_extent = big_roi['extent_ras']
+    print(f"Big roi extends from {big_roi['min_ras']} to {big_roi_max_bounds}\nExtent is {big_roi_extent} and center is {big_roi['center_ras']}")
+    roi_centers = np.stack(geometry.loc[list(subdivision_rois_fns), 'center_ras'])
+    roi_center_proportions = (big_roi_max_bounds - roi_centers)/big_roi_extent
+    fig, ax = plt.subplots(1)
+    ax.scatter(roi_center_proportions[:, 0], 1-roi_center_proportions[:, 2])
+    ax.set_xlabel("Proportion of LGN extent (L-R)")
+    ax.set_ylabel("Proportion of LGN extent (Ventral - Dorsal)")
+    for fn, roi_center, roi_center_proportion in zip(subdivision_rois_fns, roi_centers, roi_center_proportions):
+        print(fn, roi_center, roi_center_proportion, sep='\n')
+    plt.show()
+    plt.close('all')
+
+@profiling.traced
+def roi_stats(roi_dict, ref_vol_img):
+    geometry = roi_geometry(load_roi_table(roi_dict, affine=ref_vol_img.affine))
+    for label, roi in geometry.iterrows():
+        print(f"{label}")
+        print((roi['n_voxels'], 3))
+        print("ROI max and min coords", roi['max'], roi['min'])
+        print("ROI extent (total voxel span and max/min distance from center): ", roi['extent'], roi['max']-roi['center'], roi['min']-roi['center'], sep='\n')
+        print("ROI center in EPI and real-world coordinates: ", roi['center'], roi['center_ras'], sep='\n')
+        print("****")
+
+def roi_partition_filenames(roi, cut_pct, roi_below_suffix='P', roi_above_suffix='M', out_dir=None):
+    """Filenames of the two ROIs made by splitting roi at cut_pct,
+    e.g. desc-LLGN -> desc-LLGNP80 (below) and desc-LLGNM80 (above), in out_dir (by default roi's)"""
+    roi_stub = op.basename(roi).split('.')[0]
+    roi_stub_parts = roi_stub.split('_')
+    desc = [(i, x) for i, x in enumerate(roi_stub_parts) if 'desc-' in x]
+    # desc[0][0] = index of description part in list of parts
+    # desc[0][1] = actual desc-whatever
+    roi_dir = op.dirname(roi) if out_dir is None else out_dir
+    # desc-LLGN -> desc-LLGNM80 or whatever
+    roi_below_name = f"{desc[0][1]}{roi_below_suffix}{cut_pct}"
+    roi_above_name = f"{desc[0][1]}{roi_above_suffix}{cut_pct}"
+    #print(roi_stub, roi_stub_parts, desc, roi_above_name, roi_below_name)
+    roi_below_filename = f"{op.join(roi_dir, '_'.join([*roi_stub_parts[:desc[0][0]], roi_below_name, *roi_stub_parts[desc[0][0]+1:]]))}.nii.gz"
+    roi_above_filename = f"{op.join(roi_dir, '_'.join([*roi_stub_parts[:desc[0][0]], roi_above_name, *roi_stub_parts[desc[0][0]+1:]]))}.nii.gz"
+    return roi_below_filename, roi_above_filename
+
+@profiling.traced
+def partition_roi(roi, beta_map, cut_pcts):
+    """Split an roi at one or more percentiles of the values of beta_map within it.
+
+    Nothing is written or plotted. The roi values are sorted once and every percentile
+    is read off the sorted values (interpolating linearly, as np.percentile does).
+
+    Returns the roi voxel coordinates (voxels x 3), the beta_map values there,
+    the threshold for each of cut_pcts, and a (percentiles x voxels) boolean array
+    that is True for voxels above the threshold (all others are at or below it).
+    Only the roi's bounding box of beta_map is read."""
+    roi_mask = load_mask(roi)
+    coords = np.argwhere(roi_mask)
+    bbox = bounding_box(roi_mask, margin=0)
+    corner = np.array([s.start for s in bbox])
+    roi_betas = load_data(beta_map, slicer=bbox)[tuple((coords - corner).T)]
+    sorted_betas = np.sort(roi_betas)
+    pos = np.atleast_1d(np.asarray(cut_pcts, dtype=float)) / 100 * (len(sorted_betas) - 1)
+    lo = np.floor(pos).astype(int)
+    hi = np.ceil(pos).astype(int)
+    thresholds = sorted_betas[lo] + (sorted_betas[hi] - sorted_betas[lo]) * (pos - lo)
+    above = roi_betas[None, :] > thresholds[:, None]
+    return coords, roi_betas, thresholds, above
+
+@profiling.traced
+def write_roi_partition(roi, coords, above, cut_pct, roi_below_suffix='P', roi_above_suffix='M', out_dir=None):
+    """Save the two ROIs for one row of partition_roi's assignments next to roi (or in out_dir).
+    Returns the above and below mask images."""
+    roi_img = load_img(roi)
+    roi_below_filename, roi_above_filename = roi_partition_filenames(roi, cut_pct, roi_below_suffix, roi_above_suffix, out_dir)
+    masks = []
+    for filename, voxels in ((roi_above_filename, coords[above]), (roi_below_filename, coords[~above])):
+        mask_data = np.zeros(roi_img.shape[:3], dtype=np.int8)
+        mask_data[tuple(voxels.T)] = 1
+        mask_img = new_img_like(roi_img, mask_data)
+        mask_img.to_filename(filename)
+        masks.append(mask_img)
+        print(f"{filename}: {len(voxels)} voxels")
+    return masks
+
+@profiling.traced
+def plot_roi_partition(beta_map, coords, roi_betas, threshold):
+    """Histogram of the roi values with the threshold, and slices through the roi (z, then y)
+    showing the map values around the threshold"""
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as colors
+
+    roi_beta_min = np.min(roi_betas)
+    roi_beta_max = np.max(roi_betas)
+
+    # plot histogram of beta values within roi mask
+    plt.hist(roi_betas, bins=16)
+    plt.xlabel("BetaM-P")
+    plt.ylabel("Number of voxels")
+    plt.axvline(x=threshold, color="orange")
+    plt.show()
+    plt.close()
+
+    # only the roi and the 2 voxels before and 1 after it are shown, so only that block of the map
+    # is read (indices below are within the block; slice titles are in the full volume)
+    shape = load_img(beta_map).shape[:3]
+    corner = np.maximum(np.min(coords, 0) - 2, 0)
+    bbox = tuple(slice(lo, hi) for lo, hi in zip(corner, np.minimum(np.max(coords, 0) + 2, shape)))
+    beta_mp = load_data(beta_map, slicer=bbox)
+    roi_mask = np.zeros(beta_mp.shape[:3], dtype=bool)
+    roi_mask[tuple((coords - corner).T)] = True
+    beta_masked = np.ma.masked_array(beta_mp, mask=~roi_mask)
+    print(f"beta_masked: {beta_masked.shape}")
+
+    roi_min_x, roi_min_y, roi_min_z = np.min(coords, 0) - corner
+    roi_max_x, roi_max_y, roi_max_z = np.max(coords, 0) - corner
+    x0, y0, z0 = corner
+    roi_extent_y = roi_max_y - roi_min_y + 1
+    roi_extent_z = roi_max_z - roi_min_z + 1
+
+    # display first set of slices (z) and include a narrow colorbar axis
+    gridspec = {'width_ratios': [1]*roi_extent_z + [0.1]}
+    fig, ax = plt.subplots(ncols=roi_extent_z+1, figsize=(16,6), gridspec_kw=gridspec)
+    for ri in range(roi_extent_z):
+        # as of 2021-08-12, making this change to the orientation of the beta map to display correctly
+        to_show = np.fliplr(beta_masked[:,:,roi_max_z-ri].transpose())
+        #print(to_show.shape, np.count_nonzero(~to_show.mask))
+        pos = ax[ri].imshow(to_show, origin="lower",
+            cmap="coolwarm", clim=(roi_beta_min, roi_beta_max),
+            norm=colors.TwoSlopeNorm(vmin=roi_beta_min, vcenter=threshold, vmax=roi_beta_max))
+        ax[ri].set_title(f"Slice {z0+roi_max_z-ri}")
+        ax[ri].set_xlabel("Left to Right")
+        ax[ri].set_ylabel("Posterior to Anterior")
+        ax[ri].set_xticks([])
+        ax[ri].set_yticks([])
+    plt.colorbar(pos, cax=ax[ri+1])
+    plt.show()
+    plt.close()
+
+    # display second set of slices with different orientation (y)
+    fig, ax = plt.subplots(ncols=roi_extent_y, figsize=(16,6))
+    for ri in range(roi_extent_y):
+        # as of 2021-08-12, making this change to the orientation of the beta map to display correctly
+        to_show = np.fliplr(beta_masked[:,roi_max_y-ri,:].transpose())
+        #print(to_show.shape, np.count_nonzero(~to_show.mask))
+        pos = ax[ri].imshow(to_show, origin="lower",
+            cmap="coolwarm", clim=(roi_beta_min, roi_beta_max),
+            norm=colors.TwoSlopeNorm(vmin=roi_beta_min, vcenter=threshold, vmax=roi_beta_max))
+        ax[ri].set_title(f"Slice {y0+roi_max_y-ri}")
+        ax[ri].set_xlabel("Left to Right")
+        ax[ri].set_ylabel("Inferior to Superior")
+        ax[ri].set_xticks([])
+        ax[ri].set_yticks([])
+    plt.show()
+    plt.close('all')
+
+@profiling.traced
+def assign_roi_percentile(roi, beta_map, cut_pct, ref_vol_img, which_hemi=None, roi_below_suffix='P', roi_above_suffix='M', write=True, plot=True):
+    """This function takes an roi mask (nifti) and a map of values (originally betas for GLM contrasts but could also be pRF results etc).
+    It looks at the values in the map within the ROI and identifies the specified (cut_pct) percentile.
+    It then assigns the voxels to one of two regions based on if they're above or below this value.
+    It also displays some graphs and stuff about this.
+
+    This is partition_roi, write_roi_partition and plot_roi_partition in sequence; write and plot
+    turn the last two off (when not writing, the masks are None). To sweep several percentiles,
+    call partition_roi once with all of them."""
+    coords, roi_betas, thresholds, above = partition_roi(roi, beta_map, [cut_pct])
+    threshold = thresholds[0] # value above/below which voxels are assigned to different ROIs
+    roi_below_filename, roi_above_filename = roi_partition_filenames(roi, cut_pct, roi_below_suffix, roi_above_suffix)
+    print(f"****\n****\nGiven the LGN mask \n{roi}\nwhich extends from {np.max(coords, 0)} to {np.min(coords, 0)}\nwill partition at {cut_pct}% and create\n{roi_below_filename}\n{roi_above_filename}", sep='\n')
+    print(f"Mask contains {len(roi_betas)} voxels and {cut_pct}th percentile is {threshold}")
+
+    above_mask, below_mask = None, None
+    if write:
+        above_mask, below_mask = write_roi_partition(roi, coords, above[0], cut_pct, roi_below_suffix, roi_above_suffix)
+    if plot:
+        plot_roi_partition(beta_map, coords, roi_betas, threshold)
+    return above_mask, below_mask, threshold
+
+
+def read_percentile_manifest(manifest):
+    """Read a manifest of ROI percentile splits into a DataFrame.
+
+    manifest is a TSV file (or DataFrame, or list of dicts) with one row per split and columns
+    cope, roi, percentile, plus optionally roi_below_suffix, roi_above_suffix (default P and M) and out_dir
+    (default: next to the roi)."""
+    if isinstance(manifest, str):
+        manifest = pd.read_csv(manifest, sep='\t', dtype={'percentile': float}, keep_default_na=False)
+    jobs = pd.DataFrame(manifest)
+    for column, default in (('roi_below_suffix', 'P'), ('roi_above_suffix', 'M'), ('out_dir', '')):
+        if column not in jobs:
+            jobs[column] = default
+    jobs['out_dir'] = [d if d else None for d in jobs['out_dir']]
+    return jobs
+
+@profiling.traced
+def assign_roi_percentiles(manifest):
+    """Split each roi at percentiles of a cope map (or any map) within it, for every row of a manifest
+    (see read_percentile_manifest), in-process and without writing any intermediate images.
+
+    Rows with the same cope and roi are done together: the cope is read once, only within the roi's
+    bounding box, and each percentile read off the same sorted values (see partition_roi).
+    The two masks for each row are written as in assign_roi_percentile (see roi_partition_filenames).
+
+    Returns a DataFrame of the rows with their threshold, voxel counts and output filenames."""
+    jobs = read_percentile_manifest(manifest)
+    results = []
+    for (cope, roi), group in jobs.groupby(['cope', 'roi'], sort=False):
+        coords, roi_betas, thresholds, above = partition_roi(roi, cope, group['percentile'].to_numpy())
+        for i, (_, job) in enumerate(group.iterrows()):
+            pct = int(job['percentile']) if float(job['percentile']).is_integer() else job['percentile']
+            write_roi_partition(roi, coords, above[i], pct, job['roi_below_suffix'], job['roi_above_suffix'], job['out_dir'])
+            below_file, above_file = roi_partition_filenames(roi, pct, job['roi_below_suffix'], job['roi_above_suffix'], job['out_dir'])
+            results.append({**job.to_dict(), 'threshold': thresholds[i], 'n_above': int(above[i].sum()),
+                            'n_below': int((~above[i]).sum()), 'above_file': above_file, 'below_file': below_file})
+    return pd.DataFrame(results)
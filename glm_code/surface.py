@@ -0,0 +1,181 @@
+# In-process volume to surface projection for the LGN-cortical coupling (aka streams) project
+#
+# prf_to_anat used to run `mri_vol2surf --projfrac 0.5 --regheader sub` twice per map, once per hemisphere,
+# each FreeSurfer process reading the same surfaces again. Here the white and pial surfaces of a subject
+# are read once, and the voxel of the reference volume under each vertex of the surface halfway between
+# them (nearest neighbour, as mri_vol2surf does by default) is stored as a sparse vertices x voxels matrix,
+# kept per (subject, hemisphere, reference grid). Any number of maps on that grid are then projected to a
+# hemisphere with one sparse matrix product, and written as {hemi}.{name}.mgz overlays (see freeview_prfs).
+#
+# The other way round, labels_to_volumes replaces mri_label2vol --proj frac 0 1 .1 (and the fslswapdim after
+# it) in convert_labels: the voxels of the template crossed by each vertex's ribbon, sampled at 11 depths
+# between white and pial, are computed once per hemisphere, and every label is rasterized from them.
+
+import os
+import os.path as op
+from functools import lru_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import nibabel as nib
+
+import profiling
+from resample import grid
+
+HEMIS = ('lh', 'rh')
+# depths between white (0) and pial (1) of mri_label2vol --proj frac 0 1 .1
+PROJ_FRACS = tuple(round(0.1 * i, 1) for i in range(11))
+
+
+def subject_dir(sub, subjects_dir=None):
+    return op.join(subjects_dir or os.environ['SUBJECTS_DIR'], sub)
+
+
+def white_pial(sub, hemi, subjects_dir=None):
+    """Vertex coordinates (surface RAS) of hemi.white and hemi.pial"""
+    surf_dir = op.join(subject_dir(sub, subjects_dir), 'surf')
+    white, _ = nib.freesurfer.read_geometry(op.join(surf_dir, f"{hemi}.white"))
+    pial, _ = nib.freesurfer.read_geometry(op.join(surf_dir, f"{hemi}.pial"))
+    return white, pial
+
+
+def surface_coordinates(sub, hemi, projfrac=0.5, subjects_dir=None):
+    """Vertex coordinates (surface RAS) of the surface projfrac of the way from hemi.white to hemi.pial"""
+    white, pial = white_pial(sub, hemi, subjects_dir)
+    return white + projfrac * (pial - white)
+
+
+def _surf_mtimes(sub, hemi, subjects_dir):
+    surf_dir = op.join(subject_dir(sub, subjects_dir), 'surf')
+    return tuple(os.stat(op.join(surf_dir, f"{hemi}.{s}")).st_mtime_ns for s in ('white', 'pial'))
+
+
+def surface_to_scanner(sub, subjects_dir=None):
+    """4x4 matrix from FreeSurfer surface RAS (tkregister) to scanner RAS, from the subject's orig.mgz,
+    i.e. mri_vol2surf's --regheader registration"""
+    orig = nib.load(op.join(subject_dir(sub, subjects_dir), 'mri', 'orig.mgz'))
+    return orig.header.get_vox2ras() @ np.linalg.inv(orig.header.get_vox2ras_tkr())
+
+
+@lru_cache(maxsize=8)
+def _vertex_voxel_matrix(sub, hemi, subjects_dir, ref_grid, projfrac, surf_mtimes):
+    from scipy import sparse
+
+    ref_shape, _, ref_affine = ref_grid
+    coords = surface_coordinates(sub, hemi, projfrac, subjects_dir)
+    ras2vox = np.linalg.inv(np.reshape(ref_affine, (4, 4))) @ surface_to_scanner(sub, subjects_dir)
+    voxels = np.rint(coords @ ras2vox[:3, :3].T + ras2vox[:3, 3]).astype(np.int64)
+    inside = np.flatnonzero(np.all((voxels >= 0) & (voxels < np.array(ref_shape)), axis=1))
+    columns = np.ravel_multi_index(tuple(voxels[inside].T), ref_shape)
+    matrix = sparse.csr_matrix((np.ones(len(inside), dtype=np.float32), (inside, columns)),
+                               shape=(len(coords), int(np.prod(ref_shape))))
+    logger.debug(f"{hemi} of {sub}: {len(inside)} of {len(coords)} vertices inside the {ref_shape} volume")
+    return matrix
+
+
+def vertex_voxel_matrix(sub, hemi, ref_img, projfrac=0.5, subjects_dir=None):
+    """Sparse (vertices x voxels of ref_img) matrix picking, for each vertex of hemi's surface projfrac
+    of the way from white to pial, the voxel it falls in (rows of vertices outside the volume are empty).
+    Cached for the last few subjects/hemispheres/reference grids, and remade if the surfaces change."""
+    ref_img = nib.load(ref_img) if isinstance(ref_img, str) else ref_img
+    subjects_dir = subjects_dir or os.environ['SUBJECTS_DIR']
+    return _vertex_voxel_matrix(sub, hemi, subjects_dir, grid(ref_img), projfrac, _surf_mtimes(sub, hemi, subjects_dir))
+
+
+@profiling.traced
+def vol2surf(in_files, sub, out_names, out_dir, hemis=HEMIS, projfrac=0.5, subjects_dir=None):
+    """Project 3d maps (in_files, on the same grid, e.g. the subject's anatomical) to both hemispheres,
+    like mri_vol2surf --regheader sub --projfrac, writing {out_dir}/{hemi}.{out_name}.mgz for each map.
+    Unlike mri_vol2surf, which moves projfrac of the thickness along the white surface's normal, each vertex
+    is sampled projfrac of the way from its white to its pial vertex, so some vertices can get another voxel.
+
+    Each hemisphere's maps are projected together, with one sparse matrix product. Returns the written files."""
+    if isinstance(in_files, str):
+        in_files, out_names = [in_files], [out_names]
+    assert len(in_files) == len(out_names)
+    if len(in_files) == 0:
+        return []
+    imgs = [nib.load(f) for f in in_files]
+    assert all(grid(img) == grid(imgs[0]) for img in imgs), "The maps to project must share a grid"
+    data = np.stack([np.asarray(img.dataobj, dtype=np.float32).ravel() for img in imgs], axis=1)
+    os.makedirs(out_dir, exist_ok=True)
+    out_files = []
+    for hemi in hemis:
+        values = vertex_voxel_matrix(sub, hemi, imgs[0], projfrac, subjects_dir) @ data # vertices x maps
+        for i, out_name in enumerate(out_names):
+            out_file = op.join(out_dir, f"{hemi}.{out_name}.mgz")
+            nib.save(nib.MGHImage(values[:, i].reshape(-1, 1, 1).astype(np.float32), np.eye(4)), out_file)
+            out_files.append(out_file)
+    return out_files
+
+
+## FreeSurfer labels to volumes
+def read_register_dat(reg_file):
+    """4x4 matrix of a tkregister register.dat (surface RAS -> template tkregister RAS), as mri_label2vol --reg takes"""
+    with open(reg_file) as f:
+        lines = [line.split() for line in f if line.strip()]
+    return np.array([[float(v) for v in line] for line in lines[4:8]])
+
+
+def tkr_vox2ras(img):
+    """FreeSurfer's tkregister vox2ras of an image of any format, as mri_label2vol uses for its template"""
+    shape, zooms = img.shape[:3], img.header.get_zooms()[:3]
+    return np.array([[-zooms[0], 0, 0, zooms[0] * shape[0] / 2],
+                     [0, 0, zooms[2], -zooms[2] * shape[2] / 2],
+                     [0, -zooms[1], 0, zooms[1] * shape[1] / 2],
+                     [0, 0, 0, 1]])
+
+
+@lru_cache(maxsize=4)
+def _ribbon_voxels(sub, hemi, subjects_dir, ref_grid, surf2vox, fracs, surf_mtimes):
+    ref_shape = ref_grid[0]
+    surf2vox = np.reshape(surf2vox, (4, 4))
+    white, pial = white_pial(sub, hemi, subjects_dir)
+    voxels = np.full((len(white), len(fracs)), -1, dtype=np.int64)
+    for i, frac in enumerate(fracs):
+        ijk = np.rint((white + frac * (pial - white)) @ surf2vox[:3, :3].T + surf2vox[:3, 3]).astype(np.int64)
+        inside = np.all((ijk >= 0) & (ijk < np.array(ref_shape)), axis=1)
+        voxels[inside, i] = np.ravel_multi_index(tuple(ijk[inside].T), ref_shape)
+    return voxels
+
+
+def ribbon_voxels(sub, hemi, template_img, reg_mat='identity', fracs=PROJ_FRACS, subjects_dir=None):
+    """(vertices x fracs) flat indices into template_img of the points fracs of the way from each vertex of
+    hemi.white to hemi.pial (-1 outside the template), with mri_label2vol's --identity or --reg reg_mat.
+    Cached for the last few subjects/hemispheres/templates, and remade if the surfaces change."""
+    template_img = nib.load(template_img) if isinstance(template_img, str) else template_img
+    subjects_dir = subjects_dir or os.environ['SUBJECTS_DIR']
+    surf2tkr = np.eye(4) if reg_mat == 'identity' else read_register_dat(reg_mat)
+    surf2vox = np.linalg.inv(tkr_vox2ras(template_img)) @ surf2tkr
+    return _ribbon_voxels(sub, hemi, subjects_dir, grid(template_img), tuple(surf2vox.ravel()), tuple(fracs),
+                          _surf_mtimes(sub, hemi, subjects_dir))
+
+
+def swapdim_x_z_negy(data, affine):
+    """data and affine reoriented as by fslswapdim x z -y (the same world coordinates for every voxel)"""
+    ny = data.shape[1]
+    swapped = np.flip(np.transpose(data, (0, 2, 1)), axis=2)
+    new2old = np.array([[1, 0, 0, 0], [0, 0, -1, ny - 1], [0, 1, 0, 0], [0, 0, 0, 1]], dtype=float)
+    return np.ascontiguousarray(swapped), affine @ new2old
+
+
+@profiling.traced
+def labels_to_volumes(label_fns, sub, hemis, template_fn, out_fns, reg_mat='identity', subjects_dir=None):
+    """Volumes (1 in the label, 0 elsewhere) of FreeSurfer labels on template_fn's grid, like
+    mri_label2vol --proj frac 0 1 .1 followed by fslswapdim x z -y, saved as out_fns.
+
+    A voxel is in a label if the ribbon of any of its vertices, from white to pial, crosses it.
+    The ribbons are computed once per hemisphere for all the labels. Returns out_fns."""
+    template_img = nib.load(template_fn)
+    shape = template_img.shape[:3]
+    for label_fn, hemi, out_fn in zip(label_fns, hemis, out_fns):
+        voxels = ribbon_voxels(sub, hemi, template_img, reg_mat, subjects_dir=subjects_dir)
+        label_voxels = voxels[nib.freesurfer.read_label(label_fn)].ravel()
+        mask = np.zeros(int(np.prod(shape)), dtype=np.uint8)
+        mask[label_voxels[label_voxels >= 0]] = 1
+        data, affine = swapdim_x_z_negy(mask.reshape(shape), template_img.affine)
+        os.makedirs(op.dirname(op.abspath(out_fn)), exist_ok=True)
+        nib.save(nib.Nifti1Image(data, affine), out_fn)
+    return out_fns
@@ -0,0 +1,8 @@
+# The project's modules live directly in glm_code/ and are imported by name, as the scripts
+# and notebooks there do, so the tests put that directory on the path. Run from glm_code/:
+#   python -m pytest tests
+
+import sys
+import os.path as op
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
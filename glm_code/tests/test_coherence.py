@@ -0,0 +1,59 @@
+# band_coherence against nitime: SeedCoherenceAnalyzer (Welch), the reference it replaces,
+# and multi_taper_csd for the multitaper method
+
+import numpy as np
+import pytest
+
+import coherence
+
+nitime = pytest.importorskip('nitime')
+import nitime.timeseries as ts
+import nitime.analysis as nta
+import nitime.algorithms as tsa
+
+TR = 2.
+F_LB, F_UB = 0.01, 0.15
+
+
+def make_data(n_times=200):
+    # targets lag the first seed by 2 TRs, so the relative phases are far from 0
+    rng = np.random.default_rng(0)
+    seed = rng.standard_normal((2, n_times))
+    target = np.vstack([np.roll(seed[0], 2) + 0.5 * rng.standard_normal(n_times) for _ in range(5)])
+    return seed, target
+
+
+@pytest.mark.parametrize('method', [None, {'this_method': 'welch', 'NFFT': 32}])
+@pytest.mark.parametrize('n_seeds', [1, 2])
+def test_matches_nitime(method, n_seeds):
+    seed, target = make_data()
+    seed = seed[0] if n_seeds == 1 else seed
+    analyzer = nta.SeedCoherenceAnalyzer(ts.TimeSeries(seed, sampling_rate=1 / TR),
+                                         ts.TimeSeries(target, sampling_rate=1 / TR), method=method)
+    band = (analyzer.frequencies > F_LB) & (analyzer.frequencies < F_UB)
+
+    result = coherence.band_coherence(seed, target, 1 / TR, F_LB, F_UB, method)
+
+    np.testing.assert_allclose(result.frequencies, analyzer.frequencies[band])
+    np.testing.assert_allclose(result.coherence, analyzer.coherence[..., band], atol=1e-10)
+    # compare the phases on the circle
+    phase_diff = np.angle(np.exp(1j * (result.relative_phases - analyzer.relative_phases[..., band])))
+    np.testing.assert_allclose(phase_diff, 0, atol=1e-10)
+    assert np.abs(result.relative_phases).max() > 0.1
+
+
+@pytest.mark.parametrize('NW', [2, 4])
+def test_multitaper_matches_nitime(NW):
+    seed, target = make_data(n_times=128) # even, as nitime's onesided frequencies assume
+    freqs, csd = tsa.multi_taper_csd(np.vstack([seed[0], target]), Fs=1 / TR, NW=NW)
+    band = (freqs > F_LB) & (freqs < F_UB)
+    seed_csd = csd[0, 1:][:, band] # targets x frequencies
+    psd = np.diagonal(csd).T.real[:, band] # seed and targets x frequencies
+    nitime_coherence = np.abs(seed_csd)**2 / (psd[0] * psd[1:])
+
+    result = coherence.band_coherence(seed[0], target, 1 / TR, F_LB, F_UB, {'this_method': 'multi_taper_csd', 'NW': NW})
+
+    np.testing.assert_allclose(result.frequencies, freqs[band])
+    np.testing.assert_allclose(result.coherence, nitime_coherence, atol=1e-10)
+    phase_diff = np.angle(np.exp(1j * (result.relative_phases - np.angle(seed_csd))))
+    np.testing.assert_allclose(phase_diff, 0, atol=1e-10)
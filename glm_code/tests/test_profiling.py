@@ -0,0 +1,53 @@
+# profiling's per-command measures: commands run concurrently by run_commands' threads each get
+# their own CPU time, not the whole process's
+
+import sys
+import threading
+
+import pytest
+
+import profiling
+
+BUSY = f"{sys.executable} -c 'import time; t = time.process_time()\nwhile time.process_time() - t < {{}}: pass'"
+
+
+@pytest.fixture
+def trace_dir(tmp_path):
+    out_dir = profiling.start_trace(str(tmp_path / 'trace'))
+    yield out_dir
+    profiling.stop_trace()
+
+
+def test_run_process():
+    returncode, stdout, stderr, measured = profiling.run_process("echo out; echo err >&2; exit 3")
+    assert (returncode, stdout, stderr) == (3, 'out\n', 'err\n')
+    assert measured['children_cpu_s'] >= 0 and measured['peak_rss_mb'] > 0
+
+
+def test_concurrent_commands(trace_dir):
+    utils = pytest.importorskip('utils')
+    steps = [utils.command(BUSY.format(seconds)) for seconds in (0.2, 0.8)]
+    with profiling.trace('batch'):
+        assert list(utils.run_commands(steps, n_procs=2)['status']) == ['ran', 'ran']
+
+    records = profiling.load_trace(trace_dir)
+    commands = sorted((r for r in records if r['kind'] == 'command'), key=lambda r: r['children_cpu_s'])
+    for command, seconds in zip(commands, (0.2, 0.8)):
+        assert seconds <= command['children_cpu_s'] < seconds + 0.5 # interpreter startup, not the other command's
+        assert command['cpu_s'] < 0.1
+    # the span of the main thread holds both
+    batch, = [r for r in records if r['name'] == 'batch']
+    assert batch['children_cpu_s'] >= 1.
+
+
+def test_worker_thread_span_unattributed(trace_dir):
+    def work():
+        with profiling.trace('worker'):
+            pass
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+
+    record, = profiling.load_trace(trace_dir)
+    assert record['wall_s'] >= 0
+    assert all(record[field] is None for field in ('cpu_s', 'children_cpu_s', 'peak_rss_mb', 'read_mb'))
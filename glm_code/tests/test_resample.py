@@ -0,0 +1,75 @@
+# resample.apply_xfm against what flirt -applyxfm does with the same matrices: FSL's scaled voxel
+# coordinates, x flipped for images in neurological order, and a source -> reference matrix
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+import resample
+
+SHAPE = (6, 5, 4)
+ZOOMS = (2., 2., 2.)
+
+
+def make_img(tmp_path, name, neurological=True, data=None):
+    affine = np.diag([*ZOOMS, 1.])
+    if not neurological: # radiological: x index increases to the left
+        affine[0, 0] = -ZOOMS[0]
+    if data is None:
+        data = np.random.default_rng(0).random(SHAPE).astype(np.float32)
+    fn = str(tmp_path / f"{name}.nii.gz")
+    nib.save(nib.Nifti1Image(data, affine), fn)
+    return fn, data
+
+
+def translation(x=0., y=0., z=0.):
+    xfm = np.eye(4)
+    xfm[:3, 3] = x, y, z
+    return xfm
+
+
+def resampled(tmp_path, in_file, xfm, interp):
+    out_file = str(tmp_path / f"out_{interp}.nii.gz")
+    resample.apply_xfm(in_file, in_file, xfm, out_file, interp=interp)
+    return np.asarray(nib.load(out_file).dataobj)
+
+
+@pytest.mark.parametrize('interp', ['nearest', 'trilinear'])
+def test_identity(tmp_path, interp):
+    in_file, data = make_img(tmp_path, 'in')
+    mat_file = str(tmp_path / 'identity.mat')
+    np.savetxt(mat_file, np.eye(4))
+    np.testing.assert_allclose(resampled(tmp_path, in_file, mat_file, interp), data, atol=1e-6)
+
+
+@pytest.mark.parametrize('interp', ['nearest', 'trilinear'])
+@pytest.mark.parametrize('neurological', [True, False])
+def test_translation(tmp_path, interp, neurological):
+    # +1 voxel along FSL's scaled x, which runs against the voxel index in neurological images
+    in_file, data = make_img(tmp_path, 'in', neurological)
+    out = resampled(tmp_path, in_file, translation(x=ZOOMS[0]), interp)
+    shift = -1 if neurological else 1
+    expected = np.zeros_like(data)
+    if shift > 0:
+        expected[1:] = data[:-1]
+    else:
+        expected[:-1] = data[1:]
+    # trilinear samples at grid points exactly, and reference voxels outside the source are 0
+    np.testing.assert_allclose(out, expected, atol=1e-6)
+
+
+def test_translation_yz(tmp_path):
+    in_file, data = make_img(tmp_path, 'in')
+    out = resampled(tmp_path, in_file, translation(y=ZOOMS[1], z=-2 * ZOOMS[2]), 'trilinear')
+    expected = np.zeros_like(data)
+    expected[:, 1:, :-2] = data[:, :-1, 2:]
+    np.testing.assert_allclose(out, expected, atol=1e-6)
+
+
+def test_trilinear_half_voxel(tmp_path):
+    # halfway between grid points, trilinear averages the neighbours along the shifted axis
+    in_file, data = make_img(tmp_path, 'in')
+    out = resampled(tmp_path, in_file, translation(z=-ZOOMS[2] / 2), 'trilinear')
+    np.testing.assert_allclose(out[:, :, :-1], (data[:, :, :-1] + data[:, :, 1:]) / 2, atol=1e-6)
+    np.testing.assert_array_equal(out[:, :, -1], 0)
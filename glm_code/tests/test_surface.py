@@ -0,0 +1,148 @@
+# surface.py on a synthetic FreeSurfer subject: the --regheader mapping of vol2surf (orig vox2ras @
+# inv(tkregister vox2ras)), and labels_to_volumes' rasterization and fslswapdim x z -y reorientation
+
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+import surface
+
+SUB = 'sub-test'
+# orig.mgz: 1mm conformed, its center away from scanner 0 so that surface and scanner RAS differ
+ORIG_SHAPE = (32, 32, 32)
+ORIG_AFFINE = np.array([[-1., 0, 0, 20], [0, 0, 1, -10], [0, -1, 0, 30], [0, 0, 0, 1]])
+# reference/template volume: 2mm, neurological
+REF_SHAPE = (10, 12, 8)
+REF_AFFINE = np.array([[2., 0, 0, -8], [0, 2, 0, -40], [0, 0, 2, 0], [0, 0, 0, 1]])
+TRIANGLES = np.array([[0, 1, 2]], dtype=np.int32)
+
+
+@pytest.fixture
+def subjects_dir(tmp_path):
+    (tmp_path / SUB / 'mri').mkdir(parents=True)
+    (tmp_path / SUB / 'surf').mkdir()
+    nib.save(nib.MGHImage(np.zeros(ORIG_SHAPE, dtype=np.uint8), ORIG_AFFINE), str(tmp_path / SUB / 'mri' / 'orig.mgz'))
+    return str(tmp_path)
+
+
+def scanner_to_surface(subjects_dir):
+    orig = nib.load(f"{subjects_dir}/{SUB}/mri/orig.mgz")
+    return orig.header.get_vox2ras_tkr() @ np.linalg.inv(orig.header.get_vox2ras())
+
+
+def write_surfaces(subjects_dir, hemi, white, pial):
+    for name, coords in (('white', white), ('pial', pial)):
+        nib.freesurfer.write_geometry(f"{subjects_dir}/{SUB}/surf/{hemi}.{name}", np.asarray(coords, dtype=float), TRIANGLES)
+
+
+def write_label(label_fn, vertices, coords):
+    """FreeSurfer ascii label file"""
+    with open(label_fn, 'w') as f:
+        f.write(f"#!ascii label\n{len(vertices)}\n")
+        for vertex, (x, y, z) in zip(vertices, coords):
+            f.write(f"{vertex} {x:.3f} {y:.3f} {z:.3f} 0.0\n")
+
+
+def ref_voxels_to_surface(subjects_dir, ijk, affine=REF_AFFINE):
+    xyz = np.c_[np.asarray(ijk, dtype=float), np.ones(len(ijk))] @ affine.T
+    return (xyz @ scanner_to_surface(subjects_dir).T)[:, :3]
+
+
+def test_surface_to_scanner(subjects_dir):
+    # the orig volume's corner voxel, through its tkregister vox2ras and back to scanner RAS
+    orig = nib.load(f"{subjects_dir}/{SUB}/mri/orig.mgz")
+    surf_ras = orig.header.get_vox2ras_tkr() @ [0, 0, 0, 1]
+    np.testing.assert_allclose(surface.surface_to_scanner(SUB, subjects_dir) @ surf_ras, ORIG_AFFINE @ [0, 0, 0, 1])
+
+
+def test_vertex_voxel_matrix(subjects_dir):
+    # vertices 0 and 1 lie halfway between white and pial in the centers of known reference voxels,
+    # vertex 2 outside the reference volume
+    ijk = np.array([[1, 2, 3], [7, 0, 5], [40, 3, 3]])
+    mid = ref_voxels_to_surface(subjects_dir, ijk)
+    offset = np.array([0.3, -0.6, 0.9])
+    write_surfaces(subjects_dir, 'lh', mid - offset, mid + offset)
+    ref_img = nib.Nifti1Image(np.zeros(REF_SHAPE, dtype=np.float32), REF_AFFINE)
+
+    matrix = surface.vertex_voxel_matrix(SUB, 'lh', ref_img, subjects_dir=subjects_dir).toarray()
+
+    assert matrix.shape == (3, np.prod(REF_SHAPE))
+    for vertex in (0, 1):
+        np.testing.assert_array_equal(np.flatnonzero(matrix[vertex]), [np.ravel_multi_index(tuple(ijk[vertex]), REF_SHAPE)])
+    assert matrix[2].sum() == 0
+
+
+def test_vol2surf(subjects_dir, tmp_path):
+    ijk = np.array([[1, 2, 3], [7, 0, 5], [4, 11, 7]])
+    mid = ref_voxels_to_surface(subjects_dir, ijk)
+    for hemi in surface.HEMIS:
+        write_surfaces(subjects_dir, hemi, mid, mid)
+    data = np.random.default_rng(0).random(REF_SHAPE).astype(np.float32)
+    in_file = str(tmp_path / 'map.nii.gz')
+    nib.save(nib.Nifti1Image(data, REF_AFFINE), in_file)
+
+    out_files = surface.vol2surf(in_file, SUB, 'desc-test', str(tmp_path / 'out'), subjects_dir=subjects_dir)
+
+    assert [f.split('/')[-1] for f in out_files] == ['lh.desc-test.mgz', 'rh.desc-test.mgz']
+    np.testing.assert_allclose(np.asarray(nib.load(out_files[0]).dataobj).ravel(), data[tuple(ijk.T)])
+
+
+def test_tkr_vox2ras():
+    # as FreeSurfer computes it for the orig volume
+    orig = nib.MGHImage(np.zeros((16, 20, 24), dtype=np.uint8), np.diag([1.5, 2., 2.5, 1.]))
+    nifti = nib.Nifti1Image(np.zeros((16, 20, 24), dtype=np.uint8), np.diag([1.5, 2., 2.5, 1.]))
+    np.testing.assert_allclose(surface.tkr_vox2ras(nifti), orig.header.get_vox2ras_tkr())
+
+
+def test_swapdim_x_z_negy():
+    data = np.random.default_rng(0).random((3, 4, 5))
+    swapped, affine = surface.swapdim_x_z_negy(data, REF_AFFINE)
+    assert swapped.shape == (3, 5, 4)
+    # every voxel keeps its value and its world coordinates
+    for ijk in np.ndindex(*data.shape):
+        new_ijk = (ijk[0], ijk[2], data.shape[1] - 1 - ijk[1])
+        assert swapped[new_ijk] == data[ijk]
+        np.testing.assert_allclose(affine @ [*new_ijk, 1], REF_AFFINE @ [*ijk, 1])
+
+
+def test_labels_to_volumes(subjects_dir, tmp_path):
+    template = nib.Nifti1Image(np.zeros(REF_SHAPE, dtype=np.float32), REF_AFFINE)
+    template_fn = str(tmp_path / 'template.nii.gz')
+    nib.save(template, template_fn)
+    # with --identity, surface RAS is the template's tkregister RAS: vertex 0 runs from white in voxel
+    # (2, 3, 4) to pial in (2, 5, 4), vertex 1 (not in the label) sits in (6, 6, 6)
+    tkr = surface.tkr_vox2ras(template)
+    ijk = np.array([[2, 3, 4], [2, 5, 4], [6, 6, 6], [6, 6, 6]], dtype=float)
+    xyz = (np.c_[ijk, np.ones(4)] @ tkr.T)[:, :3]
+    write_surfaces(subjects_dir, 'lh', xyz[[0, 2, 2]], xyz[[1, 3, 3]])
+    label_fn = str(tmp_path / 'lh.test.label')
+    write_label(label_fn, [0], xyz[[0]])
+    out_fn = str(tmp_path / 'out' / 'lh.test.nii.gz')
+
+    surface.labels_to_volumes([label_fn], SUB, ['lh'], template_fn, [out_fn], subjects_dir=subjects_dir)
+
+    out_img = nib.load(out_fn)
+    out = np.asarray(out_img.dataobj)
+    # the label's ribbon crosses (2, 3..5, 4) of the template, which fslswapdim x z -y moves to (2, 4, ny-1-j)
+    expected = np.zeros(REF_SHAPE, dtype=np.uint8)
+    expected[2, 3:6, 4] = 1
+    expected_swapped, expected_affine = surface.swapdim_x_z_negy(expected, REF_AFFINE)
+    np.testing.assert_array_equal(out, expected_swapped)
+    np.testing.assert_allclose(out_img.affine, expected_affine)
+    assert out[2, 4, REF_SHAPE[1] - 1 - 4] == 1 and out.sum() == 3
+
+
+def test_ribbon_voxels_register_dat(subjects_dir, tmp_path):
+    # --reg register.dat: surface RAS -> template tkregister RAS, here a 2mm (one voxel) shift along tkregister x
+    template = nib.Nifti1Image(np.zeros(REF_SHAPE, dtype=np.float32), REF_AFFINE)
+    xyz = (surface.tkr_vox2ras(template) @ [5, 5, 5, 1])[:3]
+    write_surfaces(subjects_dir, 'lh', [xyz] * 3, [xyz] * 3)
+    reg_file = str(tmp_path / 'register.dat')
+    with open(reg_file, 'w') as f:
+        f.write(f"{SUB}\n2.0\n2.0\n0.15\n1 0 0 2\n0 1 0 0\n0 0 1 0\n0 0 0 1\nround\n")
+
+    voxels = surface.ribbon_voxels(SUB, 'lh', template, reg_file, subjects_dir=subjects_dir)
+
+    # tkregister x runs against the voxel index (-zooms[0] in tkr_vox2ras)
+    np.testing.assert_array_equal(voxels, np.ravel_multi_index((4, 5, 5), REF_SHAPE))
@@ -0,0 +1,52 @@
+# utils helpers that run without FSL/FreeSurfer/nipype: make_func_parc_mask (native engine), read_glm_manifest
+
+import os
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+
+import utils
+
+
+@pytest.fixture
+def parc_files(tmp_path):
+    ribbon = np.zeros((6, 5, 4), dtype=np.uint8)
+    ribbon[1, 1, 1], ribbon[4, 3, 2] = 3, 42
+    ribbon_nii = str(tmp_path / 'ribbon.nii.gz')
+    nib.save(nib.Nifti1Image(ribbon, np.diag([2., 2., 2., 1.])), ribbon_nii)
+    xfm = str(tmp_path / 'T1w2func.mat')
+    np.savetxt(xfm, np.eye(4))
+    out_fn = str(tmp_path / 'sub-01_space-func_desc-cortex_mask.nii.gz')
+    return ribbon_nii, ribbon_nii, out_fn, xfm # the ribbon as its own functional reference
+
+
+def test_make_func_parc_mask(parc_files):
+    ribbon_nii, ref, out_fn, xfm = parc_files
+    assert utils.make_func_parc_mask(ribbon_nii, [3, 42], ref, out_fn, xfm) == [out_fn]
+    data = np.asarray(nib.load(out_fn).dataobj)
+    assert data.dtype == np.float32 and data.sum() == 2 and data[1, 1, 1] == 1
+
+    # up to date: skipped, same return value
+    mtime = os.stat(out_fn).st_mtime_ns
+    assert utils.make_func_parc_mask(ribbon_nii, [42, 3], ref, out_fn, xfm) == [out_fn]
+    assert os.stat(out_fn).st_mtime_ns == mtime
+
+    # other codes: remade
+    utils.make_func_parc_mask(ribbon_nii, [42], ref, out_fn, xfm)
+    data = np.asarray(nib.load(out_fn).dataobj)
+    assert data.sum() == 1 and data[4, 3, 2] == 1
+
+
+def test_read_glm_manifest(tmp_path):
+    manifest = tmp_path / 'manifest.tsv'
+    manifest.write_text("sub\tses\ttask\truns\ttrim_idxs\traw_data_dir\tout_dir\n"
+                        "01\t1\tmp\t[1, 2]\t(4, 0)\t/raw\t/out\n"
+                        "01\t2\themi\t[3]\t\t/raw\t/out\n")
+    jobs = utils.read_glm_manifest(str(manifest))
+    assert jobs[0]['runs'] == [1, 2] and jobs[0]['trim_idxs'] == (4, 0)
+    assert 'trim_idxs' not in jobs[1] # run_fixedeffects_glm uses the task's defaults
+
+    with pytest.raises(ValueError, match=r"Row 1 .* missing out_dir"):
+        utils.read_glm_manifest([{'sub': '01', 'ses': '1', 'task': 'mp', 'raw_data_dir': '/raw', 'out_dir': '/out'},
+                                 {'sub': '01', 'ses': '2', 'task': 'mp', 'raw_data_dir': '/raw', 'out_dir': ''}])
@@ -0,0 +1,218 @@
+# Timeseries, seed coherence and pRF input helpers for the LGN-cortical coupling (aka streams) project
+#
+# Split out of utils.py, which imports them lazily, as nilearn and nitime take seconds to import.
+
+from functools import lru_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+import nibabel as nib
+
+from nilearn.image import get_data, load_img, new_img_like
+from nilearn.input_data import NiftiMasker
+
+import nitime.timeseries as ts
+import nitime.analysis as nta
+
+from ts_cache import cached_transform
+from image_utils import roi_bbox, crop_img
+import profiling
+
+## Functions for dealing with timeseries and doing coherence analysis
+def _update_mean(mean, data, n):
+    """In-place update of a running mean (array or view) with its n-th sample (n counts from 1)"""
+    mean += (data - mean) / n
+
+@profiling.traced
+def average_timeseries(bolds, masker, dtype=np.float64, split_odd_even=False):
+    """Given a list of bold file names and a NiftiMasker that has already been fit,
+    compute the mean across runs of the bold timeseries and return it
+
+    Runs are added to a running mean one at a time, so only one run is held in memory.
+    split_odd_even: return the means of bolds[::2] and bolds[1::2] instead, from the same pass"""
+    means = {}
+    counts = {}
+    for i, bold_file in enumerate(bolds):
+        masked_bold_nm = cached_transform(masker, bold_file)
+        group = i % 2 if split_odd_even else 0
+        if group not in means:
+            means[group] = np.zeros(masked_bold_nm.shape, dtype=dtype)
+            counts[group] = 0
+        counts[group] += 1
+        print(i, masked_bold_nm.shape, masked_bold_nm.dtype)
+        _update_mean(means[group], masked_bold_nm, counts[group])
+    if split_odd_even:
+        return means[0], means.get(1)
+    return means[0]
+
+@profiling.traced
+def get_timeseries_from_file(bold, mask, TR, bbox=None, load=None, **kwargs):
+    """
+    Given a bold file and roi mask, return a nitime TimeSeries object
+
+    The masked data are read from / stored in the timeseries cache (see ts_cache.py).
+    bbox: only read this bounding box of the bold (e.g. roi_bbox of a small seed mask); the masker
+          is then fit on the cropped mask. The filtering is voxelwise, so the timeseries are the same.
+    load: function returning the bold already read in, used instead of reading it on a cache miss
+    """
+    if bbox is not None:
+        mask = crop_img(mask, bbox)
+    masker = NiftiMasker(mask_img=mask, t_r=TR, **kwargs).fit()
+    return masker, ts.TimeSeries(data=cached_transform(masker, bold, bbox=bbox, load=load).T, sampling_interval=TR)
+
+@profiling.traced
+def seed_coherence_timeseries(seed_ts, target_ts, f_ub, f_lb, method=dict(NFFT=32), engine='fft'):
+    """Coherence between a seed and each target voxel (nitime TimeSeries), averaged over f_lb < f < f_ub.
+
+    engine: 'fft' computes only the band of interest for all voxels at once (see coherence.py)
+            and returns a BandCoherence with frequencies/coherence/relative_phases limited to the band,
+            'nitime' uses nta.SeedCoherenceAnalyzer over all frequencies."""
+    if engine == 'fft':
+        from coherence import band_coherence
+        conn_analyzer = band_coherence(seed_ts.data, target_ts.data, float(seed_ts.sampling_rate),
+                                       f_lb, f_ub, method=method)
+    elif engine == 'nitime':
+        conn_analyzer = nta.SeedCoherenceAnalyzer(seed_ts, target_ts, method=method)
+    else:
+        raise ValueError(f"Unknown coherence engine {engine}, must be 'fft' or 'nitime'")
+    freq_idx = np.where((conn_analyzer.frequencies > f_lb) * (conn_analyzer.frequencies < f_ub))[0]
+    logger.debug(f"Seed timeseries has shape: {seed_ts.shape}\nLooking at freq bins centered on: {conn_analyzer.frequencies[freq_idx]}")
+    # mean coherence across voxels in each freq bin
+    mean_coh = np.mean(conn_analyzer.coherence, axis=0)
+    # mean coherence across voxels in freq bins of interest
+    mean_coh_bandpass = np.mean(mean_coh[freq_idx])
+    # coherence in freq band of interest for each voxel
+    coh_by_voxel = np.mean(conn_analyzer.coherence[:, freq_idx], axis=1)
+    phase_by_voxel = np.mean(conn_analyzer.relative_phases[:, freq_idx], axis=1)
+
+    # plots of interest
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(3, figsize=(10, 12))
+    ax[0].set_title("Mean coherence with seed across voxels at different frequencies")
+    if len(seed_ts.shape) > 1:
+        ax[0].plot(conn_analyzer.frequencies, np.mean(mean_coh, axis=0))
+    else:
+        ax[0].plot(conn_analyzer.frequencies, mean_coh)
+    ax[0].axvline(x=f_lb)
+    ax[0].axvline(x=f_ub)
+    ax[0].set_xlabel("Frequency (Hz)")
+    ax[0].set_ylabel("Coherence")
+
+    # ax[1].set_title("Coherence of each voxel with seed at different frequencies")
+    # for i in range(conn_analyzer.coherence.shape[0]):
+    #     ax[1].plot(conn_analyzer.frequencies, conn_analyzer.coherence[i, :])
+    # ax[1].axvline(x=f_lb)
+    # ax[1].axvline(x=f_ub)
+    # ax[1].set_xlabel("Frequency (Hz)")
+    # ax[1].set_ylabel("Coherence")
+
+    ax[1].set_title(f"Histogram of voxel coherence values within band {f_lb} < f < {f_ub} (N={coh_by_voxel.shape[0]})")
+    ax[1].hist(coh_by_voxel)
+    ax[1].set_xlabel("Coherence")
+    ax[1].set_ylabel("# voxels")
+
+    ax[2].set_title(f"Histogram of voxel phase values within band {f_lb} < f < {f_ub} (N={coh_by_voxel.shape[0]})")
+    ax[2].hist(phase_by_voxel)
+    ax[2].set_xlabel("Relative phase")
+    ax[2].set_ylabel("# voxels")
+
+    plt.subplots_adjust(hspace=.3)
+    plt.show()
+    plt.close('all')
+    logger.debug((f"seed_ts: {seed_ts.data.shape}\n"
+        f"target_ts: {target_ts.data.shape}\n{conn_analyzer.coherence.shape}\n{conn_analyzer.relative_phases.shape},"
+        f"{mean_coh.shape}, {mean_coh_bandpass.shape}, {coh_by_voxel.shape}"))
+    return conn_analyzer, (coh_by_voxel, phase_by_voxel)
+
+@profiling.traced
+def seed_coherence_analysis(bold, mask, seed_roi, TR, f_ub, f_lb, mean_seed=True, method=dict(NFFT=32), engine='fft'):
+    """
+    Given a bold file, brainmask, and seed ROI mask, do a seed coherence analysis.
+    """
+    logger.debug(f"bold: {bold}\nmask: {mask}\nseed_roi: {seed_roi}")
+    target_masker, target_ts = get_timeseries_from_file(bold, mask, TR, detrend=False, standardize=False, high_pass=f_lb, low_pass=f_ub)
+    # the seed is small, so only its bounding box of the bold is read (the filtering is voxelwise)
+    seed_masker, seed_ts = get_timeseries_from_file(bold, seed_roi, TR, bbox=roi_bbox(seed_roi),
+                                                    detrend=False, standardize=False, high_pass=f_lb, low_pass=f_ub)
+
+    if mean_seed:
+        seed_ts = ts.TimeSeries(data=np.mean(seed_ts.data, axis=0), sampling_interval=TR)
+
+    conn_analyzer, (coh_by_voxel, phase_by_voxel) = seed_coherence_timeseries(seed_ts, target_ts, f_ub, f_lb, method, engine)
+
+    logger.debug("seed_coherence_analysis() about to return...")
+    return conn_analyzer, target_masker, coh_by_voxel, phase_by_voxel
+
+@profiling.traced
+def multi_seed_coherence_analysis(bold, mask, seed_rois, TR, f_ub, f_lb, mean_seed=True, method=dict(NFFT=32)):
+    """
+    Seed coherence analysis for several seed ROI masks (e.g. L/R LGN and their M/P subdivisions) with one bold file.
+
+    The target and seed timeseries are read from the timeseries cache (see get_timeseries_from_file),
+    and the bold is decompressed at most once, for the ones not cached yet. The target spectra are
+    computed once for all seeds together (see coherence.band_coherence).
+
+    Returns the BandCoherence, the target masker, the (seeds x voxels) coherence and phase averaged
+    over f_lb < f < f_ub, and for each seed row the index into seed_rois it came from
+    (one row per roi if mean_seed, otherwise one row per seed voxel).
+    """
+    from coherence import band_coherence
+
+    logger.debug(f"bold: {bold}\nmask: {mask}\nseed_rois: {seed_rois}")
+    @lru_cache(maxsize=1)
+    def load_bold():
+        # read the data in once, for all the maskers whose timeseries are not cached
+        bold_img = load_img(bold)
+        return new_img_like(bold_img, get_data(bold_img), copy_header=True)
+
+    filter_kwargs = dict(detrend=False, standardize=False, high_pass=f_lb, low_pass=f_ub)
+    target_masker, target_ts = get_timeseries_from_file(bold, mask, TR, load=load_bold, **filter_kwargs)
+
+    seeds = []
+    seed_labels = []
+    for i, seed_roi in enumerate(seed_rois):
+        _, seed_ts = get_timeseries_from_file(bold, seed_roi, TR, bbox=roi_bbox(seed_roi), load=load_bold, **filter_kwargs)
+        seed_data = np.mean(seed_ts.data, axis=0, keepdims=True) if mean_seed else seed_ts.data
+        seeds.append(seed_data)
+        seed_labels.extend([i] * seed_data.shape[0])
+
+    conn_analyzer = band_coherence(np.concatenate(seeds), target_ts.data, 1. / TR, f_lb, f_ub, method=method)
+    coh_by_seed_voxel = np.mean(conn_analyzer.coherence, axis=-1)
+    phase_by_seed_voxel = np.mean(conn_analyzer.relative_phases, axis=-1)
+    logger.debug(f"Coherence of {len(seed_labels)} seeds with {target_ts.data.shape[0]} voxels "
+                 f"at {conn_analyzer.frequencies} Hz")
+    return conn_analyzer, target_masker, coh_by_seed_voxel, phase_by_seed_voxel, np.array(seed_labels)
+
+
+## Functions for pRF
+@profiling.traced
+def make_timeseries_for_prf(bolds, n_vols=138, dtype=np.float32, slab_size=None, split_odd_even=False):
+    """Takes a list of 4d nifti filenames, averages, cuts extra timepoints
+
+    Runs are read one at a time (or slab_size slices at a time through nibabel's array proxy,
+    which avoids holding a whole run for uncompressed .nii files) into a running mean,
+    so memory use is one output volume regardless of the number of runs.
+    dtype: of the accumulated mean, np.float64 doubles the memory needed
+    split_odd_even: return the means of bolds[::2] and bolds[1::2] instead, from the same pass"""
+    means = {}
+    counts = {}
+    for i, bold_file in enumerate(bolds):
+        img = nib.load(bold_file)
+        print(img.shape)
+        shape = (*img.shape[:3], min(n_vols, img.shape[3]))
+        group = i % 2 if split_odd_even else 0
+        if group not in means:
+            means[group] = np.zeros(shape, dtype=dtype)
+            counts[group] = 0
+        counts[group] += 1
+        step = shape[2] if slab_size is None else slab_size
+        for z in range(0, shape[2], step):
+            slab = np.asarray(img.dataobj[:, :, z:z+step, :shape[3]], dtype=dtype)
+            _update_mean(means[group][:, :, z:z+step], slab, counts[group])
+        img.uncache()
+    mean_imgs = [nib.Nifti1Image(means[g], img.affine) for g in sorted(means)]
+    if split_odd_even:
+        return tuple(mean_imgs)
+    return mean_imgs[0]
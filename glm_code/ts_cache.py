@@ -0,0 +1,109 @@
+# On-disk cache of masked timeseries for the LGN-cortical coupling (aka streams) project
+#
+# The timeseries helpers in utils.py run NiftiMasker over the same multi-hundred-MB .nii.gz
+# bolds over and over, re-decompressing them every time. Here the (time x voxels) result of
+# each masker/bold combination is stored as an uncompressed .npy file, keyed by the bold path
+# and mtime (and the bounding box, for seeds read from a crop of the bold), a hash of the mask and
+# the masker's filtering parameters (t_r included), and memory-mapped on the next read. The least recently used entries are removed once the
+# cache grows beyond its disk budget.
+
+import os
+import os.path as op
+import hashlib
+
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.environ.get('STREAMS_TS_CACHE_DIR',
+                                   op.join(op.expanduser('~'), '.cache', 'streams', 'timeseries'))
+DEFAULT_MAX_BYTES = int(float(os.environ.get('STREAMS_TS_CACHE_GB', 20)) * 1024**3)
+
+# masker parameters that do not affect the extracted values
+_IGNORED_PARAMS = ('mask_img', 'memory', 'memory_level', 'verbose', 'reports')
+
+
+def _hash_img(img):
+    """Hash of the data and affine of an (in-memory or on-disk) image"""
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(np.asanyarray(img.dataobj)).tobytes())
+    h.update(np.ascontiguousarray(img.affine).tobytes())
+    return h.hexdigest()
+
+
+def cache_key(img, masker, bbox=None):
+    """Key for the output of masker (already fit) on img (cropped to bbox), or None if img is not a file on disk"""
+    if not isinstance(img, str):
+        return None
+    img = op.abspath(img)
+    st = os.stat(img)
+    params = {k: v for k, v in masker.get_params().items() if k not in _IGNORED_PARAMS}
+    h = hashlib.sha1()
+    h.update(f"{img}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+    if bbox is not None:
+        h.update(repr([(int(s.start), int(s.stop)) for s in bbox]).encode())
+    h.update(_hash_img(masker.mask_img_).encode())
+    h.update(repr(sorted(params.items())).encode())
+    return h.hexdigest()
+
+
+def _crop(img, bbox):
+    from image_utils import crop_img
+    return crop_img(img, bbox)
+
+
+def evict(cache_dir, max_bytes):
+    """Remove the least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for f in os.listdir(cache_dir):
+        if f.endswith('.npy'):
+            st = os.stat(op.join(cache_dir, f))
+            entries.append((st.st_mtime, st.st_size, f))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries):
+        if total <= max_bytes:
+            break
+        logger.debug(f"Evicting {f} ({size/1024**2:.1f} MB) from timeseries cache")
+        try:
+            os.remove(op.join(cache_dir, f))
+        except FileNotFoundError: # another process got there first
+            pass
+        total -= size
+
+
+def cached_transform(masker, img, cache_dir=None, max_bytes=None, bbox=None, load=None):
+    """
+    masker.transform(img), read from the cache when possible.
+
+    masker must already be fit. Returns a read-only memory-mapped array for cached results.
+    Images that are not files on disk are transformed without caching.
+    bbox: transform the crop of img to this bounding box (see image_utils.crop_img) instead,
+          e.g. for a small seed roi, cached under img's path too
+    load: function returning img already read in (e.g. shared by several maskers), called instead
+          of reading img again when the result is not cached
+    """
+    key = cache_key(img, masker, bbox)
+    if key is None:
+        return masker.transform(img if bbox is None else _crop(img, bbox))
+
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
+    cache_file = op.join(cache_dir, f"{key}.npy")
+    if op.exists(cache_file):
+        os.utime(cache_file) # mark as recently used
+        logger.debug(f"Timeseries cache hit for {img}: {cache_file}")
+        return np.load(cache_file, mmap_mode='r')
+
+    source = img if load is None else load()
+    data = masker.transform(source if bbox is None else _crop(source, bbox))
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary name and rename, so other processes never see a partial file
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        np.save(f, data)
+    os.replace(tmp_file, cache_file)
+    evict(cache_dir, max_bytes)
+    return data
@@ -1,42 +1,70 @@
 # Utility functions for the LGN-cortical coupling (aka streams) project
+#
+# This module is the lean core (GLM workflows, BIDS lookup, event/confound ingestion, cope sorting,
+# command runner) and imports only the standard library, so scripts and nipype nodes that only need
+# those don't pay for numpy/nilearn/nitime/matplotlib. The image, ROI and timeseries helpers live in
+# image_utils, roi_utils and timeseries_utils, and are still reachable as utils.<name>: they are
+# imported the first time one of them is used (see __getattr__ below).
+#
+# Nothing is logged anywhere until setup_logging() is called (e.g. from a script's __main__ or the
+# first cell of a notebook); setup_logging('sub-LL_analysis.log') gives the old log file.
 
 import os, glob
 import os.path as op
+import importlib
 
 import logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-consoleHandler = logging.StreamHandler()
-consoleHandler.setLevel(logging.DEBUG)
-fileHandler = logging.FileHandler('sub-LL_analysis.log')
-fileHandler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-consoleHandler.setFormatter(formatter)
-fileHandler.setFormatter(formatter)
-logger.addHandler(consoleHandler)
-logger.addHandler(fileHandler)
-logger.setLevel(logging.DEBUG)
-
-import numpy as np
-import pandas as pd
-
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-
-import nibabel as nib
-
-import nilearn
-from nilearn.masking import apply_mask
-from nilearn.plotting import plot_img, plot_epi, plot_roi, plot_stat_map, view_img, plot_anat
-from nilearn.image import get_data, index_img, load_img, threshold_img, math_img, resample_to_img, new_img_like, coord_transform
-from nilearn.input_data import NiftiMasker
-
-import nitime
-import nitime.fmri.io as nfio
-import nitime.timeseries as ts
-import nitime.analysis as nta
-import nitime.utils as ntu
-import nitime.viz as ntv
+
+import profiling
+
+# loggers of the project's modules, configured together by setup_logging
+PROJECT_LOGGERS = ('utils', 'image_utils', 'roi_utils', 'timeseries_utils', 'glm_inputs', 'bids_index',
+                   'ts_cache', 'roi_table', 'coherence', 'workdirs', 'native_glm', 'prf', 'profiling',
+                   'resample', 'surface')
+
+def setup_logging(log_file=None, level=logging.DEBUG, loggers=PROJECT_LOGGERS):
+    """Log the project's modules to the console, and to log_file if given (appended to).
+
+    Safe to call more than once: the handlers added by an earlier call are replaced."""
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setLevel(level)
+        handler.setFormatter(formatter)
+        handler._streams_handler = True
+    for name in loggers:
+        log = logging.getLogger(name)
+        for handler in [h for h in log.handlers if getattr(h, '_streams_handler', False)]:
+            log.removeHandler(handler)
+            handler.close()
+        log.setLevel(level)
+        for handler in handlers:
+            log.addHandler(handler)
+
+# functions moved out of this module, by the module that now has them
+LAZY_MODULES = {'image_utils': ['load_mask', 'load_data', 'bounding_box', 'roi_bbox', 'crop_img', 'uncrop',
+                                'threshold'],
+                'roi_utils': ['roi_map_scatter', 'roi_centers', 'roi_stats', 'roi_partition_filenames',
+                              'partition_roi', 'write_roi_partition', 'plot_roi_partition', 'assign_roi_percentile',
+                              'read_percentile_manifest', 'assign_roi_percentiles'],
+                'timeseries_utils': ['average_timeseries', 'get_timeseries_from_file', 'seed_coherence_timeseries',
+                                     'seed_coherence_analysis', 'multi_seed_coherence_analysis',
+                                     'make_timeseries_for_prf']}
+_LAZY_NAMES = {name: module for module, names in LAZY_MODULES.items() for name in names}
+
+def __getattr__(name):
+    """utils.<name> for the functions in LAZY_MODULES, importing their module on first use"""
+    if name in _LAZY_NAMES:
+        value = getattr(importlib.import_module(_LAZY_NAMES[name]), name)
+        globals()[name] = value # later lookups don't come back here
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted([*globals(), *_LAZY_NAMES])
 
 ## functions for GLM implementation in nipype
 def write_hemifield_localizer_event_file(event_file):
@@ -65,7 +93,8 @@ def write_hemifield_localizer_event_file(event_file):
     with open(event_file, 'w') as f:
         f.write(file_contents)
 
-def tsv2subjectinfo(events_file, confounds_file=None, exclude=None, trim_indices=None):
+def tsv2subjectinfo(events_file, confounds_file=None, exclude=None, trim_indices=None,
+                    confound_set='motion', trim_events=False, TR=None):
     """
     Function to go from events tsv + confounds tsv to subjectinfo,
     which can then be passed to model setup functions.
@@ -75,60 +104,26 @@ def tsv2subjectinfo(events_file, confounds_file=None, exclude=None, trim_indices
     trim_indices: either none or a tuple that will be used to slice the confounds
                     to conform to the length of the timeseries that is passed to the GLM
                     (TRs/volumes, not seconds)
-
-    TODO: currently the event files are basically handmade, so they artificially reflect
-            the (hardcoded) trim values for the hemifield task (6 volumes up front, 1 at the end)
-            instead these should be generated by the experiment code and reflect the untrimmed data,
-            and then the trimming of fMRI data AND the confounds/events timeseries done in nipype (here)
-
-    SO: for now the trim_indices only apply to the confounds (which reflect the untrimmed data)
-        but in the near future they'll be applied to the events as well.
+    confound_set: which confounds to use as regressors, a named set ('motion', 'fd', 'acompcor',
+                    'global_signal', 'white_matter', 'csf'), a column name, or a list of them
+                    (see glm_inputs.CONFOUND_SETS). Default is the 6 motion parameters.
+    trim_events: also apply trim_indices to the events (shifting onsets by trim_indices[0] * TR),
+                    for event files that reflect the untrimmed data
+
+    Note: currently the event files are basically handmade, so they artificially reflect
+            the (hardcoded) trim values for the hemifield task (6 volumes up front, 1 at the end),
+            which is why trim_events is off by default. Event files generated by the experiment code
+            reflect the untrimmed data, and should be used with trim_events=True and TR.
+
+    Files are parsed once per process and cached (see glm_inputs.py).
     """
-    import numpy as np
-    import pandas as pd
     from nipype.interfaces.base import Bunch
+    from glm_inputs import read_events, read_confounds
 
-    # Events first
-    events = pd.read_csv(events_file, sep="\t")
-    if exclude is not None:  # not tested
-        events.drop(exclude, axis=1, inplace=True)
-
-    conditions = sorted(events['trial_type'].unique())
-    onsets = [events['onset'][events['trial_type'] == tt].tolist() for tt in conditions]
-    durations = [events['duration'][events['trial_type'] == tt].tolist() for tt in conditions]   
-    if 'weight' in events.columns:
-      amplitudes = [events['weight'][events['trial_type'] == tt].tolist() for tt in conditions]
-    else:
-      amplitudes = [np.ones(len(d)) for d in durations]
-
-    # Confounds next
-    if confounds_file is None or confounds_file=='':
-        regressor_names = []
-        regressors = []
-    else:
-        confounds = pd.read_csv(confounds_file, sep="\t", na_values="n/a") # fmriprep confounds file
-        regressor_names=[ # 'white_matter', 'global_signal','framewise_displacement',
-                            # 'a_comp_cor_00',
-                            # 'a_comp_cor_01',
-                            # 'a_comp_cor_02',
-                            # 'a_comp_cor_03',
-                            # 'a_comp_cor_04',
-                            # 'a_comp_cor_05',
-                            'trans_x',
-                            'trans_y',
-                            'trans_z',
-                            'rot_x',
-                            'rot_y',
-                            'rot_z']
-
-        if trim_indices is None:
-            regressors = [list(confounds[reg].fillna(0)) for reg in regressor_names]
-        else:
-            assert(len(trim_indices)==2)
-            if trim_indices[-1] == 0: # if nothing is to be trimmed from the end, 0 will be passed in, but slice() wants None
-                regressors = [list(confounds[reg].fillna(0))[slice(trim_indices[0], None)] for reg in regressor_names]
-            else:
-                regressors = [list(confounds[reg].fillna(0))[slice(*trim_indices)] for reg in regressor_names]
+    assert TR is not None or not trim_events, "trim_events needs the TR to shift the onsets"
+    conditions, onsets, durations, amplitudes = read_events(events_file, exclude=exclude,
+        trim_indices=trim_indices if trim_events else None, TR=TR)
+    regressor_names, regressors = read_confounds(confounds_file, confound_set, trim_indices)
 
     bunch = Bunch(conditions=conditions,
                     onsets=onsets,
@@ -154,6 +149,57 @@ def sort_copes(files):
 def num_copes(files):
     return len(files)
 
+def trim_volumes(in_file, begin_index=0, end_index=0, output_type='NIFTI_GZ'):
+    """Same as nipype's nipy Trim (end_index 0 = to the end), but written as output_type
+    ('NIFTI' or 'NIFTI_GZ') rather than in the input's format, and without a float64 copy"""
+    import os
+    import numpy as np
+    import nibabel as nb
+    from nipype.utils.filemanip import split_filename
+
+    img = nb.load(in_file)
+    s = slice(begin_index, img.shape[3] if end_index == 0 else end_index)
+    trimmed = nb.Nifti1Image(np.asanyarray(img.dataobj[..., s]), img.affine, img.header)
+    _, base, _ = split_filename(in_file)
+    out_file = os.path.join(os.getcwd(), f"{base}_trim{'.nii' if output_type == 'NIFTI' else '.nii.gz'}")
+    nb.save(trimmed, out_file)
+    return out_file
+
+def convert_nifti_outputs(in_path, output_type='NIFTI_GZ'):
+    """Copy in_path (a nifti file, or a directory such as FILMGLS's results) into the current directory,
+    (de)compressing the .nii/.nii.gz files to output_type. Other files are copied as they are.
+    Used between uncompressed intermediates and the DataSink. Returns the new path."""
+    import os, gzip, shutil
+
+    def convert(src, dst_dir):
+        name = os.path.basename(src)
+        if output_type == 'NIFTI_GZ' and name.endswith('.nii'):
+            dst = os.path.join(dst_dir, f"{name}.gz")
+            with open(src, 'rb') as f_in, gzip.open(dst, 'wb', compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        elif output_type == 'NIFTI' and name.endswith('.nii.gz'):
+            dst = os.path.join(dst_dir, name[:-len('.gz')])
+            with gzip.open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            dst = os.path.join(dst_dir, name)
+            shutil.copy(src, dst)
+        return dst
+
+    if not os.path.isdir(in_path):
+        return convert(in_path, os.getcwd())
+    out_path = os.path.join(os.getcwd(), os.path.basename(in_path.rstrip(os.sep)))
+    for root, dirs, files in os.walk(in_path):
+        dst_dir = os.path.join(out_path, os.path.relpath(root, in_path))
+        os.makedirs(dst_dir, exist_ok=True)
+        for f in files:
+            convert(os.path.join(root, f), dst_dir)
+    return out_path
+
+def nifti_file(stem):
+    """stem.nii if it exists (so it can be memory-mapped), otherwise stem.nii.gz"""
+    return f"{stem}.nii" if op.exists(f"{stem}.nii") else f"{stem}.nii.gz"
+
 def fslmaths_threshold_roi_opstring(thresh):
     return [f"-thr {thresh} -bin", f"-uthr {thresh} -bin"]
 
@@ -161,12 +207,15 @@ def get_files(subject_id, session, task, raw_data_dir, preprocessed_data_dir, sp
     """
     Given some information, retrieve all the files and metadata from a
     BIDS-formatted dataset that will be passed to the analysis pipeline.
+
+    The layouts come from the persistent index in bids_index.py, which only holds (and after changes,
+    only re-indexes) this subject's or session's files, so only the first call pays for indexing them.
     """
-    from bids import BIDSLayout
+    from bids_index import get_layout
     
     # only the raw files have the correct metadata, eg TR, and the event files are here
-    raw_layout = BIDSLayout(raw_data_dir, validate=False, derivatives=False)
-    preproc_layout = BIDSLayout(preprocessed_data_dir, validate=False)
+    raw_layout = get_layout(raw_data_dir, derivatives=False, subject=subject_id, session=session)
+    preproc_layout = get_layout(preprocessed_data_dir, subject=subject_id, session=session)
 
     subjects = preproc_layout.get_subjects()
     assert subject_id in subjects and subject_id in raw_layout.get_subjects(), "Subject not found!"
@@ -249,52 +298,236 @@ def get_contrasts(task):
         return [cont_mp, cont_pm, cont_visresp]
 
 
-def run_fixedeffects_glm(sub, ses, task, run, raw_data_dir, out_dir, working_dir_suffix = None, space = None, **kwargs):
+@profiling.traced
+def run_fixedeffects_glm(sub, ses, task, run, raw_data_dir, out_dir, working_dir_suffix = None, space = None, engine = 'fsl',
+                         return_datasink=False, **kwargs):
     """Run the fixed effects glm, given some parameters.
 
-    Return the working directory for this glm run"""
-    
-    import glm_fixedeffects_level12 as glm
-    
-    if working_dir_suffix is None:
-        working_dir = os.path.abspath(os.path.join(os.path.split(out_dir)[0], f"nipype_{sub}_{ses}_{task}"))
-    else:
-        working_dir = os.path.abspath(os.path.join(os.path.split(out_dir)[0], f"nipype_{sub}_{ses}_{task}_{working_dir_suffix}"))
-    glm.BIDSDataGrabber.inputs.raw_data_dir = raw_data_dir
-    glm.BIDSDataGrabber.inputs.preprocessed_data_dir = out_dir
-    glm.BIDSDataGrabber.inputs.space = space
-    glm.BIDSDataGrabber.inputs.run = run
-    glm.hemi_wf.base_dir = working_dir
-    glm.hemi_wf.config = {"execution": {"crashdump_dir": os.path.join(working_dir, 'crashdumps')}}
-
-    glm.BIDSDataGrabber.inputs.subject_id = sub
-    glm.BIDSDataGrabber.inputs.session = ses
-    glm.BIDSDataGrabber.inputs.task = task
+    engine: 'fsl' runs the nipype workflow in glm_fixedeffects_level12 (FILMGLS + FLAMEO),
+            'native' fits the same model in-process with numpy (see native_glm.py).
+            Both write their results to the datasink directory of these settings, see below
+
+    The working directory, next to out_dir, is named after a hash of the inputs (sub/ses/task/run/space
+    and the checksums of the input files, see workdirs.py), so any glm on the same runs reuses its nipype
+    cache: nodes whose own settings are unchanged (e.g. trimming and masking when only the contrasts
+    change) are not rerun. The results of each set of settings (trim indices, contrasts, model settings,
+    engine, ...) go to their own {working_dir}/datasink_{hash}, with the same layout as the nipype DataSink.
+    As they share the node directories, glms on the same inputs run one at a time (see workdirs.job).
+    Afterwards the intermediates of the least recently completed working directories there are removed
+    to keep them under workdir_budget_gb (kwarg, by default STREAMS_WORKDIR_GB); datasinks are kept.
+
+    Return the working directory for this glm run; its results are in glm_datasink_dir(working_dir)
+    until another glm runs there. With return_datasink, return (working_dir, datasink directory)."""
+    import time
+    import workdirs
 
     contrasts = get_contrasts(task)
-    glm.modelfit.inputs.level1design.contrasts = contrasts
 
     # How many volumes to trim from the functional run before masking and preprocessing
-    try:
-        trim_idxs = kwargs.get('trim_idxs')
-        assert(trim_idxs is not None)
-    except KeyError:
-        print("Trim indices not provided, will use defaults")
+    trim_idxs = kwargs.get('trim_idxs')
+    if trim_idxs is None:
         if task=="mp":
             trim_idxs = (4, 0) # Should be 4 0 for MP when 139 2.25s TRs acquired
         elif task=="hemi":
             trim_idxs = (6, -1) # 6 at the front, 1 at the back, for hemifield. 
+        else:
+            raise ValueError(f"Trim indices not provided, and there are no defaults for task {task}")
+        print(f"Trim indices not provided, will use the defaults for {task}: {trim_idxs}")
+
+    if engine not in ('fsl', 'native'):
+        raise ValueError(f"Unknown GLM engine {engine}, must be 'fsl' or 'native'")
+
+    with profiling.trace('utils.get_files', sub=sub, ses=ses, task=task):
+        bolds, masks, events, TR, confounds = get_files(sub, ses, task, raw_data_dir, out_dir, space=space, run=run)
+    inputs = dict(sub=sub, ses=ses, task=task, run=run, space=space)
+    settings = dict(engine=engine, TR=TR, trim_idxs=list(trim_idxs), contrasts=contrasts,
+                    confound_set=kwargs.get('confound_set', 'motion'))
+    if engine == 'fsl':
+        import glm_fixedeffects_level12 as glm
+        settings['model_settings'] = glm.MODEL_SETTINGS
+        settings['intermediate_type'] = kwargs.get('intermediate_type') or glm.INTERMEDIATE_TYPE
+    prefix = f"nipype_{sub}_{ses}_{task}" if working_dir_suffix is None else f"nipype_{sub}_{ses}_{task}_{working_dir_suffix}"
+    parent_dir = os.path.split(os.path.abspath(out_dir))[0]
+    working_dir = workdirs.hashed_working_dir(parent_dir, prefix, inputs, files=[bolds, masks, events, confounds])
+
+    with workdirs.job(working_dir):
+        datasink_dir = workdirs.hashed_datasink_dir(working_dir, settings)
+        if engine == 'native':
+            import native_glm
+            native_glm.run_native_fixedeffects(bolds, masks, events, TR, confounds, contrasts, datasink_dir,
+                                               trim_indices=trim_idxs, confound_set=settings['confound_set'])
+        else:
+            hemi_wf = make_fixedeffects_workflow(sub, ses, task, run, raw_data_dir, out_dir, working_dir, trim_idxs,
+                                                 contrasts=contrasts, space=space, intermediate_type=settings['intermediate_type'],
+                                                 confound_set=settings['confound_set'], datasink_dir=datasink_dir)
+            hemi_wf.write_graph()
+            if profiling.trace_dir() is not None:
+                profiling.enable_resource_monitor()
+            run_start = time.time()
+            hemi_wf.run(plugin='MultiProc', plugin_args={'n_procs':kwargs.get('n_procs', 3)})
+            profiling.add_node_records(working_dir, since=run_start, sub=sub, ses=ses, task=task)
+        workdirs.set_last_datasink(working_dir, datasink_dir)
+
+    budget_gb = kwargs.get('workdir_budget_gb')
+    workdirs.gc_working_dirs(parent_dir, None if budget_gb is None else int(budget_gb * 1024**3), keep=[working_dir])
+    return (working_dir, datasink_dir) if return_datasink else working_dir
+
+def glm_datasink_dir(working_dir):
+    """Datasink directory of the last glm run in working_dir (see run_fixedeffects_glm), for get_model_outputs.
+    Working directories from before the per-settings datasinks have theirs in fixedeffects/modelfit/datasink."""
+    import workdirs
+
+    return workdirs.last_datasink(working_dir) or os.path.join(working_dir, 'fixedeffects', 'modelfit', 'datasink')
+
+def make_fixedeffects_workflow(sub, ses, task, run, raw_data_dir, out_dir, working_dir, trim_idxs, contrasts=None, space=None,
+                               intermediate_type=None, confound_set=None, datasink_dir=None):
+    """Build and configure a new fixed effects workflow instance for one subject/session/task.
+
+    Unlike the module-level workflow in glm_fixedeffects_level12, nothing here is shared,
+    so several of these can be set up (and run) from the same process.
+    intermediate_type: 'NIFTI' or 'NIFTI_GZ' for the working directory images, see glm_fixedeffects_level12
+    confound_set: confound regressors, see tsv2subjectinfo (by default the workflow's, the motion parameters)
+    datasink_dir: where the DataSink writes the results (by default its node directory in working_dir)"""
+    import glm_fixedeffects_level12 as glm
 
-    glm.modelfit.inputs.tsv2subjinfo.trim_indices = trim_idxs
-    glm.modelfit.inputs.trim.begin_index = trim_idxs[0]
-    glm.modelfit.inputs.trim.end_index = trim_idxs[1]
+    hemi_wf = glm.create_fixedeffects_workflow(intermediate_type=intermediate_type)
+    hemi_wf.base_dir = working_dir
+    # content hashes, so that node results are reused whenever their inputs are unchanged, even if rewritten
+    hemi_wf.config = {"execution": {"crashdump_dir": os.path.join(working_dir, 'crashdumps'),
+                                    "hash_method": "content"}}
+
+    grabber = hemi_wf.get_node('BIDSDataGrabber')
+    grabber.inputs.raw_data_dir = raw_data_dir
+    grabber.inputs.preprocessed_data_dir = out_dir
+    grabber.inputs.space = space
+    grabber.inputs.run = run
+    grabber.inputs.subject_id = sub
+    grabber.inputs.session = ses
+    grabber.inputs.task = task
+
+    modelfit = hemi_wf.get_node('modelfit')
+    if contrasts is None:
+        contrasts = get_contrasts(task)
+    modelfit.inputs.level1design.contrasts = contrasts
+
+    modelfit.inputs.tsv2subjinfo.trim_indices = trim_idxs
+    if confound_set is not None:
+        modelfit.inputs.tsv2subjinfo.confound_set = confound_set
+    modelfit.inputs.trim.begin_index = trim_idxs[0]
+    modelfit.inputs.trim.end_index = trim_idxs[1]
+    if datasink_dir is not None:
+        modelfit.inputs.datasink.base_directory = datasink_dir
+    return hemi_wf
+
+# columns every row of a batch GLM manifest must fill in
+GLM_MANIFEST_COLUMNS = ('sub', 'ses', 'task', 'raw_data_dir', 'out_dir')
+
+def read_glm_manifest(manifest):
+    """Read a batch GLM manifest into a list of job dicts.
+
+    manifest is a TSV file (or DataFrame, or list of dicts) with one row per GLM and columns
+    sub, ses, task, raw_data_dir, out_dir (required, a ValueError names the rows missing one), runs
+    plus optionally trim_idxs (by default the task's, see run_fixedeffects_glm), working_dir_suffix,
+    space, engine, intermediate_type and confound_set.
+    runs, trim_idxs and confound_set may be given as strings, e.g. "[2, 3, 4]", "(4, 0)" and "['motion', 'fd']"."""
+    import ast
+    import pandas as pd
 
-    glm.hemi_wf.write_graph()
-    outgraph = glm.hemi_wf.run(plugin='MultiProc', plugin_args={'n_procs':3})
-    return working_dir
+    if isinstance(manifest, str):
+        manifest = pd.read_csv(manifest, sep='\t', dtype=str, keep_default_na=False)
+    if isinstance(manifest, pd.DataFrame):
+        manifest = manifest.to_dict('records')
+    jobs = []
+    for i, row in enumerate(manifest):
+        job = {k: v for k, v in row.items() if not (isinstance(v, str) and v == '')}
+        missing = [k for k in GLM_MANIFEST_COLUMNS if job.get(k) is None]
+        if missing:
+            raise ValueError(f"Row {i} of the GLM manifest ({row}) is missing {', '.join(missing)}")
+        for key in ('runs', 'trim_idxs'):
+            if isinstance(job.get(key), str):
+                job[key] = ast.literal_eval(job[key])
+        if isinstance(job.get('confound_set'), str) and job['confound_set'].startswith('['): # several sets, e.g. "['motion', 'fd']"
+            job['confound_set'] = ast.literal_eval(job['confound_set'])
+        jobs.append(job)
+    return jobs
+
+def _run_fixedeffects_job(job, n_procs):
+    """Run one row of a batch manifest, returning its status and timings rather than raising"""
+    import time, traceback
+
+    result = {k: job.get(k) for k in ('sub', 'ses', 'task', 'runs', 'trim_idxs')}
+    result['start'] = time.time()
+    try:
+        result['working_dir'], result['datasink_dir'] = run_fixedeffects_glm(job['sub'], job['ses'], job['task'], job.get('runs', []),
+            job['raw_data_dir'], job['out_dir'], working_dir_suffix=job.get('working_dir_suffix'),
+            space=job.get('space'), engine=job.get('engine', 'fsl'), trim_idxs=job.get('trim_idxs'), n_procs=n_procs,
+            intermediate_type=job.get('intermediate_type'), confound_set=job.get('confound_set', 'motion'),
+            return_datasink=True)
+        result['status'] = 'ok'
+        result['error'] = ''
+    except Exception as e:
+        result['working_dir'] = result['datasink_dir'] = ''
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        logger.debug(traceback.format_exc())
+    result['end'] = time.time()
+    result['seconds'] = result['end'] - result['start']
+    return result
+
+def available_workers(procs_per_job=3, mem_gb_per_job=4.):
+    """How many jobs of the given size fit on this machine, based on usable cores and memory"""
+    try:
+        n_cores = len(os.sched_getaffinity(0))
+    except AttributeError: # not available on macOS
+        n_cores = os.cpu_count()
+    try:
+        import psutil
+        mem_gb = psutil.virtual_memory().available / 1024**3
+    except ImportError:
+        try:
+            mem_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') / 1024**3
+        except (ValueError, OSError): # no SC_AVPHYS_PAGES on macOS: go by cores only
+            return max(1, n_cores // procs_per_job)
+    return max(1, min(n_cores // procs_per_job, int(mem_gb // mem_gb_per_job)))
+
+@profiling.traced
+def run_fixedeffects_batch(manifest, n_jobs=None, procs_per_job=3, mem_gb_per_job=4., summary_file=None):
+    """Run the fixed effects glm for every row of a manifest (see read_glm_manifest).
+
+    Each row gets its own workflow instance and runs in its own process, n_jobs at a time
+    (by default as many as fit in the available cores and memory), each with procs_per_job
+    MultiProc workers. Rows on the same inputs (e.g. a contrasts sweep) share a working directory and
+    run one after the other, see run_fixedeffects_glm. Failures are recorded rather than raised.
+
+    Return a DataFrame with per-job status and timings, also written to summary_file (TSV) if given."""
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import pandas as pd
+
+    jobs = read_glm_manifest(manifest)
+    if n_jobs is None:
+        n_jobs = available_workers(procs_per_job, mem_gb_per_job)
+    n_jobs = min(n_jobs, len(jobs))
+    logger.debug(f"Running {len(jobs)} GLMs, {n_jobs} at a time with {procs_per_job} processes each")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_run_fixedeffects_job, job, procs_per_job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            logger.debug(f"sub-{result['sub']} ses-{result['ses']} task-{result['task']}: "
+                         f"{result['status']} in {result['seconds']:.1f}s")
+            results.append(result)
+
+    summary = pd.DataFrame(results).sort_values('start').reset_index(drop=True)
+    for col in ('start', 'end'):
+        summary[col] = pd.to_datetime(summary[col], unit='s')
+    if summary_file is not None:
+        summary.to_csv(summary_file, sep='\t', index=False)
+    return summary
 
 def get_model_outputs(datasink_dir, contrasts):
-    """Given the datasink directory of a glm workflow, this grabs the Level 1 and 2 results for the specified contrasts [list]."""
+    """Given the datasink directory of a glm workflow, this grabs the Level 1 and 2 results for the specified contrasts [list].
+    Uncompressed (.nii) outputs are returned when present, so that loading them memory-maps rather than decompresses."""
     import glob
     contents = os.listdir(datasink_dir)
     l1outdir = 'results_dir'
@@ -308,11 +541,11 @@ def get_model_outputs(datasink_dir, contrasts):
             l1outputs = sorted(glob.glob(l1glob))
             for l1o in l1outputs:
                 #l1tstats.append(os.path.join(l1o, f"results/tstat{contrast_number}.nii.gz"))
-                l1copes.append(os.path.join(l1o, f"results/cope{contrast_number}.nii.gz"))
+                l1copes.append(nifti_file(os.path.join(l1o, f"results/cope{contrast_number}")))
                 
         if l2outdir in contents:
             l2contrastdir = os.path.join(datasink_dir, l2outdir, f"_flameo{contrast_number - 1}", "stats")
-            l2outs.extend([os.path.join(l2contrastdir, x) for x in ['cope1.nii.gz']])
+            l2outs.extend([nifti_file(os.path.join(l2contrastdir, x)) for x in ['cope1']])
         
     return l1copes, l2outs
 
@@ -324,338 +557,131 @@ def view_results(datasink_dir, contrast_number, anat, func, vROI=''):
     return f"fsleyes {anat} {func} {vROI} {' '.join(c)} {' '.join(l2)}"
 
 
-## Functions for dealing with rois
-
-def roi_map_scatter(roi, beta_map, ref_vol_img):
-    # get coordinates of roi, calculate bounds
-    coords = np.argwhere(load_img(roi).get_fdata()!=0)
-    roi_max_bounds = np.max(coords, 0)
-    roi_min_bounds = np.min(coords, 0)
-    roi_center_native = np.mean(coords, 0)
-    roi_center_ras = coord_transform(*roi_center_native, ref_vol_img.affine)
-
-    print(f"****\n{roi} extends from {roi_max_bounds} to {roi_min_bounds} and is centered at:\n{roi_center_native} (native) = {roi_center_ras} (RAS)", sep='\n')
-
-    # mask the beta map with the roi mask
-    beta_masker = NiftiMasker(mask_img=roi)
-    roi_betas = beta_masker.fit_transform(beta_map)[0]
-    roi_beta_min = np.min(roi_betas)
-    roi_beta_max = np.max(roi_betas)
-
-    print(coords.shape, roi_betas.shape)
-    coords_ras = np.array(coord_transform(coords[:, 0], coords[:, 1], coords[:, 2], ref_vol_img.affine))
-
-    plt.scatter(coords_ras[0, :], roi_betas)
-    plt.xlabel("Left - Right")
-    plt.ylabel(f"{op.basename(beta_map)}")
-    plt.show()
-    plt.close()
-    plt.scatter(coords_ras[1, :], roi_betas)
-    plt.xlabel("Posterior - Anterior")
-    plt.ylabel(f"{op.basename(beta_map)}")
-    plt.show()
-    plt.close()
-    # plot histogram of beta values within roi mask
-    plt.scatter(coords_ras[2, :], roi_betas)
-    plt.xlabel("Inferior - Superior")
-    plt.ylabel(f"{op.basename(beta_map)}")
-    plt.show()
-    plt.close()
-
-def roi_centers(big_roi_fn, subdivision_rois_fns, ref_vol_img):
-    M = ref_vol_img.affine[:3, :3]
-    abc = ref_vol_img.affine[:3, 3]
-    big_roi = load_img(big_roi_fn)
-    subdivision_rois = [load_img(f) for f in subdivision_rois_fns]
-    big_coords = np.argwhere(big_roi.get_fdata()!=0)
-    big_roi_center = M.dot(np.mean(big_coords, 0)) + abc
-    big_roi_max_bounds = M.dot(np.max(big_coords, 0)) + abc
-    big_roi_min_bounds = M.dot(np.min(big_coords, 0)) + abc
-    big_roi_extent = big_roi_max_bounds-big_roi_min_bounds
-    print(f"Big roi extends from {big_roi_min_bounds} to {big_roi_max_bounds}\nExtent is {big_roi_extent} and center is {big_roi_center}")
-    fig, ax = plt.subplots(1)
-    for fn,roi in zip(subdivision_rois_fns,subdivision_rois):
-        coords = np.argwhere(roi.get_fdata()!=0)
-        roi_center = M.dot(np.mean(coords, 0)) + abc
-        roi_center_proportion = (big_roi_max_bounds - roi_center)/big_roi_extent
-        ax.scatter(roi_center_proportion[0], 1-roi_center_proportion[2])
-        ax.set_xlabel("Proportion of LGN extent (L-R)")
-        ax.set_ylabel("Proportion of LGN extent (Ventral - Dorsal)")
-        print(fn, roi_center, roi_center_proportion, sep='\n')
-    plt.show()
-    plt.close('all')
-
-def roi_stats(roi_dict, ref_vol_img):
-    M = ref_vol_img.affine[:3, :3]
-    abc = ref_vol_img.affine[:3, 3]
-    for label, roi in roi_dict.items():
-        print(f"{label}")
-        coords = np.argwhere(roi.get_fdata()!=0)
-        print(coords.shape)
-        roi_center = np.mean(coords, 0)
-        roi_max_bounds = np.max(coords, 0)
-        roi_min_bounds = np.min(coords, 0)
-        print("ROI max and min coords", roi_max_bounds, roi_min_bounds)
-        #for i in range(roi_min_bounds[2], roi_max_bounds[2]+1)
-        #    [roi_min_bounds[0]-1, roi_min_bounds[1]-1, i]
-        roi_extent = roi_max_bounds-roi_min_bounds+1
-        print("ROI extent (total voxel span and max/min distance from center): ", roi_extent, roi_max_bounds-roi_center, roi_min_bounds-roi_center, sep='\n')
-        print("ROI center in EPI and real-world coordinates: ", roi_center, M.dot(roi_center) + abc, sep='\n')
-        print("****")
-
-def assign_roi_percentile(roi, beta_map, cut_pct, ref_vol_img, which_hemi=None, roi_below_suffix='P', roi_above_suffix='M'):
-    """This function takes an roi mask (nifti) and a map of values (originally betas for GLM contrasts but could also be pRF results etc).
-    It looks at the values in the map within the ROI and identifies the specified (cut_pct) percentile.
-    It then assigns the voxels to one of two regions based on if they're above or below this value.
-    It also displays some graphs and stuff about this."""
-    # first, figure out what the filenames of the new ROIs will be
-    roi_stub = op.basename(roi).split('.')[0]
-    roi_stub_parts = roi_stub.split('_')
-    desc = [(i, x) for i, x in enumerate(roi_stub_parts) if 'desc-' in x]
-    # desc[0][0] = index of description part in list of parts
-    # desc[0][1] = actual desc-whatever
-    roi_dir = op.dirname(roi)
-    # desc-LLGN -> desc-LLGNM80 or whatever
-    roi_below_name = f"{desc[0][1]}{roi_below_suffix}{cut_pct}"
-    roi_above_name = f"{desc[0][1]}{roi_above_suffix}{cut_pct}"
-    #print(roi_stub, roi_stub_parts, desc, roi_above_name, roi_below_name)
-    roi_below_filename = f"{op.join(roi_dir, '_'.join([*roi_stub_parts[:desc[0][0]], roi_below_name, *roi_stub_parts[desc[0][0]+1:]]))}.nii.gz"
-    roi_above_filename = f"{op.join(roi_dir, '_'.join([*roi_stub_parts[:desc[0][0]], roi_above_name, *roi_stub_parts[desc[0][0]+1:]]))}.nii.gz"
-
-    # get coordinates of roi, calculate bounds
-    coords = np.argwhere(load_img(roi).get_fdata()!=0)
-    roi_max_bounds = np.max(coords, 0)
-    roi_min_bounds = np.min(coords, 0)
-
-    print(f"****\n****\nGiven the LGN mask \n{roi}\nwhich extends from {roi_max_bounds} to {roi_min_bounds}\nwill partition at {cut_pct}% and create\n{roi_below_filename}\n{roi_above_filename}", sep='\n')
-
-    # mask the beta map with the roi mask
-    beta_masker = NiftiMasker(mask_img=roi)
-    roi_betas = beta_masker.fit_transform(beta_map)[0]
-
-    roi_beta_min = np.min(roi_betas)
-    roi_beta_max = np.max(roi_betas)
-
-    # plot histogram of beta values within roi mask
-    plt.hist(roi_betas, bins=16)
-    plt.xlabel("BetaM-P")
-    plt.ylabel("Number of voxels")
-    threshold = np.percentile(roi_betas, cut_pct) # value above/below which voxels are assigned to different ROIs
-    print(f"Mask contains {len(roi_betas)} voxels and {cut_pct}th percentile is {threshold}")
-    plt.axvline(x=threshold, color="orange")
-    plt.show()
-    plt.close()
-
-    # threshold at value determined by percentile testing above
-    roi_nilearn = threshold_img(beta_map, threshold=threshold, mask_img=roi)
-    # threshold only works one way, returning values above the threshold
-    # therefore to get values below it, we do (-img)>(-threshold) within the roi mask
-    roi_nilearn_neg = threshold_img(math_img(f"-img", img=beta_map), threshold=(-1*threshold), mask_img=roi)
-    # exclude the zero voxels (not in the roi mask)
-    above_mask = math_img(f"np.logical_and((img != 0), (img > {threshold}))", img=roi_nilearn)
-    below_mask = math_img(f"np.logical_and((img != 0), (img >= {-1*threshold}))", img=roi_nilearn_neg)
-    n_vox_above = np.count_nonzero(above_mask.get_data())
-    n_vox_below = np.count_nonzero(below_mask.get_data())
-
-    # save files
-    above_mask.to_filename(roi_above_filename)
-    below_mask.to_filename(roi_below_filename)
-    print(f"{roi_above_filename}: {n_vox_above} voxels\n{roi_below_filename}: {n_vox_below} voxels")
-    # we should have assigned all voxels in the ROI mask to one of the two new ROIs
-    assert(len(roi_betas)==n_vox_above+n_vox_below)
-    
-    # fix/change this to not assume M/P
-    # also this could probably be refactored out into its own function that can be used elsewhere
-    imgs_in_order = [load_img(roi_below_filename), load_img(roi_above_filename), load_img(beta_map)] #[load_img(roi_above_filename), load_img(roi_below_filename), beta_map]
-    img_data = [img.get_data() for img in imgs_in_order]
-    p_roi, m_roi, beta_mp = img_data
-    print([np.count_nonzero(x) for x in img_data])
-    p_roi_masked = np.ma.masked_where(p_roi==0, p_roi)
-    m_roi_masked = np.ma.masked_where(m_roi==0, m_roi)
-    p_mask = np.ma.getmask(p_roi_masked)
-    m_mask = np.ma.getmask(m_roi_masked)
-    both_mask = np.logical_and(p_mask,m_mask)
-    beta_masked = np.ma.masked_array(beta_mp, mask=both_mask)
-    print([np.count_nonzero(~m) for m in [p_mask, m_mask, both_mask]])
-    print(f"beta_masked: {beta_masked.shape}")
-
-    # gets the coordinates of unmasked voxels
-    xs, ys, zs = beta_masked.nonzero()
-
-    roi_min_x = np.min(xs)
-    roi_min_y = np.min(ys)
-    roi_max_x = np.max(xs)
-    roi_max_y = np.max(ys)
-    roi_min_z = np.min(zs)
-    roi_max_z = np.max(zs)
-    roi_extent_y = roi_max_y - roi_min_y + 1
-    roi_extent_z = roi_max_z - roi_min_z + 1
-
-    # display first set of slices (z) and include a narrow colorbar axis
-    gridspec = {'width_ratios': [1]*roi_extent_z + [0.1]}
-    fig, ax = plt.subplots(ncols=roi_extent_z+1, figsize=(16,6), gridspec_kw=gridspec)
-    for ri in range(roi_extent_z):
-        # as of 2021-08-12, making this change to the orientation of the beta map to display correctly
-        to_show = np.fliplr(beta_masked[roi_min_x-2:roi_max_x+2,roi_min_y-2:roi_max_y+2,roi_max_z-ri].transpose())
-        #print(to_show.shape, np.count_nonzero(~to_show.mask))
-        pos = ax[ri].imshow(to_show, origin="lower",
-            cmap="coolwarm", clim=(roi_beta_min, roi_beta_max),
-            norm=colors.TwoSlopeNorm(vmin=roi_beta_min, vcenter=threshold, vmax=roi_beta_max))
-        ax[ri].set_title(f"Slice {roi_max_z-ri}")
-        ax[ri].set_xlabel(f"Left to Right")
-        ax[ri].set_ylabel(f"Posterior to Anterior")
-        ax[ri].set_xticks([])
-        ax[ri].set_yticks([])
-    plt.colorbar(pos, cax=ax[ri+1])
-    plt.show()
-    plt.close()
-
-    # display second set of slices with different orientation (y)
-    fig, ax = plt.subplots(ncols=roi_extent_y, figsize=(16,6))
-    for ri in range(roi_extent_y):
-        # as of 2021-08-12, making this change to the orientation of the beta map to display correctly
-        to_show = np.fliplr(beta_masked[roi_min_x-2:roi_max_x+2,roi_max_y-ri,roi_min_z-2:roi_max_z+2].transpose())
-        #print(to_show.shape, np.count_nonzero(~to_show.mask))
-        pos = ax[ri].imshow(to_show, origin="lower",
-            cmap="coolwarm", clim=(roi_beta_min, roi_beta_max),
-            norm=colors.TwoSlopeNorm(vmin=roi_beta_min, vcenter=threshold, vmax=roi_beta_max))
-        ax[ri].set_title(f"Slice {roi_max_y-ri}")
-        ax[ri].set_xlabel(f"Left to Right")
-        ax[ri].set_ylabel(f"Inferior to Superior")
-        ax[ri].set_xticks([])
-        ax[ri].set_yticks([])
-    plt.show()
-    plt.close('all')
-    return above_mask, below_mask, threshold
-
-
-## Functions for dealing with timeseries and doing coherence analysis
-def average_timeseries(bolds, masker):
-    """Given a list of bold file names and a NiftiMasker that has already been fit,
-    compute the mean across runs of the bold timeseries and return it"""
-    for i, bold_file in enumerate(bolds):
-        masked_bold_nm = masker.transform(bold_file)
-        if i==0: # first run
-            all_bolds = np.empty((*masked_bold_nm.shape, len(bolds)))
-        print(i, all_bolds.shape, masked_bold_nm.shape, masked_bold_nm.dtype, masked_bold_nm[:5, :5], sep="\n")
-        all_bolds[:, :, i] = masked_bold_nm
-    return np.average(all_bolds, axis=-1)
-
-def get_timeseries_from_file(bold, mask, TR, **kwargs):
-    """
-    Given a bold file and roi mask, return a nitime TimeSeries object
-    """
-    masker = NiftiMasker(mask_img=mask, t_r=TR, **kwargs)
-    return masker, ts.TimeSeries(data=masker.fit_transform(bold).T, sampling_interval=TR)
-
-def seed_coherence_timeseries(seed_ts, target_ts, f_ub, f_lb, method=dict(NFFT=32)):
-    conn_analyzer = nta.SeedCoherenceAnalyzer(seed_ts, target_ts, method=method)
-    freq_idx = np.where((conn_analyzer.frequencies > f_lb) * (conn_analyzer.frequencies < f_ub))[0]
-    logger.debug(f"Seed timeseries has shape: {seed_ts.shape}\nLooking at freq bins centered on: {conn_analyzer.frequencies[freq_idx]}")
-    # mean coherence across voxels in each freq bin
-    mean_coh = np.mean(conn_analyzer.coherence, axis=0)
-    # mean coherence across voxels in freq bins of interest
-    mean_coh_bandpass = np.mean(mean_coh[freq_idx])
-    # coherence in freq band of interest for each voxel
-    coh_by_voxel = np.mean(conn_analyzer.coherence[:, freq_idx], axis=1)
-    phase_by_voxel = np.mean(conn_analyzer.relative_phases[:, freq_idx], axis=1)
-
-    # plots of interest
-    fig, ax = plt.subplots(3, figsize=(10, 12))
-    ax[0].set_title("Mean coherence with seed across voxels at different frequencies")
-    if len(seed_ts.shape) > 1:
-        ax[0].plot(conn_analyzer.frequencies, np.mean(mean_coh, axis=0))
-    else:
-        ax[0].plot(conn_analyzer.frequencies, mean_coh)
-    ax[0].axvline(x=f_lb)
-    ax[0].axvline(x=f_ub)
-    ax[0].set_xlabel("Frequency (Hz)")
-    ax[0].set_ylabel("Coherence")
-
-    # ax[1].set_title("Coherence of each voxel with seed at different frequencies")
-    # for i in range(conn_analyzer.coherence.shape[0]):
-    #     ax[1].plot(conn_analyzer.frequencies, conn_analyzer.coherence[i, :])
-    # ax[1].axvline(x=f_lb)
-    # ax[1].axvline(x=f_ub)
-    # ax[1].set_xlabel("Frequency (Hz)")
-    # ax[1].set_ylabel("Coherence")
-
-    ax[1].set_title(f"Histogram of voxel coherence values within band {f_lb} < f < {f_ub} (N={coh_by_voxel.shape[0]})")
-    ax[1].hist(coh_by_voxel)
-    ax[1].set_xlabel("Coherence")
-    ax[1].set_ylabel("# voxels")
-
-    ax[2].set_title(f"Histogram of voxel phase values within band {f_lb} < f < {f_ub} (N={coh_by_voxel.shape[0]})")
-    ax[2].hist(phase_by_voxel)
-    ax[2].set_xlabel("Relative phase")
-    ax[2].set_ylabel("# voxels")
-
-    plt.subplots_adjust(hspace=.3)
-    plt.show()
-    plt.close('all')
-    logger.debug((f"seed_ts: {seed_ts.data.shape}\n"
-        f"target_ts: {target_ts.data.shape}\n{conn_analyzer.coherence.shape}\n{conn_analyzer.relative_phases.shape},"
-        f"{mean_coh.shape}, {mean_coh_bandpass.shape}, {coh_by_voxel.shape}"))
-    return conn_analyzer, (coh_by_voxel, phase_by_voxel)
-
-def seed_coherence_analysis(bold, mask, seed_roi, TR, f_ub, f_lb, mean_seed=True, method=dict(NFFT=32)):
-    """
-    Given a bold file, brainmask, and seed ROI mask, do a seed coherence analysis.
-    """
-    logger.debug(f"bold: {bold}\nmask: {mask}\nseed_roi: {seed_roi}")
-    target_masker, target_ts = get_timeseries_from_file(bold, mask, TR, detrend=False, standardize=False, high_pass=f_lb, low_pass=f_ub)
-    seed_masker, seed_ts = get_timeseries_from_file(bold, seed_roi, TR, detrend=False, standardize=False, high_pass=f_lb, low_pass=f_ub)
-
-    if mean_seed:
-        seed_ts = ts.TimeSeries(data=np.mean(seed_ts.data, axis=0), sampling_interval=TR)
-        n_seeds = 1
-    else:
-        n_seeds = seed_ts.data.shape[0]
-
-    conn_analyzer, (coh_by_voxel, phase_by_voxel) = seed_coherence_timeseries(seed_ts, target_ts, f_ub, f_lb, method)
-
-    logger.debug("seed_coherence_analysis() about to return...")
-    return conn_analyzer, target_masker, coh_by_voxel, phase_by_voxel
+## Functions for running external (FSL/FreeSurfer) commands
+def command(cmd, inputs=(), outputs=(), env=None):
+    """Describe one shell command for run_commands: the files it reads (inputs),
+    the files it writes (outputs) and any extra environment variables it needs"""
+    return dict(cmd=cmd, inputs=list(inputs), outputs=list(outputs), env=env)
+
+def up_to_date(inputs, outputs):
+    """True if every output exists and none is older than any (existing) input"""
+    if not outputs or not all(op.exists(f) for f in outputs):
+        return False
+    newest_input = max([op.getmtime(f) for f in inputs if op.exists(f)], default=0)
+    return min(op.getmtime(f) for f in outputs) >= newest_input
+
+def run_command(cmd, inputs=(), outputs=(), env=None, force=False):
+    """Run a shell command unless its outputs are up to date with its inputs (or force is set).
+
+    Returns a dict with the command, its status ('ran', 'failed' or 'skipped'),
+    exit code, wall time and captured stdout/stderr."""
+    import time
+
+    if not force and up_to_date(inputs, outputs):
+        logger.debug(f"Up to date, skipping: {cmd}")
+        return dict(cmd=cmd, status='skipped', returncode=None, seconds=0., stdout='', stderr='')
+    start = time.time()
+    with profiling.trace(op.basename(cmd.split()[0]), kind='command', cmd=cmd) as span:
+        # measured on its own, as run_commands runs several at once in this process
+        returncode, stdout, stderr, measured = profiling.run_process(cmd, env=None if env is None else {**os.environ, **env})
+        span.update(measured)
+    result = dict(cmd=cmd, status='ran' if returncode == 0 else 'failed', returncode=returncode,
+                  seconds=time.time() - start, stdout=stdout, stderr=stderr)
+    logger.debug(f"{result['status']} ({returncode}) in {result['seconds']:.1f}s: {cmd}")
+    return result
+
+def run_commands(steps, n_procs=4, force=False):
+    """Run a list of command() steps on a pool of n_procs workers.
+
+    A step waits for every earlier step that writes one of its inputs, and is not run
+    ('blocked') if any of those failed; all other steps run concurrently.
+    Returns a DataFrame with one row of run_command results per step, in order."""
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    import pandas as pd
 
+    producers = {}
+    deps = []
+    for i, step in enumerate(steps):
+        deps.append({producers[f] for f in step['inputs'] if f in producers})
+        for f in step['outputs']:
+            producers[f] = i
+
+    results = [None] * len(steps)
+    pending = set(range(len(steps)))
+    running = {}
+    with ThreadPoolExecutor(max_workers=n_procs) as executor:
+        while pending or running:
+            ready = [i for i in sorted(pending) if all(results[d] is not None for d in deps[i])]
+            for i in ready:
+                pending.remove(i)
+                if any(results[d]['status'] in ('failed', 'blocked') for d in deps[i]):
+                    results[i] = dict(cmd=steps[i]['cmd'], status='blocked', returncode=None, seconds=0., stdout='', stderr='')
+                else:
+                    running[executor.submit(run_command, force=force, **steps[i])] = i
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+    return pd.DataFrame(results)
+
+
+## Functions for preprocessing raw BIDS runs
+@profiling.traced
+def mcflirt_par_to_confounds(par_file, out_tsv):
+    """Write mcflirt's motion parameters (.par: 3 rotations in radians, then 3 translations in mm)
+    as an fmriprep-style confounds TSV, adding framewise displacement (Power et al., 50mm head radius)"""
+    import numpy as np
+    import pandas as pd
 
-## Functions for pRF
-def make_timeseries_for_prf(bolds):
-    """Takes a list of 4d nifti filenames, averages, cuts extra timepoints"""
-    for i, bold_file in enumerate(bolds):
-        img = load_img(bold_file)
-        data = get_data(img)
-        print(data.shape)
-        if i==0:
-            all_data = np.empty((*data.shape, len(bolds)))
-        all_data[:, :, :, :, i] = data
-    mean_timeseries = np.average(all_data, -1)
-    return nib.Nifti1Image(mean_timeseries[:, :, :, :138], img.affine)
+    par = np.loadtxt(par_file, ndmin=2)
+    confounds = pd.DataFrame(par, columns=['rot_x', 'rot_y', 'rot_z', 'trans_x', 'trans_y', 'trans_z'])
+    deltas = np.abs(np.diff(par, axis=0))
+    fd = np.sum(deltas[:, 3:], axis=1) + 50 * np.sum(deltas[:, :3], axis=1)
+    confounds['framewise_displacement'] = np.concatenate([[np.nan], fd])
+    confounds = confounds[['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z', 'framewise_displacement']]
+    confounds.to_csv(out_tsv, sep='\t', index=False, na_rep='n/a')
+
+@profiling.traced
+def preprocess_runs(sub, ses, task, raw_data_dir, out_dir, refvol, run=[], bet=True, n_procs=4, force=False):
+    """Motion correct (and skull strip) the raw bold runs of one subject/session/task.
+
+    Each run is mcflirted to refvol (-cost mutualinfo -smooth 16, as in the notebooks) into
+    {out_dir}/ses-{ses}/func/*_desc-mcflirt_bold.nii.gz, then optionally bet -R into *_desc-preproc_bold.nii.gz,
+    and its motion parameters are written to *_desc-confounds_regressors.tsv, where get_files/tsv2subjectinfo find them.
+    Runs are processed concurrently on n_procs workers and outputs newer than their inputs are not remade.
+    Returns the run_commands results."""
+    from bids_index import get_layout, invalidate
+
+    raw_bolds = sorted(get_layout(raw_data_dir, derivatives=False, subject=sub, session=ses).get(subject=sub,
+                       session=ses, task=task, run=run, suffix='bold', extension=['nii.gz'], return_type='file'))
+    func_dir = os.path.join(out_dir, f"ses-{ses}", "func")
+    os.makedirs(func_dir, exist_ok=True)
+
+    steps = []
+    par_files = {}
+    for this_epi in raw_bolds:
+        full_outpath = os.path.join(func_dir, change_bids_description(this_epi, 'desc-mcflirt'))
+        mcflirt_cmd = f"mcflirt -reffile {refvol} -mats -plots -report -cost mutualinfo -smooth 16 -in {this_epi} -o {full_outpath}"
+        steps.append(command(mcflirt_cmd, inputs=[this_epi, refvol], outputs=[f"{full_outpath}.nii.gz", f"{full_outpath}.par"]))
+        if bet:
+            full_outpath_bet = os.path.join(func_dir, change_bids_description(this_epi, 'desc-preproc'))
+            steps.append(command(f"bet {full_outpath} {full_outpath_bet} -R",
+                                 inputs=[f"{full_outpath}.nii.gz"], outputs=[f"{full_outpath_bet}.nii.gz"]))
+        confounds_stub = change_bids_description(this_epi, 'desc-confounds').split('_')
+        confounds_stub[-1] = 'regressors'
+        par_files[f"{full_outpath}.par"] = os.path.join(func_dir, f"{'_'.join(confounds_stub)}.tsv")
+
+    results = run_commands(steps, n_procs, force=force)
+    for par_file, confounds_file in par_files.items():
+        if op.exists(par_file) and (force or not up_to_date([par_file], [confounds_file])):
+            mcflirt_par_to_confounds(par_file, confounds_file)
+    invalidate(func_dir) # so that get_files finds the new bolds and confounds
+    return results
 
 
 ## Functions manipulating NIFTI images and FreeSurfer surfaces
-def threshold(what, by, at, out_dir, how='more'):
-    """Threshold a given prf output (what) by another (by, usually rsq) at a specific value"""
-    w = load_img(what)
-    b = load_img(by)
-    assert(w.shape == b.shape)
-    if how=='more':
-        mask = b.get_fdata() < at
-    elif how=='less':
-        mask = b.get_fdata() > at
-    marray = np.ma.masked_array(w.get_fdata(), mask)
-    out_data = np.ma.filled(marray, fill_value=0)
-    print(f"Thresholding {what} by {by} at thresh {at:.2f}...\n", 
-        mask.shape, out_data.shape, np.count_nonzero(mask), np.count_nonzero(out_data))
-    out_img = nib.Nifti1Image(out_data, w.affine)
-    parts_by = os.path.basename(by).split('_')
-    desc_by = [p for p in parts_by if 'desc' in p][0].split('-')[1] # gets whatever is after desc-
-    parts = os.path.basename(what).split('_')
-    parts.insert(-1, f"thresh-{desc_by}-{at:.2f}")
-    out_file = '_'.join(parts)
-    print(desc_by, parts, out_file, sep='\n')
-    nib.save(out_img, f"{out_dir}/{out_file}")
-
-def prf_to_anat(sub, brain_file, in_file, func2brain, out_dir):
+def prf_anat_filenames(in_file, out_dir):
+    """Anatomical space file for a prf output map, and the name ({desc}-{thresh}) of its surface overlays"""
     # put space-anat in there, replacing space-* if it exists
     parts = os.path.basename(in_file).split('_')
     parts = [p if 'space-' not in p else 'space-anat' for p in parts]
@@ -667,16 +693,54 @@ def prf_to_anat(sub, brain_file, in_file, func2brain, out_dir):
     except IndexError as inst:
         thresh = 'nothresh'
     outname = f"{desc}-{thresh}"
-    print(parts, outname)
     out_file = '_'.join(parts)
-    cmd = f"flirt -ref {brain_file} -out {out_dir}/{out_file} -in {in_file} -init {func2brain} -interp nearestneighbour -applyxfm"
-    print('flirt cmd:\n', cmd)
-    print('fsleyes anat cmd:\n', f"fsleyes {brain_file} {out_dir}/{out_file}")
-    os.system(cmd)
+    return f"{out_dir}/{out_file}", outname
+
+def prf_to_anat_commands(sub, brain_file, in_file, func2brain, out_dir):
+    """Steps (see command()) that move a prf output map to anatomical space and onto both hemispheres' surfaces"""
+    anat_file, outname = prf_anat_filenames(in_file, out_dir)
+    steps = [command(f"flirt -ref {brain_file} -out {anat_file} -in {in_file} -init {func2brain} -interp nearestneighbour -applyxfm",
+                     inputs=[brain_file, in_file, func2brain], outputs=[anat_file])]
     for hemi in ("lh", "rh"):
-        cmd2 = f"mri_vol2surf --src {out_dir}/{out_file} --o {out_dir}/{hemi}.{outname}.mgz --hemi {hemi} --regheader {sub} --projfrac 0.5"
-        print(cmd2)
-        os.system(cmd2)
+        surf_file = f"{out_dir}/{hemi}.{outname}.mgz"
+        steps.append(command(f"mri_vol2surf --src {anat_file} --o {surf_file} --hemi {hemi} --regheader {sub} --projfrac 0.5",
+                             inputs=[anat_file], outputs=[surf_file]))
+    return steps
+
+@profiling.traced
+def prf_to_anat(sub, brain_file, in_files, func2brain, out_dir, n_procs=4, engine='native'):
+    """Move one or more prf output maps (in_files) to anatomical space and the surface
+    ({out_dir}/{hemi}.{desc}-{thresh}.mgz, see freeview_prfs). Outputs newer than their inputs are not remade.
+
+    engine: 'native' resamples all the maps to anatomical space in one pass (see resample.py), then projects
+            them to both hemispheres' mid-thickness surfaces (see surface.py), in-process, and returns the
+            surface files written; 'commands' runs flirt -applyxfm and mri_vol2surf for each map and hemisphere,
+            n_procs at a time, and returns the run_commands results.
+            The overlays of the two engines can differ at some vertices: 'native' samples each vertex halfway
+            along the line from its white to its pial vertex, mri_vol2surf --projfrac 0.5 half the thickness
+            along the white surface's normal, and where the two points fall in different voxels, so do the values."""
+    if isinstance(in_files, str):
+        in_files = [in_files]
+    if engine not in ('native', 'commands'):
+        raise ValueError(f"Unknown engine {engine}, must be 'native' or 'commands'")
+    anat_files, outnames = zip(*[prf_anat_filenames(in_file, out_dir) for in_file in in_files])
+    print('fsleyes anat cmd:\n', f"fsleyes {brain_file} {' '.join(anat_files)}")
+    if engine == 'commands':
+        steps = [step for in_file in in_files for step in prf_to_anat_commands(sub, brain_file, in_file, func2brain, out_dir)]
+        return run_commands(steps, n_procs)
+
+    import resample
+    import surface
+    todo = [(in_file, anat_file) for in_file, anat_file in zip(in_files, anat_files)
+            if not up_to_date([brain_file, in_file, func2brain], [anat_file])]
+    if len(todo) > 0:
+        resample.apply_xfm([in_file for in_file, _ in todo], brain_file, func2brain,
+                           [anat_file for _, anat_file in todo], interp='nearest')
+    todo = [(anat_file, outname) for anat_file, outname in zip(anat_files, outnames)
+            if not up_to_date([anat_file], [f"{out_dir}/{hemi}.{outname}.mgz" for hemi in surface.HEMIS])]
+    if len(todo) == 0:
+        return []
+    return surface.vol2surf([anat_file for anat_file, _ in todo], sub, [outname for _, outname in todo], out_dir)
 
 def freeview_prfs(sub, hemi, prf_dir):
     """View prfs on surface in freeview with good colormap"""
@@ -690,22 +754,52 @@ def freeview_prfs(sub, hemi, prf_dir):
         freeview_cmd = freeview_cmd + f":overlay={x}:{x_color}"
     print(freeview_cmd)
 
-def make_func_parc_mask(ribbon_nii, parc_codes, func_ref_vol_path, out_fn, xfm_path):
-    # Load ribbon file, get voxels identified by parc_codes
-    ribbon_img = load_img(ribbon_nii)
-    ribbon_data = ribbon_img.get_fdata()
-    cortex_mask = np.zeros_like(ribbon_data)
-    print(np.count_nonzero(cortex_mask))
-    for c in parc_codes:
-        cortex_mask[ribbon_data==c] = 1
-    print(np.count_nonzero(cortex_mask))
-    # save these voxels as a binarized mask in the original space and resolution (T1)
-    cortex_mask_img = nib.Nifti1Image(cortex_mask, ribbon_img.affine)
+@profiling.traced
+def make_func_parc_mask(ribbon_nii, parc_codes, func_ref_vol_path, out_fn, xfm_path, engine='native'):
+    """Mask of the ribbon voxels with one of parc_codes, saved in T1w space (with the codes in a json sidecar)
+    and moved (trilinear) to the functional reference's space as out_fn. Masks up to date with their inputs
+    and made with the same parc_codes are not remade.
+
+    engine: 'native' resamples in-process (see resample.py) and returns [out_fn],
+            'commands' runs flirt -applyxfm and returns the run_command result"""
+    import json
+    import numpy as np
+    import nibabel as nib
+
+    if engine not in ('native', 'commands'):
+        raise ValueError(f"Unknown engine {engine}, must be 'native' or 'commands'")
     out_fn_t1 = f"{op.dirname(out_fn)}/{change_bids_description(out_fn, 'space-T1w', 'space')}.nii.gz"
-    nib.save(cortex_mask_img, out_fn_t1)
-    cmd = f"flirt -ref {func_ref_vol_path} -in {out_fn_t1} -out {out_fn} -init {xfm_path} -applyxfm"
-    print(cmd)
-    os.system(cmd)
+    sidecar = f"{out_fn_t1[:-len('.nii.gz')]}.json"
+    parc_codes = sorted(int(code) for code in np.atleast_1d(parc_codes))
+    saved_codes = None
+    if up_to_date([ribbon_nii], [out_fn_t1, sidecar]):
+        with open(sidecar) as f:
+            saved_codes = json.load(f).get('parc_codes')
+    remade = saved_codes != parc_codes
+    if remade:
+        # Load ribbon file, get voxels identified by parc_codes
+        ribbon_img = nib.load(ribbon_nii)
+        ribbon_data = np.asanyarray(ribbon_img.dataobj) # integer labels, no need for floats
+        # float32, as flirt keeps the input's datatype: an integer mask would round the trilinear partial volumes
+        cortex_mask = np.isin(ribbon_data, parc_codes).astype(np.float32)
+        ribbon_img.uncache()
+        print(np.count_nonzero(cortex_mask))
+        # save these voxels as a binarized mask in the original space and resolution (T1)
+        cortex_mask_img = nib.Nifti1Image(cortex_mask, ribbon_img.affine)
+        cortex_mask_img.set_data_dtype(np.float32)
+        nib.save(cortex_mask_img, out_fn_t1)
+        with open(sidecar, 'w') as f:
+            json.dump({'ribbon': ribbon_nii, 'parc_codes': parc_codes}, f)
+    # out_fn is remade with the T1w mask, even if it was written within the same mtime tick
+    inputs = [out_fn_t1, func_ref_vol_path, xfm_path]
+    if engine == 'native':
+        if not remade and up_to_date(inputs, [out_fn]):
+            logger.debug(f"{out_fn} is up to date")
+            return [out_fn]
+        import resample
+        return resample.apply_xfm(out_fn_t1, func_ref_vol_path, xfm_path, out_fn, interp='trilinear')
+    return run_command(f"flirt -ref {func_ref_vol_path} -in {out_fn_t1} -out {out_fn} -init {xfm_path} -applyxfm",
+                       inputs=inputs, outputs=[out_fn], force=remade)
 
 ## Functions for dealing with BIDS filenames
 # from fsleyes 0.32
@@ -749,26 +843,42 @@ def get_bids_part(fn, part):
 def epireg_func_to_anat(epi, t1, t1_brain, wmseg_nii, out, xfm, inverse):
     epireg_cmd = (f"epi_reg -v --epi={epi} --t1={t1} "
                   f"--t1brain={t1_brain} --wmseg={wmseg_nii} --out={out}")
-    print(epireg_cmd, os.system(epireg_cmd))
-
     inverse_cmd = f"convert_xfm -omat {inverse} -inverse {out}.mat && cp {out}.mat {xfm}"
-    print(inverse_cmd, os.system(inverse_cmd))
+    return run_commands([command(epireg_cmd, inputs=[epi, t1, t1_brain, wmseg_nii], outputs=[f"{out}.mat"]),
+                         command(inverse_cmd, inputs=[f"{out}.mat"], outputs=[inverse, xfm])], n_procs=1)
 
-def convert_label_to_vol(label_fn, sub, freesurfer_dir, template_fn, reg_mat, hemi, output_name):
+def label_to_vol_command(label_fn, sub, freesurfer_dir, template_fn, reg_mat, hemi, output_name):
+    """Step (see command()) converting one FreeSurfer label to a volume in the template's space"""
     if reg_mat == "identity":
         reg_option = "--identity"
+        inputs = [label_fn, template_fn]
     elif op.exists(reg_mat):
         reg_option = f"--reg {reg_mat}"
+        inputs = [label_fn, template_fn, reg_mat]
     else:
         raise ValueError("Must provide a valid registration matrix or 'identity'")
-    os.putenv('SUBJECTS_DIR', f"{freesurfer_dir}")
     cmd = (f"mri_label2vol --label {label_fn} --subject {sub} --temp {template_fn} "
            f"{reg_option} --hemi {hemi} --proj frac 0 1 .1 --o {output_name} "
            f"&& fslswapdim {output_name} x z -y {output_name} ")
-    logger.debug(cmd)
-    logger.debug(f"exited with status {os.system(cmd)}")
+    return command(cmd, inputs=inputs, outputs=[output_name], env={'SUBJECTS_DIR': f"{freesurfer_dir}"})
 
-def convert_labels(labels, sub, out_dir, template_fn, freesurfer_dir, reg_mat="identity", space="T1w"):
+def convert_label_to_vol(label_fn, sub, freesurfer_dir, template_fn, reg_mat, hemi, output_name):
+    return run_command(**label_to_vol_command(label_fn, sub, freesurfer_dir, template_fn, reg_mat, hemi, output_name))
+
+@profiling.traced
+def convert_labels(labels, sub, out_dir, template_fn, freesurfer_dir, reg_mat="identity", space="T1w", n_procs=4,
+                   engine='native'):
+    """Convert FreeSurfer labels ({lh,rh}.{roi}.label) to {out_dir}/sub-{sub}_desc-{L,R}{roi}_space-{space}_roi.nii.gz
+    masks on template_fn's grid, filling the cortical ribbon from white to pial.
+
+    engine: 'native' rasterizes all the labels in-process (see surface.labels_to_volumes) and returns the
+            files written; 'commands' runs mri_label2vol and fslswapdim per label, n_procs at a time,
+            and returns the run_commands results. Outputs newer than their inputs are not remade."""
+    if engine not in ('native', 'commands'):
+        raise ValueError(f"Unknown engine {engine}, must be 'native' or 'commands'")
+    if reg_mat != "identity" and not op.exists(reg_mat):
+        raise ValueError("Must provide a valid registration matrix or 'identity'")
+    jobs = []
     for l in labels:
         parts = op.basename(l).split('.')
         if parts[0] in ('lh','rh'):
@@ -782,4 +892,13 @@ def convert_labels(labels, sub, out_dir, template_fn, freesurfer_dir, reg_mat="i
         out_fn_stub = f"{out_dir}/sub-{sub}_desc-{hemi_LR}{roi_name}_space-{space}"
         out_fn = f"{out_fn_stub}_roi.nii.gz"
         logger.debug(f"{parts}, {hemi}, {roi_name}")
-        convert_label_to_vol(l, sub, freesurfer_dir, template_fn, reg_mat, hemi, out_fn)
\ No newline at end of file
+        jobs.append((l, hemi, out_fn))
+    if engine == 'commands':
+        return run_commands([label_to_vol_command(l, sub, freesurfer_dir, template_fn, reg_mat, hemi, out_fn)
+                             for l, hemi, out_fn in jobs], n_procs)
+
+    import surface
+    reg_inputs = [] if reg_mat == "identity" else [reg_mat]
+    todo = [job for job in jobs if not up_to_date([job[0], template_fn, *reg_inputs], [job[2]])]
+    return surface.labels_to_volumes([l for l, _, _ in todo], sub, [hemi for _, hemi, _ in todo], template_fn,
+                                     [out_fn for _, _, out_fn in todo], reg_mat, subjects_dir=freesurfer_dir)
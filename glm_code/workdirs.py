@@ -0,0 +1,266 @@
+# Content-hashed nipype working directories for the LGN-cortical coupling (aka streams) project
+#
+# Working directories used to be named after sub/ses/task (so a run on different inputs silently
+# reused, or clobbered, the last one) or after a timestamp (so nothing was ever reused). Here a working
+# directory is named after a hash of its inputs: the parameters that pick them, and the checksums of
+# the input files. Re-running on the same inputs finds its directory and nipype's node cache, whose
+# per-node hashes tell apart the settings (contrasts, model, ...) of the nodes downstream, and the
+# outputs of each setting go to their own hashed datasink directory in it (see hashed_datasink_dir).
+#
+# Jobs on the same working directory (e.g. the rows of a contrasts sweep in run_fixedeffects_batch) share
+# its node directories, which nipype empties and rewrites when a node reruns with other settings, so a job
+# holds an exclusive lock on it while it runs and the others wait their turn (see job). A job also marks
+# its working directory as in use while it runs (or waits) and as complete when it is done.
+# Once the working directories take up more than a disk budget, the intermediates of the least recently
+# completed ones are removed, never their datasinks, and never while a job is using them.
+
+import os
+import os.path as op
+import json
+import socket
+import hashlib
+import datetime
+from contextlib import contextmanager
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = int(float(os.environ.get('STREAMS_WORKDIR_GB', 200)) * 1024**3)
+CHECKSUM_CACHE = os.environ.get('STREAMS_CHECKSUM_CACHE',
+                                op.join(op.expanduser('~'), '.cache', 'streams', 'checksums.json'))
+
+# written into each working directory made here, so gc_working_dirs only ever cleans up those
+MARKER = '.streams_workdir.json'
+# written when a job using the working directory completes; gc_working_dirs only cleans up completed ones
+DONE = '.streams_done'
+# one file per job ({host}-{pid}) using the working directory, removed when it ends
+RUNNING = '.streams_running'
+# locked (flock) by the job running in the working directory
+LOCK = '.streams_lock'
+# path of the datasink directory written by the last completed job (see set_last_datasink)
+LAST_DATASINK = '.streams_last_datasink'
+# results (DataSink outputs) that gc_working_dirs keeps: anything named datasink*
+DATASINK = 'datasink'
+
+
+def _load_checksums():
+    try:
+        with open(CHECKSUM_CACHE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def file_checksum(path, checksums=None):
+    """sha1 of a file's contents, remembered (in CHECKSUM_CACHE) for as long as its mtime and size are unchanged"""
+    path = op.abspath(path)
+    st = os.stat(path)
+    key = f"{path}:{st.st_mtime_ns}:{st.st_size}"
+    if checksums is None:
+        checksums = _load_checksums()
+    if key not in checksums:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(16 * 1024**2), b''):
+                h.update(block)
+        checksums[key] = h.hexdigest()
+    return checksums[key]
+
+
+def params_hash(params, files=()):
+    """
+    Hash of a dict of parameters (anything json or repr can represent) and the contents of files.
+
+    files: paths (or nested lists of paths, as get_files returns) whose contents, not names, are hashed
+    """
+    checksums = _load_checksums()
+    n_known = len(checksums)
+    flat_files = []
+    for f in files:
+        flat_files.extend(f if isinstance(f, (list, tuple)) else [f])
+    file_hashes = [file_checksum(f, checksums) for f in flat_files if f]
+    if len(checksums) > n_known:
+        os.makedirs(op.dirname(CHECKSUM_CACHE), exist_ok=True)
+        tmp_file = f"{CHECKSUM_CACHE}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(checksums, f)
+        os.replace(tmp_file, CHECKSUM_CACHE)
+
+    h = hashlib.sha1()
+    h.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    for file_hash in file_hashes:
+        h.update(file_hash.encode())
+    return h.hexdigest()
+
+
+def hashed_working_dir(parent_dir, prefix, params, files=()):
+    """
+    Working directory {parent_dir}/{prefix}_{hash} for these parameters and input files, created if needed.
+
+    params should only pick the inputs (e.g. sub/ses/task/run/space); settings applied to them belong
+    to the nodes, or to hashed_datasink_dir. The parameters are saved in it (in MARKER).
+    """
+    working_dir = op.abspath(op.join(parent_dir, f"{prefix}_{params_hash(params, files)[:12]}"))
+    os.makedirs(working_dir, exist_ok=True)
+    marker = op.join(working_dir, MARKER)
+    with open(marker, 'w') as f:
+        json.dump({'params': params, 'files': [str(f) for f in files],
+                   'last_used': datetime.datetime.now().isoformat()}, f, indent=2, default=repr)
+    logger.debug(f"Working directory for {params}: {working_dir}")
+    return working_dir
+
+
+def hashed_datasink_dir(working_dir, params):
+    """
+    Directory {working_dir}/datasink_{hash} for the outputs of one set of settings (contrasts, model, ...)
+    on the working directory's inputs, created if needed, with the settings saved in it (in MARKER).
+
+    It is outside the nipype node directories, which nipype empties when a node reruns with other settings.
+    """
+    datasink_dir = op.join(working_dir, f"{DATASINK}_{params_hash(params)[:12]}")
+    os.makedirs(datasink_dir, exist_ok=True)
+    with open(op.join(datasink_dir, MARKER), 'w') as f:
+        json.dump({'params': params}, f, indent=2, default=repr)
+    return datasink_dir
+
+
+def set_last_datasink(working_dir, datasink_dir):
+    """Record datasink_dir as the results of the last job completed in working_dir"""
+    with open(op.join(working_dir, LAST_DATASINK), 'w') as f:
+        f.write(datasink_dir)
+
+
+def last_datasink(working_dir):
+    """The datasink directory recorded by set_last_datasink, or None"""
+    try:
+        with open(op.join(working_dir, LAST_DATASINK)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _running_file(working_dir):
+    return op.join(working_dir, RUNNING, f"{socket.gethostname()}-{os.getpid()}")
+
+
+@contextmanager
+def job(working_dir):
+    """
+    Run the with block as the only job in working_dir: wait for an exclusive lock on it, held until the
+    block ends. working_dir is marked as in use by this process meanwhile (waiting included), so that
+    gc_working_dirs leaves it alone, and as complete (last used now) if the block succeeds.
+    """
+    import fcntl
+
+    running_file = _running_file(working_dir)
+    os.makedirs(op.dirname(running_file), exist_ok=True)
+    with open(running_file, 'w') as f:
+        f.write(datetime.datetime.now().isoformat())
+    try:
+        with open(op.join(working_dir, LOCK), 'w') as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug(f"Waiting for the job running in {working_dir}")
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield working_dir
+                with open(op.join(working_dir, DONE), 'w') as f:
+                    f.write(datetime.datetime.now().isoformat())
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+    finally:
+        try:
+            os.remove(running_file)
+        except FileNotFoundError:
+            pass
+
+
+def is_running(working_dir):
+    """Whether a job (see job) is using working_dir. Jobs of this host whose process is gone don't count,
+    those of other hosts always do."""
+    try:
+        running = os.listdir(op.join(working_dir, RUNNING))
+    except FileNotFoundError:
+        return False
+    host = socket.gethostname()
+    for name in running:
+        job_host, _, pid = name.rpartition('-')
+        if job_host != host:
+            return True
+        try:
+            os.kill(int(pid), 0)
+            return True
+        except ProcessLookupError:
+            continue
+        except (PermissionError, ValueError):
+            return True
+    return False
+
+
+def _is_kept(name):
+    return name.startswith(DATASINK) or name in (MARKER, DONE, RUNNING, LOCK, LAST_DATASINK)
+
+
+def intermediates_size(path):
+    """Bytes under path outside the datasink directories (what gc_working_dirs would remove)"""
+    total = 0
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not _is_kept(d)]
+        for f in files:
+            if _is_kept(f):
+                continue
+            try:
+                total += os.lstat(op.join(root, f)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def remove_intermediates(path):
+    """Remove everything under path except the datasink directories (and the directories leading to them)"""
+    for entry in os.scandir(path):
+        if _is_kept(entry.name):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            remove_intermediates(entry.path)
+            if len(os.listdir(entry.path)) == 0:
+                os.rmdir(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+def gc_working_dirs(parent_dir, max_bytes=None, keep=()):
+    """
+    Remove the intermediates (everything but the datasinks, see remove_intermediates) of the least
+    recently completed working directories made by hashed_working_dir under parent_dir, until the
+    intermediates take up at most max_bytes. Only completed directories (see job) are cleaned up,
+    never those in keep (e.g. the one just used) or in use by a running job.
+
+    Returns the list of cleaned up directories.
+    """
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
+    keep = {op.abspath(k) for k in keep}
+    entries = []
+    total = 0
+    for d in os.listdir(parent_dir):
+        working_dir = op.abspath(op.join(parent_dir, d))
+        if not op.exists(op.join(working_dir, MARKER)):
+            continue
+        size = intermediates_size(working_dir)
+        total += size
+        done = op.join(working_dir, DONE)
+        if size > 0 and op.exists(done) and working_dir not in keep:
+            entries.append((os.stat(done).st_mtime, size, working_dir))
+    removed = []
+    for _, size, working_dir in sorted(entries):
+        if total <= max_bytes:
+            break
+        if is_running(working_dir):
+            continue
+        logger.debug(f"Removing the intermediates of {working_dir} ({size/1024**3:.1f} GB)")
+        remove_intermediates(working_dir)
+        removed.append(working_dir)
+        total -= size
+    return removed